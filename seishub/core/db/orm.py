@@ -275,6 +275,8 @@ class DbStorage(DbEnabled):
                                                     rel_order_by)
             elif value == DB_NULL:
                 q = q.where(table.c[colname] == None)
+            elif isinstance(value, (list, tuple)):
+                q = q.where(table.c[colname].in_(value))
             elif value:
                 q = q.where(table.c[colname] == value)
             # don't read lazy attribute columns
@@ -475,6 +477,9 @@ class DbStorage(DbEnabled):
         Use DB_NULL as a value to force a column to be None;
         attribute_name = None will be ignored:
             - attribute_name = DB_NULL
+
+        Use a list of values to select objects matching any of them:
+            - attribute_name = [value, ...]
         """
         if hasattr(self, 'debug') and self.debug:
             start = time.time()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
+from decimal import Decimal
+import datetime
 import json
 import re
 import unittest
 
 from seishub.core.db import util
+from seishub.core.exceptions import InvalidParameterError
 
 
 class dummy_request(object):
@@ -300,6 +303,27 @@ class DBUtilTestCase(unittest.TestCase):
                     </body>
                 </html>"""))
 
+    def test_cursor(self):
+        """
+        Tests encoding and decoding of continuation tokens.
+        """
+        values = [1, 2.5, u"abc", None, True,
+                  datetime.datetime(2010, 1, 2, 3, 4, 5, 600),
+                  datetime.datetime(2010, 1, 2), datetime.date(2010, 1, 2),
+                  Decimal("1.10")]
+        token = util.encodeCursor(values)
+        self.assertTrue(re.match("^[A-Za-z0-9_=-]+$", token))
+        self.assertEqual(util.decodeCursor(token), values)
+        self.assertRaises(InvalidParameterError, util.decodeCursor, "abc")
+        token = util.encodeCursor([1])[:-2]
+        self.assertRaises(InvalidParameterError, util.decodeCursor, token)
+        # the token is returned with the results
+        result = [{"attrib_1": "1"}]
+        formatted_result = util.formatResults(dummy_request("json"), result,
+                                              cursor=token)
+        output = json.loads(formatted_result)["ResultSet"]
+        self.assertEqual(output["nextCursor"], token)
+
 
 def suite():
     return unittest.makeSuite(DBUtilTestCase, 'test')
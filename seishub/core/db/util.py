@@ -5,9 +5,13 @@ Database related utilities.
 
 from decimal import Decimal
 from lxml.etree import Element, SubElement, tostring
+from seishub.core.exceptions import InvalidParameterError
 from seishub.core.util.xmlwrapper import toString
 import sqlalchemy
 from sqlalchemy import sql, Table
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+import base64
 import datetime
 import json
 
@@ -40,6 +44,27 @@ def compileStatement(stmt, bind=None, params={}, **kwargs):
     return s
 
 
+class Explain(Executable, ClauseElement):
+    """
+    Returns the execution plan of a select statement without executing it.
+
+    SQLite uses EXPLAIN QUERY PLAN. The last column of each returned row
+    describes one step of the plan.
+    """
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _explain(element, compiler, **kwargs):
+    return "EXPLAIN " + compiler.process(element.statement)
+
+
+@compiles(Explain, 'sqlite')
+def _explainSQLite(element, compiler, **kwargs):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement)
+
+
 def querySingleColumn(request, table, column, **kwargs):
     """
     """
@@ -83,6 +108,64 @@ def querySingleColumn(request, table, column, **kwargs):
                          count=count)
 
 
+def encodeCursor(values):
+    """
+    Encodes a list of values into an opaque continuation token.
+
+    Datetime, date and Decimal values keep their type.
+    """
+    def encode(value):
+        if isinstance(value, datetime.datetime):
+            return {'datetime': value.isoformat()}
+        elif isinstance(value, datetime.date):
+            return {'date': value.isoformat()}
+        elif isinstance(value, Decimal):
+            return {'decimal': str(value)}
+        return value
+    data = json.dumps([encode(value) for value in values],
+                      separators=(',', ':'))
+    return base64.urlsafe_b64encode(data)
+
+
+def decodeCursor(token):
+    """
+    Decodes a continuation token created by L{encodeCursor} into a list of
+    values.
+    """
+    def decode(value):
+        if not isinstance(value, dict):
+            return value
+        if 'datetime' in value:
+            value = value['datetime']
+            fmt = '%Y-%m-%dT%H:%M:%S'
+            if '.' in value:
+                fmt += '.%f'
+            return datetime.datetime.strptime(value, fmt)
+        elif 'date' in value:
+            return datetime.datetime.strptime(value['date'],
+                                              '%Y-%m-%d').date()
+        return Decimal(value['decimal'])
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+        if not isinstance(values, list):
+            raise ValueError
+        return [decode(value) for value in values]
+    except Exception:
+        raise InvalidParameterError("Invalid cursor: %s" % token)
+
+
+class ResultList(list):
+    """
+    A list of fetched result rows keeping the column order of the result.
+    """
+    def __init__(self, result):
+        list.__init__(self, result.fetchall())
+        self._keys = result.keys()
+
+    def keys(self):
+        return self._keys
+
+
 class CustomJSONEncoder(json.JSONEncoder):
     """
     Custom JSOn Encoder which also takes care of datetime and Decimal objects.
@@ -192,17 +275,20 @@ def formatORMResults(request, query, build_url=False):
 
 
 def formatResults(request, results, count=None, limit=None, offset=0,
-                  build_url=False):
+                  build_url=False, cursor=None):
     """
     Takes a list of (potentially nested) dictionaries and produces output in
     XML, JSON or XHTML. The limit and offset kwargs have to be provided by the
-    user.
+    user. A continuation token for the next page of results may be given as
+    cursor.
     Also sets the correct HTML headers.
     """
     base_url = request.env.getRestUrl()
     # create stats
     stats = {}
     stats['firstResultPosition'] = offset
+    if cursor:
+        stats['nextCursor'] = cursor
     # get format
     formats = request.args.get('format', []) or request.args.get('output', [])
     if 'json' in formats:
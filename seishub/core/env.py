@@ -100,6 +100,8 @@ class Environment(ComponentManager):
         # initialize the resource tree
         self.tree = ResourceTree(self)
         self.update()
+        # create missing keyval indexes of existing installations
+        self.catalog.index_catalog.migrateKeyvalIndexes()
         # XSLT transformation parameters
         self.xslt_params = {}
         # check if new environment has been created
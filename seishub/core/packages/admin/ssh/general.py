@@ -35,18 +35,35 @@ class ServiceCommand(Component):
 class ReindexCommand(Component):
     """
     Reindex the catalog (takes quite a while and blocks the server).
+
+    Usage: reindex [number of worker processes] [online]
+
+    Online reindexing keeps the old index rows queryable until all documents
+    have been processed.
     """
     implements(ISSHCommand)
 
     command_id = 'reindex'
 
     def executeCommand(self, request, args):
+        online = 'online' in args
+        args = [arg for arg in args if arg != 'online']
+        try:
+            processes = int(args[0])
+        except (IndexError, ValueError):
+            processes = None
         resourcetypes = self.env.registry.getAllPackagesAndResourceTypes()
         for pid, rid_list in resourcetypes.iteritems():
             for rid in rid_list:
+                def progress(done, total):
+                    request.writeln("%s/%s: %d of %d documents" % (pid, rid,
+                                                                  done, total))
                 try:
                     self.env.catalog.reindexResourceType(package_id=pid,
-                                                         resourcetype_id=rid)
+                                                         resourcetype_id=rid,
+                                                         processes=processes,
+                                                         progress=progress,
+                                                         online=online)
                 except Exception, e:
                     self.log.error("Error reindexing all resources", e)
                     request.writeln("Error reindexing %s/%s" % (pid, rid))
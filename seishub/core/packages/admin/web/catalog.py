@@ -190,16 +190,21 @@ class CatalogQueryPanel(Component):
         args = request.args
         if request.method == 'POST':
             query = None
-            if 'query' in args and 'send' in args:
+            if 'query' in args and ('send' in args or 'explain' in args):
                 query = data['query'] = request.args['query'][0]
             if query:
                 data['query'] = query
                 try:
                     t1 = time.time()
-                    result = self.catalog.query(query)
+                    if 'explain' in args:
+                        result = self.catalog.explain(query)
+                        rows = result['results']
+                    else:
+                        result = self.catalog.query(query)
+                        rows = len(result['ordered'])
                     t2 = time.time()
                     data['clock'] = "%0.6f" % (t2 - t1)
-                    data['rows'] = len(result) - 1
+                    data['rows'] = rows
                     data['result'] = pprint.pformat(result, 4)
                 except Exception, e:
                     self.env.log.info('Catalog query error', e)
@@ -369,3 +374,68 @@ class DatabaseStatusPanel(Component):
             out += '\n    (more)'
         out += '\n'
         return out
+
+
+class KeyvalIndexesPanel(Component):
+    """
+    Lists, creates and drops the keyval database indexes of all index tables.
+    """
+    implements(IAdminPanel)
+
+    template = 'templates' + os.sep + 'catalog_keyval_indexes.tmpl'
+    panel_ids = ('catalog', 'Catalog', 'keyval-indexes', 'Keyval Indexes')
+    has_roles = ['CATALOG_ADMIN']
+
+    def render(self, request):
+        data = {}
+        args = request.args
+        if request.method == 'POST':
+            names = args.get('index[]', [])
+            if 'create' in args:
+                data = self._createIndexes(names)
+            elif 'drop' in args:
+                data = self._dropIndexes(names)
+            elif 'migrate' in args:
+                data = self._migrateIndexes()
+        data['indexes'] = self.catalog.index_catalog.getKeyvalIndexes()
+        return data
+
+    def _createIndexes(self, names):
+        disabled = self.config.getlist('xmldb', 'disabled_keyval_indexes')
+        for name in names:
+            try:
+                self.catalog.index_catalog.createKeyvalIndex(name)
+            except Exception, e:
+                self.log.error("Error creating keyval index", e)
+                return {'error': ("Error creating keyval index", e)}
+            if name in disabled:
+                disabled.remove(name)
+        self.config.set('xmldb', 'disabled_keyval_indexes',
+                        ','.join(disabled))
+        self.config.save()
+        return {'info': "Keyval indexes have been created."}
+
+    def _dropIndexes(self, names):
+        disabled = self.config.getlist('xmldb', 'disabled_keyval_indexes')
+        for name in names:
+            try:
+                self.catalog.index_catalog.dropKeyvalIndex(name)
+            except Exception, e:
+                self.log.error("Error dropping keyval index", e)
+                return {'error': ("Error dropping keyval index", e)}
+            if name not in disabled:
+                disabled.append(name)
+        # dropped indexes are not created again at start up
+        self.config.set('xmldb', 'disabled_keyval_indexes',
+                        ','.join(disabled))
+        self.config.save()
+        return {'info': "Keyval indexes have been dropped."}
+
+    def _migrateIndexes(self):
+        try:
+            created = self.catalog.index_catalog.migrateKeyvalIndexes()
+        except Exception, e:
+            self.log.error("Error creating keyval indexes", e)
+            return {'error': ("Error creating keyval indexes", e)}
+        return {'info': "%d missing keyval indexes have been created." % \
+                len(created)}
@@ -3,8 +3,10 @@
 Standard packages required by SeisHub.
 """
 
+from seishub.core.config import _TRUE_VALUES
 from seishub.core.core import Component, implements
 from seishub.core.db.util import formatResults
+from seishub.core.exceptions import UnauthorizedError
 from seishub.core.packages.installer import registerStylesheet, registerIndex
 from seishub.core.packages.interfaces import IPackage, IResourceType, IMapper
 import os
@@ -66,9 +68,24 @@ class XPathMapper(Component):
         if len(request.path) < 7:
             return {}
         xpath = request.path[6:]
+        # explain the evaluation of the query - executes the query and
+        # exposes the SQL statement, so only for authenticated users
+        if request.args0.get('explain', '').lower() in _TRUE_VALUES:
+            if not request.isAuthenticatedUser():
+                raise UnauthorizedError("Authentication required to "
+                                        "explain a query.")
+            # errors are the reason to explain a query - don't hide them
+            result = self.env.catalog.explain(xpath)
+            result['predicates'] = repr(result['predicates'])
+            result['plan'] = '\n'.join(result['plan'])
+            return formatResults(request, [result])
         # get resources
         try:
-            resources = self.env.catalog.query(xpath, full=True)
+            found = self.env.catalog.query(xpath)
+            # aggregate queries return a row for each group
+            if isinstance(found, list):
+                return formatResults(request, found, count=len(found))
+            resources = self.env.catalog.xmldb.getResources(found['ordered'])
         except:
             return {}
         # get indexed data 
@@ -81,4 +98,5 @@ class XPathMapper(Component):
             data['resource_name'] = str(resource._name)
             results.append(data)
         # generate output 
-        return formatResults(request, results, count=len(results))
+        return formatResults(request, results, count=len(results),
+                             cursor=found.get('cursor'))
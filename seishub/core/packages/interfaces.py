@@ -221,6 +221,11 @@ class ISQLView(Interface):
 class IProcessorIndex(Interface):
     """
     Interface definition for a custom ProcessorIndex.
+
+    Implementations may additionally provide an optional method
+    evalMany(documents), which evaluates the index on a list of documents at
+    once, e.g. during reindexing. It has to return a list containing the
+    result of L{eval} for each given document, in the same order.
     """
     package_id = Attribute("""
         Defines the package ID of this index.
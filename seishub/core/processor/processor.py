@@ -128,6 +128,9 @@ class Processor:
         except:
             return None
 
+    def isAuthenticatedUser(self):
+        return self.getUser() not in (None, 'anonymous')
+
 
 def getChildForRequest(resource, request):
     """
@@ -6,14 +6,15 @@ REST based resources.
 from lxml import etree
 from obspy.core import UTCDateTime
 from seishub.core.exceptions import ForbiddenError, NotFoundError, \
-    SeisHubError, NotAllowedError, UnauthorizedError
+    SeisHubError, NotAllowedError, UnauthorizedError, InvalidParameterError
 from seishub.core.processor.interfaces import IRESTResource, IRESTProperty, \
     IXMLIndex
 from seishub.core.processor.processor import MAXIMAL_URL_LENGTH, PUT, GET, \
     HEAD, POST
 from seishub.core.processor.resources.resource import Resource, Folder, \
     StaticFolder
-from seishub.core.db.util import formatResults
+from seishub.core.db.util import formatResults, encodeCursor, \
+    decodeCursor, ResultList
 from seishub.core.util.path import splitPath
 from seishub.core.util.text import isInteger
 from seishub.core.util.xml import addXMLDeclaration
@@ -580,6 +581,10 @@ class RESTResourceTypeFolder(Folder):
         downside is that it is not easily testable.
 
         It supports the limit and offset parameters in the standard fashion.
+        Deeper pages should be requested with the cursor parameter, set to the
+        nextCursor attribute of the previous page, which resumes directly
+        after the last returned row. The total number of results is only
+        counted for requests without cursor.
 
         It furthermore allows filtering by any indexed values. Assume the
         resource has an index called indexed_value. Filtering is then possible
@@ -593,6 +598,7 @@ class RESTResourceTypeFolder(Folder):
         """
         limit = int(request.args0.get("limit", 20))
         offset = int(request.args0.get("offset", 0))
+        cursor = request.args0.get("cursor")
         table = "/%s/%s" % (self.package_id, self.resourcetype_id)
 
         # Directly access the database via an SQLView which is automatically
@@ -604,7 +610,9 @@ class RESTResourceTypeFolder(Folder):
         query = sql.select([tab])
         # Now loop over all parameters and apply the filters.
         for param, value in request.args0.iteritems():
-            if param in columns:
+            if param == "cursor":
+                continue
+            elif param in columns:
                 query = query.where(
                     tab.c[param] == tab.c[param].type.python_type(value))
             elif param.startswith("min_") and param[4:] in columns:
@@ -616,14 +624,37 @@ class RESTResourceTypeFolder(Folder):
                 query = query.where(
                     tab.c[name] <= tab.c[name].type.python_type(value))
 
-        count = query.count()
-        count = request.env.db.query(count).first()[0]
-        query = query.limit(limit).offset(offset)
+        if cursor:
+            try:
+                document_id, skip, offset = decodeCursor(cursor)
+            except ValueError:
+                raise InvalidParameterError("Invalid cursor: %s" % cursor)
+            query = query.where(tab.c["document_id"] >= document_id)
+            count = None
+        else:
+            document_id, skip = None, offset
+            count = query.count()
+            count = request.env.db.query(count).first()[0]
+        # Rows are sorted by document id. Multiple rows of one document are
+        # sorted by all other columns, so a cursor may skip the already
+        # returned rows of its document.
+        query = query.order_by(tab.c["document_id"],
+            *[tab.c[name] for name in columns if name != "document_id"])
+        query = query.limit(limit).offset(skip)
         # Execute the query.
-        result = request.env.db.query(query)
+        result = ResultList(request.env.db.query(query))
+        # Create the continuation token if there might be more rows.
+        next_cursor = None
+        if limit and len(result) == limit:
+            last_id = result[-1]["document_id"]
+            ids = [row["document_id"] for row in result]
+            rows = ids.count(last_id)
+            if rows == len(ids) and last_id == document_id:
+                rows += skip
+            next_cursor = encodeCursor([last_id, rows, offset + len(ids)])
 
         result = formatResults(request, result, limit=limit, offset=offset,
-            count=count)
+            count=count, cursor=next_cursor)
         return result
 
     def renderMetaInformation(self, request):
@@ -633,13 +664,12 @@ class RESTResourceTypeFolder(Folder):
         temp = {}
         # resources
         xpath = "/%s/%s" % (self.package_id, self.resourcetype_id)
-        res_dict = request.env.catalog.query(xpath)
-        for id in res_dict['ordered']:
-            name = res_dict[id]['resource_name']
+        for _, res in request.env.catalog.iterQuery(xpath):
+            name = res['resource_name']
             # skip lower revisions
-            if name in temp and temp[name].revision > res_dict[id]['revision']:
+            if name in temp and temp[name].revision > res['revision']:
                 continue
-            temp[name] = RESTResource(res_dict[id])
+            temp[name] = RESTResource(res)
         # indexes
         xmlindex_list = request.env.catalog.getIndexes(
             package_id=self.package_id, resourcetype_id=self.resourcetype_id)
@@ -51,6 +51,22 @@ class TestIndex(Component):
         return [1, 2, 3]
 
 
+class TestBatchIndex(Component):
+    implements(IProcessorIndex)
+
+    package_id = 'processorindextest'
+    resourcetype_id = 'testtype'
+    type = index.INTEGER_INDEX
+    label = 'testbatchindex'
+
+    def eval(self, document):
+        return len(document.data)
+
+    def evalMany(self, documents):
+        self.calls = getattr(self, 'calls', 0) + 1
+        return [[i, len(doc.data)] for i, doc in enumerate(documents)]
+
+
 class ProcessorIndexTest(SeisHubEnvironmentTestCase):
     def setUp(self):
         self.env.enableComponent(ProcessorIndexTestPackage)
@@ -89,6 +105,53 @@ class ProcessorIndexTest(SeisHubEnvironmentTestCase):
         # cleanup
         self.env.catalog.deleteIndex(idx)
 
+    def test_evalMany(self):
+        self.env.enableComponent(TestBatchIndex)
+        idx = self.env.catalog.index_catalog.getIndexes(
+            package_id='processorindextest', resourcetype_id='testtype')[0]
+        # processor index instances are reused
+        pidx = idx._getProcessorInstance(self.env)
+        self.assertTrue(idx._getProcessorInstance(self.env) is pidx)
+        # single evaluation
+        doc1 = newXMLDocument(RAW_XML1)
+        doc2 = newXMLDocument(RAW_XML1 % ('a', 'b'))
+        res = idx.eval(doc1, self.env)
+        self.assertEqual([el.key for el in res], [len(doc1.data)])
+        # batch evaluation calls evalMany only once
+        plan = index.XmlIndexPlan([idx])
+        res = plan.evalMany([doc1, doc2], self.env)
+        self.assertEqual(pidx.calls, 1)
+        self.assertEqual(len(res), 2)
+        self.assertEqual([el.key for el in res[0]], [0, len(doc1.data)])
+        self.assertEqual([el.key for el in res[1]], [1, len(doc2.data)])
+        self.assertEqual(type(res[1][0]), index.IntegerIndexElement)
+        self.env.disableComponent(TestBatchIndex)
+        # cleanup
+        self.env.catalog.deleteIndex(idx)
+
+    def test_deleteResourceUnloadedIndex(self):
+        """
+        Resources are deleted even if a processor index is not loaded.
+        """
+        self.env.enableComponent(TestIndex)
+        idx = self.env.catalog.index_catalog.getIndexes(
+            package_id='processorindextest', resourcetype_id='testtype')[0]
+        res = self.env.catalog.addResource('processorindextest', 'testtype',
+                                           RAW_XML1 % ('a', 'b'))
+        self.assertEqual(len(self.env.catalog.getIndexData(res)), 1)
+        # class of the processor index can't be imported
+        options = idx.options
+        idx.options = u'unloaded.module.TestIndex'
+        del idx._processor_idx
+        self.env.catalog.deleteResource(res)
+        table = index.FloatIndexElement.db_table
+        query = table.select(table.c['document_id'] == res.document._id)
+        self.assertEqual(self.env.db.query(query).fetchall(), [])
+        # cleanup
+        idx.options = options
+        self.env.disableComponent(TestIndex)
+        self.env.catalog.deleteIndex(idx)
+
 
 def suite():
     suite = unittest.TestSuite()
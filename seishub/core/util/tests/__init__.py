@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from seishub.core.util.tests import test_xml, test_xmlwrapper, test_text
+from seishub.core.util.tests import test_xml, test_xmlwrapper, test_text, \
+    test_cache
 import unittest
 
 
@@ -9,6 +10,7 @@ def suite():
     suite.addTest(test_xmlwrapper.suite())
     suite.addTest(test_text.suite())
     suite.addTest(test_xml.suite())
+    suite.addTest(test_cache.suite())
     return suite
 
 
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from seishub.core.util.cache import LRUCache
+import unittest
+
+
+class LRUCacheTest(unittest.TestCase):
+    """
+    Test case for L{seishub.core.util.cache.LRUCache}.
+    """
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # access a, so b is the least recently used item
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEquals(cache.get('b', 'default'), 'default')
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 1)
+        # pop and clear
+        self.assertEquals(cache.pop('c'), 3)
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.hits, 1)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.get('a'), None)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LRUCacheTest, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
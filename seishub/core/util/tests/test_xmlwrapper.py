@@ -2,7 +2,7 @@
 
 from seishub.core.exceptions import InvalidObjectError
 from seishub.core.util.xmlwrapper import XmlSchema, XmlTreeDoc, \
-    InvalidXPathExpression, xpathNamespaceFix
+    InvalidXPathExpression, xpathNamespaceFix, compileXPath
 import unittest
 
 
@@ -105,6 +105,22 @@ class XmlTreeTest(unittest.TestCase):
             "{http://test.org/spec}size")[0].getStrContent())
 
 
+    def testCompileXPath(self):
+        """
+        Compiled XPath evaluators are cached per expression and namespaces.
+        """
+        doc = XmlTreeDoc(xml_data=NAMESPACEFILE)
+        nsmap = doc.getRoot().nsmap
+        expr = "/order/ordered_things/{http://test.org/room}hotel_room"
+        evaluator = compileXPath(expr, nsmap)
+        self.assertTrue(evaluator is compileXPath(expr, nsmap))
+        self.assertEqual(len(evaluator(doc.getXml_doc())), 1)
+        # different namespace map results in a different evaluator
+        self.assertFalse(evaluator is compileXPath(expr, {}))
+        # invalid expressions
+        self.assertRaises(InvalidXPathExpression, compileXPath, '//', {})
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(XmlSchemaTest, 'test'))
@@ -147,6 +147,40 @@ class InvalidXPathExpression(SeisHubError):
     pass
 
 
+# compiled XPath evaluators keyed by expression and namespace map
+_XPATH_CACHE = {}
+_XPATH_CACHE_SIZE = 1000
+
+
+def compileXPath(expr, nsmap=None):
+    """
+    Returns a compiled XPath evaluator for the given expression.
+
+    The namespace map of the document root is used to resolve explicit and
+    default namespaces (see L{xpathNamespaceFix}). Evaluators are cached by
+    expression and namespace map, so each expression is only compiled once
+    per process.
+    """
+    nsmap = nsmap or {}
+    key = (expr, tuple(sorted(nsmap.items())))
+    try:
+        return _XPATH_CACHE[key]
+    except KeyError:
+        pass
+    fixed_expr, fixed_nsmap = xpathNamespaceFix(expr, nsmap.get(None))
+    if not fixed_nsmap:
+        fixed_nsmap = nsmap
+    try:
+        evaluator = etree.XPath(fixed_expr, namespaces=fixed_nsmap)
+    except Exception, e:
+        raise InvalidXPathExpression(("Error evaluating a XPath " +
+                                     "expression: %s") % str(fixed_expr), e)
+    if len(_XPATH_CACHE) >= _XPATH_CACHE_SIZE:
+        _XPATH_CACHE.clear()
+    _XPATH_CACHE[key] = evaluator
+    return evaluator
+
+
 class XmlNode(object):
     """
     Simple wrapper for libxml2.xmlNode.
@@ -180,12 +214,9 @@ class XmlNode(object):
             raise TypeError('String expected: %s' % expr)
         node_obj = self.getNode_obj()
         root = node_obj.getroottree().getroot()
-        default_namespace = root.nsmap.get(None)
-        expr, nsmap = xpathNamespaceFix(expr, default_namespace)
-        if not nsmap:
-            nsmap = root.nsmap
+        evaluator = compileXPath(expr, root.nsmap)
         try:
-            res = node_obj.xpath(expr, namespaces=nsmap)
+            res = evaluator(node_obj)
         except Exception, e:
             raise InvalidXPathExpression(("Error evaluating a XPath " +
                                          "expression: %s") % str(expr), e)
@@ -323,12 +354,9 @@ class XmlTreeDoc(XmlDoc):
         if not isinstance(expr, basestring):
             raise TypeError('String expected: %s' % expr)
         root = self.getRoot()
-        default_namespace = root.nsmap.get(None)
-        expr, nsmap = xpathNamespaceFix(expr, default_namespace)
-        if not nsmap:
-            nsmap = root.nsmap
+        evaluator = compileXPath(expr, root.nsmap)
         try:
-            res = self._xml_doc.xpath(expr, namespaces=nsmap)
+            res = evaluator(self._xml_doc)
         except Exception, e:
             raise InvalidXPathExpression(("Error evaluating a XPath " +
                                          "expression: %s") % str(expr), e)
@@ -12,7 +12,10 @@ DOCUMENT_TABLE = 'document'
 DOCUMENT_META_TABLE = 'document_meta'
 INDEX_TABLE = 'index'
 INDEX_DEF_TABLE = 'index_def'
+INDEX_SHADOW_TABLE = 'index_shadow'
 RESOURCE_TABLE = 'resource'
+# name suffix of the covering (index_id, keyval, document_id) indexes
+KEYVAL_INDEX_SUFFIX = '_idx_key_doc'
 
 
 def revision_default(ctx):
@@ -86,6 +89,9 @@ Index('idx_' + DEFAULT_PREFIX + 'text_' + INDEX_TABLE + '_idx_doc',
 Index('idx_' + DEFAULT_PREFIX + 'text_' + INDEX_TABLE + '_idx_doc_pos',
       index_text_tab.c.index_id, index_text_tab.c.document_id,
       index_text_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'text_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_text_tab.c.index_id, index_text_tab.c.keyval,
+      index_text_tab.c.document_id)
 
 
 index_numeric_tab = Table(DEFAULT_PREFIX + 'numeric_' + INDEX_TABLE, metadata,
@@ -103,6 +109,9 @@ Index('idx_' + DEFAULT_PREFIX + 'numeric_' + INDEX_TABLE + '_idx_doc',
 Index('idx_' + DEFAULT_PREFIX + 'numeric_' + INDEX_TABLE + '_idx_doc_pos',
       index_numeric_tab.c.index_id, index_numeric_tab.c.document_id,
       index_numeric_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'numeric_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_numeric_tab.c.index_id, index_numeric_tab.c.keyval,
+      index_numeric_tab.c.document_id)
 
 
 index_float_tab = Table(DEFAULT_PREFIX + 'float_' + INDEX_TABLE, metadata,
@@ -119,6 +128,9 @@ Index('idx_' + DEFAULT_PREFIX + 'float_' + INDEX_TABLE + '_idx_doc',
 Index('idx_' + DEFAULT_PREFIX + 'float_' + INDEX_TABLE + '_idx_doc_pos',
       index_float_tab.c.index_id, index_float_tab.c.document_id,
       index_float_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'float_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_float_tab.c.index_id, index_float_tab.c.keyval,
+      index_float_tab.c.document_id)
 
 
 index_datetime_tab = Table(DEFAULT_PREFIX + 'datetime_' + INDEX_TABLE,
@@ -136,6 +148,9 @@ Index('idx_' + DEFAULT_PREFIX + 'datetime_' + INDEX_TABLE + '_idx_doc',
 Index('idx_' + DEFAULT_PREFIX + 'datetime_' + INDEX_TABLE + '_idx_doc_pos',
       index_datetime_tab.c.index_id, index_datetime_tab.c.document_id,
       index_datetime_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'datetime_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_datetime_tab.c.index_id, index_datetime_tab.c.keyval,
+      index_datetime_tab.c.document_id)
 
 
 index_date_tab = Table(DEFAULT_PREFIX + 'date_' + INDEX_TABLE, metadata,
@@ -152,6 +167,9 @@ Index('idx_' + DEFAULT_PREFIX + 'date_' + INDEX_TABLE + '_idx_doc',
 Index('idx_' + DEFAULT_PREFIX + 'date_' + INDEX_TABLE + '_idx_doc_pos',
       index_date_tab.c.index_id, index_date_tab.c.document_id,
       index_date_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'date_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_date_tab.c.index_id, index_date_tab.c.keyval,
+      index_date_tab.c.document_id)
 
 
 index_boolean_tab = Table(DEFAULT_PREFIX + 'boolean_' + INDEX_TABLE, metadata,
@@ -168,6 +186,9 @@ Index('idx_' + DEFAULT_PREFIX + 'boolean_' + INDEX_TABLE + '_idx_doc',
 Index('idx_' + DEFAULT_PREFIX + 'boolean_' + INDEX_TABLE + '_idx_doc_pos',
       index_boolean_tab.c.index_id, index_boolean_tab.c.document_id,
       index_boolean_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'boolean_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_boolean_tab.c.index_id, index_boolean_tab.c.keyval,
+      index_boolean_tab.c.document_id)
 
 
 index_integer_tab = Table(DEFAULT_PREFIX + 'integer_' + INDEX_TABLE, metadata,
@@ -184,3 +205,88 @@ Index('idx_' + DEFAULT_PREFIX + 'integer_' + INDEX_TABLE + '_idx_doc',
 Index('idx_' + DEFAULT_PREFIX + 'integer_' + INDEX_TABLE + '_idx_doc_pos',
       index_integer_tab.c.index_id, index_integer_tab.c.document_id,
       index_integer_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'integer_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_integer_tab.c.index_id, index_integer_tab.c.keyval,
+      index_integer_tab.c.document_id)
+
+
+# postings of fulltext indexes - keyval holds a single normalized term
+index_fulltext_tab = Table(DEFAULT_PREFIX + 'fulltext_' + INDEX_TABLE,
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('index_id', Integer),
+    Column('keyval', Unicode),
+    Column('group_pos', Integer),
+    Column('document_id', Integer),
+    UniqueConstraint('index_id', 'keyval', 'group_pos', 'document_id'),
+    keep_existing=True
+)
+Index('idx_' + DEFAULT_PREFIX + 'fulltext_' + INDEX_TABLE + '_idx_doc',
+      index_fulltext_tab.c.index_id, index_fulltext_tab.c.document_id)
+Index('idx_' + DEFAULT_PREFIX + 'fulltext_' + INDEX_TABLE + '_idx_doc_pos',
+      index_fulltext_tab.c.index_id, index_fulltext_tab.c.document_id,
+      index_fulltext_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'fulltext_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_fulltext_tab.c.index_id, index_fulltext_tab.c.keyval,
+      index_fulltext_tab.c.document_id)
+
+
+# geo indexes - keyval holds the grid cell of the coordinate
+index_geo_tab = Table(DEFAULT_PREFIX + 'geo_' + INDEX_TABLE, metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('index_id', Integer),
+    Column('keyval', Integer),
+    Column('lat', Float(precision=52, asdecimal=False)),
+    Column('lon', Float(precision=52, asdecimal=False)),
+    Column('x', Float(precision=52, asdecimal=False)),
+    Column('y', Float(precision=52, asdecimal=False)),
+    Column('z', Float(precision=52, asdecimal=False)),
+    Column('group_pos', Integer),
+    Column('document_id', Integer),
+    UniqueConstraint('index_id', 'keyval', 'lat', 'lon', 'group_pos',
+                     'document_id'),
+    keep_existing=True
+)
+Index('idx_' + DEFAULT_PREFIX + 'geo_' + INDEX_TABLE + '_idx_doc',
+      index_geo_tab.c.index_id, index_geo_tab.c.document_id)
+Index('idx_' + DEFAULT_PREFIX + 'geo_' + INDEX_TABLE + '_idx_doc_pos',
+      index_geo_tab.c.index_id, index_geo_tab.c.document_id,
+      index_geo_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'geo_' + INDEX_TABLE + KEYVAL_INDEX_SUFFIX,
+      index_geo_tab.c.index_id, index_geo_tab.c.keyval,
+      index_geo_tab.c.document_id)
+
+
+# interval indexes - keyval holds the start and endval the end time
+index_interval_tab = Table(DEFAULT_PREFIX + 'interval_' + INDEX_TABLE,
+    metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('index_id', Integer),
+    Column('keyval', DateTime),
+    Column('endval', DateTime),
+    Column('duration', Float(precision=52, asdecimal=False)),
+    Column('group_pos', Integer),
+    Column('document_id', Integer),
+    UniqueConstraint('index_id', 'keyval', 'endval', 'group_pos',
+                     'document_id'),
+    keep_existing=True
+)
+Index('idx_' + DEFAULT_PREFIX + 'interval_' + INDEX_TABLE + '_idx_doc',
+      index_interval_tab.c.index_id, index_interval_tab.c.document_id)
+Index('idx_' + DEFAULT_PREFIX + 'interval_' + INDEX_TABLE + '_idx_doc_pos',
+      index_interval_tab.c.index_id, index_interval_tab.c.document_id,
+      index_interval_tab.c.group_pos)
+Index('idx_' + DEFAULT_PREFIX + 'interval_' + INDEX_TABLE + \
+      KEYVAL_INDEX_SUFFIX,
+      index_interval_tab.c.index_id, index_interval_tab.c.keyval,
+      index_interval_tab.c.document_id)
+Index('idx_' + DEFAULT_PREFIX + 'interval_' + INDEX_TABLE + '_idx_duration',
+      index_interval_tab.c.index_id, index_interval_tab.c.duration)
+
+# unfinished online reindexes - shadow rows are stored with index_id negated
+index_shadow_tab = Table(DEFAULT_PREFIX + INDEX_SHADOW_TABLE, metadata,
+    Column('index_id', Integer, primary_key=True, autoincrement=False),
+    Column('checkpoint', Integer),
+    Column('started', DateTime, default=datetime.utcnow),
+    keep_existing=True
+)
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from seishub.core.core import implements
 from seishub.core.db.orm import Serializable, Relation, db_property
 from seishub.core.xmldb import defaults
@@ -10,6 +10,9 @@ from twisted.python import log
 import sys
 from seishub.core.registry.package import ResourceTypeWrapper
 from obspy.core import UTCDateTime
+import math
+import re
+import unicodedata
 
 
 TEXT_INDEX = 0
@@ -21,11 +24,29 @@ TIMESTAMP_INDEX = 5
 PROCESSOR_INDEX = 6
 DATE_INDEX = 7
 INTEGER_INDEX = 8
+FULLTEXT_INDEX = 9
+GEO_INDEX = 10
+INTERVAL_INDEX = 11
+# index types evaluating pairs of nodes selected by xpath and options
+PAIRED_INDEX_TYPES = (GEO_INDEX, INTERVAL_INDEX)
 
 DATETIME_ISO_FORMAT = "%Y%m%d %H%M%S"
 DATE_ISO_FORMAT = "%Y%m%d"
 _FALSE_VALUES = ('no', 'false', 'off', '0', 'disabled')
 
+# common ISO 8601 forms, e.g. 2008-10-10, 2008-10-10T12:00 or
+# 2008-10-10T12:00:00.123456Z
+_ISO_DATETIME = re.compile(r'^(\d{4})-(\d{2})-(\d{2})'
+                           r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})'
+                           r'(?:\.(\d{1,6}))?)?Z?)?$')
+_EPOCH = datetime(1970, 1, 1)
+_DATETIME_CACHE = {}
+_DATETIME_CACHE_SIZE = 10000
+_TERM = re.compile(r'\w+', re.UNICODE)
+# grid cells of geo indexes in degrees
+GEO_CELL_SIZE = 1.0
+GEO_CELL_COLUMNS = int(360 / GEO_CELL_SIZE) + 1
+
 INDEX_TYPES = {
     "text":      TEXT_INDEX,
     "integer":   INTEGER_INDEX,
@@ -35,9 +56,85 @@ INDEX_TYPES = {
     "date":      DATE_INDEX,
     "timestamp": TIMESTAMP_INDEX,
     "boolean":   BOOLEAN_INDEX,
+    "fulltext":  FULLTEXT_INDEX,
+    "geo":       GEO_INDEX,
+    "interval":  INTERVAL_INDEX,
 }
 
 
+def parseDateTime(data):
+    """
+    Returns a naive UTC datetime object for a given date/time string.
+
+    Common ISO 8601 forms are parsed directly, any other input is handed to
+    L{obspy.core.UTCDateTime}. Results are cached.
+    """
+    try:
+        return _DATETIME_CACHE[data]
+    except (KeyError, TypeError):
+        pass
+    match = _ISO_DATETIME.match(data)
+    dt = None
+    if match:
+        parts = match.groups()
+        micro = parts[6] and int(parts[6].ljust(6, '0')) or 0
+        try:
+            dt = datetime(*[int(p or 0) for p in parts[:6]] + [micro])
+        except ValueError:
+            pass
+    if dt is None:
+        dt = UTCDateTime(data).datetime
+    if len(_DATETIME_CACHE) >= _DATETIME_CACHE_SIZE:
+        _DATETIME_CACHE.clear()
+    _DATETIME_CACHE[data] = dt
+    return dt
+
+
+def tokenize(data):
+    """
+    Returns the list of distinct normalized terms of a given text.
+
+    Terms are lower case words without any diacritical marks.
+    """
+    data = unicodedata.normalize('NFKD', unicode(data).lower())
+    data = u''.join([c for c in data if not unicodedata.combining(c)])
+    terms = []
+    seen = set()
+    for term in _TERM.findall(data):
+        if term not in seen:
+            seen.add(term)
+            terms.append(term)
+    return terms
+
+
+def getGeoCell(lat, lon):
+    """
+    Returns the grid cell number of a given coordinate.
+
+    Cells are numbered row by row starting at -90, -180 degrees, so all
+    cells between two latitudes form one consecutive range.
+    """
+    row = int(math.floor((lat + 90.0) / GEO_CELL_SIZE))
+    col = int(math.floor((lon + 180.0) / GEO_CELL_SIZE))
+    return row * GEO_CELL_COLUMNS + col
+
+
+def getUnitVector(lat, lon):
+    """
+    Returns the cartesian unit vector of a given coordinate.
+    """
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon),
+            math.sin(lat))
+
+
+def parseTimestamp(data):
+    """
+    Returns a naive UTC datetime object for a given POSIX timestamp.
+    """
+    return _EPOCH + timedelta(seconds=float(data))
+
+
 class XmlIndex(Serializable):
     """
     A XML index.
@@ -46,13 +143,20 @@ class XmlIndex(Serializable):
     @param xpath: path to node in XML tree to be indexed, or any arbitrary
     xpath expression, that returns a value of correct type
     @param type: TEXT_INDEX | NUMERIC_INDEX | DATETIME_INDEX | BOOLEAN_INDEX |
-                 DATE_INDEX | FLOAT_INDEX | INTEGER_INDEX | TIMESTAMP_INDEX
+                 DATE_INDEX | FLOAT_INDEX | INTEGER_INDEX | TIMESTAMP_INDEX |
+                 FULLTEXT_INDEX | GEO_INDEX | INTERVAL_INDEX
     @param options: additional options for an index
 
     Note:
     DATETIME_INDEX: options may be a format string (see time.strftime()
     documentation), but note that strftime / strptime does not support
     microseconds! Without a format string we assume a ISO 8601 string.
+    FULLTEXT_INDEX: each node is split into normalized terms (see tokenize)
+    which are stored as separate index elements.
+    GEO_INDEX: xpath selects the latitude and options the longitude node,
+    relative to the group path for grouping indexes.
+    INTERVAL_INDEX: xpath selects the ISO 8601 start and options the end
+    time node in the same way. A missing or empty end time is open ended.
     """
 
     implements(IXmlIndex)
@@ -158,11 +262,23 @@ class XmlIndex(Serializable):
         self._processor_idx = cls
         return cls
 
+    def _getProcessorInstance(self, env):
+        """
+        Returns the IProcessorIndex instance of this index for given env.
+        """
+        if getattr(self, '_processor_env', None) is not env or \
+           not hasattr(self, '_processor_instance'):
+            self._processor_instance = self._getProcessorIndex()(env)
+            self._processor_env = env
+        return self._processor_instance
+
     def _eval(self, xml_doc):
         if not IXmlDocument.providedBy(xml_doc):
             raise TypeError("%s is not an IXmlDocument." % str(xml_doc))
         parsed_doc = xml_doc.getXml_doc()
         try:
+            if self.type in PAIRED_INDEX_TYPES:
+                return self._evalPairs(parsed_doc)
             if self.group_path:
                 nodes = parsed_doc.evalXPath(self.group_path)
                 return [node.evalXPath(self.relative_xpath) or [None]
@@ -172,25 +288,62 @@ class XmlIndex(Serializable):
             log.err(e)
             return list()
 
+    def _evalPairs(self, parsed_doc):
+        """
+        Returns string pairs of the nodes selected by xpath and options.
+
+        Missing nodes of the second expression are returned as None.
+        """
+        if self.group_path:
+            nodes = parsed_doc.evalXPath(self.group_path)
+            paths = (self.relative_xpath, self.options)
+        else:
+            nodes = [parsed_doc]
+            paths = (self.xpath, self.options)
+        results = []
+        for node in nodes:
+            firsts = node.evalXPath(paths[0]) or []
+            seconds = node.evalXPath(paths[1]) or []
+            seconds = [n.getStrContent() for n in seconds[:len(firsts)]]
+            seconds += [None] * (len(firsts) - len(seconds))
+            results.append([(first.getStrContent(), second)
+                            for first, second in zip(firsts, seconds)]
+                           or [None])
+        return results
+
     def eval(self, xml_doc, env=None):
         if self.type == PROCESSOR_INDEX:
-            pidx = self._getProcessorIndex()(env)
-            type = pidx.type
-            elements = pidx.eval(xml_doc)
-            if not isinstance(elements, list):
-                elements = [elements]
-            elements = [elements]
-        else:
-            type = self.type
-            elements = self._eval(xml_doc)
+            values = self._getProcessorInstance(env).eval(xml_doc)
+            return self._createProcessorElements(values, xml_doc, env)
+        return self._createElements(self._eval(xml_doc), xml_doc, env)
+
+    def _createProcessorElements(self, values, xml_doc, env=None):
+        """
+        Creates index elements from the values returned by a processor index.
+        """
+        if not isinstance(values, list):
+            values = [values]
+        return self._createElements([values], xml_doc, env)
+
+    def _createElements(self, elements, xml_doc, env=None):
+        """
+        Creates index elements from a list of evaluated node lists.
+
+        The position of each node list is used as group position.
+        """
         res = list()
+        element_cls = self._getElementCls()
+        tokenize = element_cls._tokenize
         for pos, el_list in enumerate(elements):
+            if tokenize:
+                el_list = self._tokenizeElements(el_list, tokenize)
             for el in el_list:
-                # skip not existing nodes or ProcessorIndex
-                if el is not None and not self.type == PROCESSOR_INDEX:
+                # skip not existing nodes, ProcessorIndex, terms or pairs
+                if el is not None and self.type != PROCESSOR_INDEX and \
+                   self.type not in PAIRED_INDEX_TYPES and not tokenize:
                     el = el.getStrContent()
                 try:
-                    res.append(self._getElementCls()(self, el, xml_doc, pos))
+                    res.append(element_cls(self, el, xml_doc, pos))
                 except Exception, e:
                     if env:
                         log.msg(e)
@@ -199,10 +352,133 @@ class XmlIndex(Serializable):
                         continue
         return res
 
+    def _tokenizeElements(self, el_list, tokenize):
+        """
+        Splits all nodes of one group position into distinct terms.
+        """
+        terms = []
+        seen = set()
+        for el in el_list:
+            if el is None:
+                continue
+            if not self.type == PROCESSOR_INDEX:
+                el = el.getStrContent()
+            for term in tokenize(el):
+                if term not in seen:
+                    seen.add(term)
+                    terms.append(term)
+        return terms or [None]
+
     def prepareKey(self, data):
         return self._getElementCls()()._prepare_key(data)
 
 
+class XmlIndexPlan(object):
+    """
+    Evaluation plan for a list of XmlIndex objects of one resource type.
+
+    Indexes sharing a group path are evaluated in a single pass: each distinct
+    group path is evaluated only once per document and all relative XPath
+    expressions are evaluated against the shared group nodes. All other
+    indexes are evaluated on their own.
+    """
+
+    def __init__(self, xmlindex_list):
+        self.xmlindex_list = list(xmlindex_list)
+        self.groups = {}
+        for xmlindex in self.xmlindex_list:
+            if xmlindex.type == PROCESSOR_INDEX or \
+               xmlindex.type in PAIRED_INDEX_TYPES or \
+               not xmlindex.group_path:
+                continue
+            self.groups.setdefault(xmlindex.group_path, []).append(xmlindex)
+
+    def getTables(self):
+        """
+        Returns a set of all index tables used by the indexes of this plan.
+
+        If the class of a processor index is not loaded, its table is unknown
+        and all index tables are returned.
+        """
+        tables = set()
+        for xmlindex in self.xmlindex_list:
+            try:
+                tables.add(xmlindex._getElementCls().db_table)
+            except (KeyError, AttributeError):
+                return set([cls.db_table for cls in type_classes.values()])
+        return tables
+
+    def _evalGroups(self, xml_doc):
+        """
+        Returns evaluated node lists of all grouped indexes by index id.
+        """
+        if not self.groups:
+            return {}
+        if not IXmlDocument.providedBy(xml_doc):
+            raise TypeError("%s is not an IXmlDocument." % str(xml_doc))
+        parsed_doc = xml_doc.getXml_doc()
+        results = {}
+        for group_path, xmlindex_list in self.groups.iteritems():
+            try:
+                nodes = parsed_doc.evalXPath(group_path)
+            except Exception, e:
+                log.err(e)
+                for xmlindex in xmlindex_list:
+                    results[id(xmlindex)] = list()
+                continue
+            for xmlindex in xmlindex_list:
+                try:
+                    results[id(xmlindex)] = [
+                        node.evalXPath(xmlindex.relative_xpath) or [None]
+                        for node in nodes]
+                except Exception, e:
+                    log.err(e)
+                    results[id(xmlindex)] = list()
+        return results
+
+    def eval(self, xml_doc, env=None):
+        """
+        Evaluates all indexes on the given document.
+
+        Index elements are returned in the order of the given indexes.
+        """
+        return self._eval(xml_doc, env)
+
+    def evalMany(self, documents, env=None):
+        """
+        Evaluates all indexes on a list of documents.
+
+        Processor indexes providing the optional evalMany method are called
+        once for all documents. Returns a list of index element lists, one
+        for each given document.
+        """
+        processed = {}
+        for xmlindex in self.xmlindex_list:
+            if xmlindex.type != PROCESSOR_INDEX:
+                continue
+            pidx = xmlindex._getProcessorInstance(env)
+            if hasattr(pidx, 'evalMany'):
+                processed[id(xmlindex)] = pidx.evalMany(documents)
+        return [self._eval(xml_doc, env, processed, i)
+                for i, xml_doc in enumerate(documents)]
+
+    def _eval(self, xml_doc, env=None, processed=None, pos=0):
+        processed = processed or {}
+        grouped = self._evalGroups(xml_doc)
+        res = list()
+        for xmlindex in self.xmlindex_list:
+            if id(xmlindex) in grouped:
+                res.extend(xmlindex._createElements(grouped[id(xmlindex)],
+                                                    xml_doc, env))
+            elif id(xmlindex) in processed:
+                values = processed[id(xmlindex)][pos]
+                res.extend(xmlindex._createProcessorElements(values, xml_doc,
+                                                             env))
+            else:
+                res.extend(xmlindex.eval(xml_doc, env))
+        return res
+
+
 class KeyIndexElement(Serializable):
     """
     Base class for all indexes.
@@ -225,6 +501,11 @@ class KeyIndexElement(Serializable):
         self.document = document
         self.group_pos = group_pos
 
+    # function splitting node contents into multiple keys (see tokenize)
+    _tokenize = None
+    # additional columns of the index table
+    _extra_fields = ()
+
     def _filter_key(self, data):
         """
         Overwrite to do a type specific key handling.
@@ -305,8 +586,7 @@ class DateTimeIndexElement(KeyIndexElement):
         return self._prepare_key(data)
 
     def _prepare_key(self, data):
-        dt = UTCDateTime(data)
-        return dt.datetime
+        return parseDateTime(data)
 
 
 class DateIndexElement(KeyIndexElement):
@@ -340,12 +620,76 @@ class IntegerIndexElement(KeyIndexElement):
         return int(data)
 
 
+class FulltextIndexElement(KeyIndexElement):
+    db_table = defaults.index_fulltext_tab
+    _tokenize = staticmethod(tokenize)
+
+    def _filter_key(self, data):
+        return unicode(data)
+
+    def _prepare_key(self, data):
+        return u' '.join(tokenize(data))
+
+
+class GeoIndexElement(KeyIndexElement):
+    """
+    Coordinate with its grid cell as key.
+
+    The unit vector x, y, z allows exact distance tests without any
+    trigonometric functions in the database.
+    """
+    db_table = defaults.index_geo_tab
+    _extra_fields = ('lat', 'lon', 'x', 'y', 'z')
+    db_mapping = dict(KeyIndexElement.db_mapping,
+                      **dict([(f, f) for f in _extra_fields]))
+    lat = lon = x = y = z = None
+
+    def _filter_key(self, data):
+        lat, lon = float(data[0]), float(data[1])
+        if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            msg = "Invalid coordinate %s, %s."
+            raise ValueError(msg % (lat, lon))
+        self.lat, self.lon = lat, lon
+        self.x, self.y, self.z = getUnitVector(lat, lon)
+        return getGeoCell(lat, lon)
+
+    def _prepare_key(self, data):
+        return int(data)
+
+
+class IntervalIndexElement(KeyIndexElement):
+    """
+    Time interval with its start time as key.
+
+    The duration in seconds of all closed intervals is stored to restrict
+    overlap tests to a range of start times.
+    """
+    db_table = defaults.index_interval_tab
+    _extra_fields = ('endval', 'duration')
+    db_mapping = dict(KeyIndexElement.db_mapping,
+                      **dict([(f, f) for f in _extra_fields]))
+    endval = duration = None
+
+    def _filter_key(self, data):
+        start = parseDateTime(data[0].strip())
+        if data[1] and data[1].strip():
+            end = parseDateTime(data[1].strip())
+            if end < start:
+                msg = "Interval ends before it starts: %s - %s"
+                raise ValueError(msg % (start, end))
+            self.endval = end
+            self.duration = (end - start).total_seconds()
+        return start
+
+    def _prepare_key(self, data):
+        return parseDateTime(data)
+
+
 class TimestampIndexElement(KeyIndexElement):
     db_table = defaults.index_datetime_tab
 
     def _filter_key(self, data):
-        data = data.strip()
-        return UTCDateTime(float(data)).datetime
+        return parseTimestamp(data.strip())
 
 
 type_classes = {
@@ -356,5 +700,8 @@ type_classes = {
     BOOLEAN_INDEX:   BooleanIndexElement,
     DATE_INDEX:      DateIndexElement,
     INTEGER_INDEX:   IntegerIndexElement,
-    TIMESTAMP_INDEX: TimestampIndexElement
+    TIMESTAMP_INDEX: TimestampIndexElement,
+    FULLTEXT_INDEX:  FulltextIndexElement,
+    GEO_INDEX:       GeoIndexElement,
+    INTERVAL_INDEX:  IntervalIndexElement
 }
@@ -69,6 +69,12 @@ class IIndexBase(Interface):
         @return: key path
         """
 
+    def getCursor():  # @NoSelf
+        """
+        Get the sort key values of the row after which the query resumes
+        @return: list of values or None
+        """
+
     def getValue_path():  # @NoSelf
         """
         @return: value path
@@ -125,6 +131,12 @@ class IXPathQuery(Interface):
         @rtype: L{seishub.xmldb.xpath.PredicateExpression}
         """
 
+    def getCursor():  # @NoSelf
+        """
+        Get the sort key values of the row after which the query resumes
+        @return: list of values or None
+        """
+
     def getValue_path():  # @NoSelf
         """
         Get value path
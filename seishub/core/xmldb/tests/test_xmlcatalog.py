@@ -320,6 +320,48 @@ class XmlCatalogTest(SeisHubEnvironmentTestCase):
         self.env.catalog.deleteIndex(idx4)
         self.env.catalog.deleteIndex(idx5)
 
+    def test_queryCache(self):
+        """
+        Query results are cached until a queried resource type is modified.
+        """
+        catalog = self.env.catalog
+        stats = catalog.getQueryCacheStatistics()
+        q1 = '/testpackage/station/*'
+        q2 = '/testpackage/testml/*'
+        q3 = '/testpackage/*/*'
+        self.assertEqual(len(catalog.query(q1)['ordered']), 2)
+        self.assertEqual(len(catalog.query(q2)['ordered']), 1)
+        self.assertEqual(len(catalog.query(q3)['ordered']), 3)
+        # cached - modifying results does not change the cache
+        res = catalog.query(q1)
+        self.assertEqual(len(res['ordered']), 2)
+        id = res['ordered'].pop()
+        res[id]['resource_name'] = 'modified'
+        res = catalog.query(q1)
+        self.assertEqual(len(res['ordered']), 2)
+        self.assertNotEqual(res[id]['resource_name'], 'modified')
+        res[id]['resource_name'] = 'modified'
+        self.assertNotEqual(catalog.query(q1)[id]['resource_name'],
+                            'modified')
+        new_stats = catalog.getQueryCacheStatistics()
+        self.assertEqual(new_stats['hits'], stats['hits'] + 3)
+        self.assertEqual(new_stats['misses'], stats['misses'] + 3)
+        # adding a station invalidates station and wildcard queries only
+        res4 = catalog.addResource(PID1, RID1, RAW_XML)
+        self.assertEqual(len(catalog.query(q1)['ordered']), 3)
+        self.assertEqual(len(catalog.query(q2)['ordered']), 1)
+        self.assertEqual(len(catalog.query(q3)['ordered']), 4)
+        stats = catalog.getQueryCacheStatistics()
+        self.assertEqual(stats['hits'], new_stats['hits'] + 1)
+        self.assertEqual(stats['misses'], new_stats['misses'] + 2)
+        # deleting
+        catalog.deleteResource(res4)
+        self.assertEqual(len(catalog.query(q1)['ordered']), 2)
+        self.assertEqual(len(catalog.query(q3)['ordered']), 3)
+        # aggregate queries return their groups
+        self.assertEqual(catalog.query(q3 + ' select count()'),
+                         [{'count': 3}])
+
     def test_indexRevision(self):
         """
         Tests indexing of a version controlled resource.
@@ -355,7 +397,7 @@ class XmlCatalogTest(SeisHubEnvironmentTestCase):
         res = self.env.catalog.getResource("test-catalog", "index", "muh.xml",
                                            2)
         index_dict = self.env.catalog.getIndexData(res)
-        self.assertEqual(index_dict, {u'lat': {0: [u'50.23200']}})
+        self.assertEqual(index_dict, {})
         # reindex manually
         self.env.catalog.reindexIndex(idx)
         # clean up
@@ -259,6 +259,36 @@ class XmlDbManagerTest(SeisHubEnvironmentTestCase):
         self.xmldbm.deleteResource(res1)
         self.xmldbm.deleteResource(res2)
 
+    def testGetResources(self):
+        res1 = Resource(self.test_resourcetype,
+                        document=newXMLDocument(self.test_data % 'r1'))
+        res2 = Resource(self.vc_resourcetype,
+                        document=newXMLDocument(self.test_data % 'r2'))
+        self.xmldbm.addResource(res1)
+        self.xmldbm.addResource(res2)
+        res2_v2 = Resource(self.vc_resourcetype,
+                           document=newXMLDocument(self.test_data % 'r3'))
+        self.xmldbm.modifyResource(res2, res2_v2)
+        rev1 = self.xmldbm.getResource(id=res2.id, revision=1)
+        rev2 = self.xmldbm.getResource(id=res2.id)
+        # order of given document ids is kept
+        ids = [rev2.document._id, res1.document._id, rev1.document._id]
+        l = self.xmldbm.getResources(ids)
+        self.assertEqual([r.document._id for r in l], ids)
+        self.assertEqual(l[0].document.data, self.test_data % 'r3')
+        self.assertEqual(l[0].document.revision, 2)
+        self.assertEqual(l[1].document.data, self.test_data % 'r1')
+        self.assertEqual(l[1].resourcetype.resourcetype_id, 'testml')
+        self.assertEqual(l[2].document.data, self.test_data % 'r2')
+        self.assertEqual(l[2].document.revision, 1)
+        self.assertEqual(l[0]._id, l[2]._id)
+        self.assertEqual(self.xmldbm.getResources([]), [])
+        # unknown document ids
+        self.assertRaises(NotFoundError, self.xmldbm.getResources,
+                          [res1.document._id, -1])
+        self.xmldbm.deleteResource(res1)
+        self.xmldbm.deleteResource(res2)
+
 
 def suite():
     suite = unittest.TestSuite()
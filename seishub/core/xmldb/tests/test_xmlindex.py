@@ -5,7 +5,8 @@ from obspy.core import UTCDateTime
 from seishub.core.exceptions import SeisHubError
 from seishub.core.test import SeisHubEnvironmentTestCase
 from seishub.core.xmldb import index
-from seishub.core.xmldb.index import NumericIndexElement, XmlIndex
+from seishub.core.xmldb.index import NumericIndexElement, XmlIndex, \
+    XmlIndexPlan, parseDateTime, tokenize, getGeoCell, GEO_CELL_COLUMNS
 from seishub.core.xmldb.resource import XmlDocument, newXMLDocument
 import unittest
 
@@ -245,6 +246,109 @@ class XmlIndexTest(SeisHubEnvironmentTestCase):
         res = idx.eval(doc, self.env)[0]
         self.assertEqual(res.key, dt.datetime)
 
+    def test_parseDateTime(self):
+        """
+        Fast ISO parsing has to match UTCDateTime.
+        """
+        for timestr in ['2008-10-10', '2008-10-10T12:00', '2008-10-10 12:00',
+                        '2008-10-10T12:13:14', '2008-10-10T12:13:14Z',
+                        '2008-10-10T12:13:14.5Z', '2008-10-10T12:13:14.000123',
+                        # handled by UTCDateTime
+                        '20081010T121314', '2008-10-10T12:13:14+02:00',
+                        '2008-10-10T12:13:14.1234567']:
+            self.assertEqual(parseDateTime(timestr),
+                             UTCDateTime(timestr).datetime)
+            # cached
+            self.assertEqual(parseDateTime(timestr),
+                             UTCDateTime(timestr).datetime)
+        self.assertRaises(ValueError, parseDateTime, '2008-13-10')
+
+    def test_FulltextIndex(self):
+        """
+        Tests indexing of normalized terms.
+        """
+        self.assertEqual(tokenize(u'Z\xfcrich: deep-focus, DEEP event!'),
+                         [u'zurich', u'deep', u'focus', u'event'])
+        self.assertEqual(tokenize(u'  '), [])
+        idx = XmlIndex(self.rt1, "/station/creation_date",
+                       index.FULLTEXT_INDEX)
+        doc = newXMLDocument(RAW_XML1 % (u"Deep event near B\xe9rn", ""))
+        res = idx.eval(doc, self.env)
+        self.assertEqual([el.key for el in res],
+                         [u'deep', u'event', u'near', u'bern'])
+        self.assertEqual(type(res[0]), index.FulltextIndexElement)
+        self.assertEqual(idx.prepareKey(u'Near'), u'near')
+        # terms of all nodes are distinct per group position
+        idx = XmlIndex(self.rt1, "/station/XY/paramXY", index.FULLTEXT_INDEX)
+        res = idx.eval(doc, self.env)
+        self.assertEqual([el.key for el in res],
+                         [u'20', u'5', u'11', u'blah'])
+        self.assertEqual([el.group_pos for el in res], [0, 0, 0, 0])
+        # missing node
+        idx = XmlIndex(self.rt1, "/station/missing", index.FULLTEXT_INDEX)
+        res = idx.eval(doc, self.env)
+        self.assertEqual([el.key for el in res], [None])
+
+    def test_GeoIndex(self):
+        """
+        Tests indexing of coordinates.
+        """
+        self.assertEqual(getGeoCell(-90, -180), 0)
+        self.assertEqual(getGeoCell(-89.5, 179.5), 359)
+        self.assertEqual(getGeoCell(50.232, 12.512),
+                         140 * GEO_CELL_COLUMNS + 192)
+        doc = newXMLDocument(RAW_XML1 % ("", ""))
+        idx = XmlIndex(self.rt1, "/station/lat", index.GEO_INDEX,
+                       options="/station/lon")
+        res = idx.eval(doc, self.env)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(type(res[0]), index.GeoIndexElement)
+        self.assertEqual(res[0].key, getGeoCell(50.232, 12.512))
+        self.assertEqual((res[0].lat, res[0].lon), (50.232, 12.512))
+        self.assertAlmostEqual(res[0].x ** 2 + res[0].y ** 2 +
+                               res[0].z ** 2, 1.0)
+        # grouped coordinates are evaluated relative to the group path
+        doc = newXMLDocument(RAW_XML2 % ("", ""))
+        idx = XmlIndex(self.rt1, "/station/XY/X", index.GEO_INDEX,
+                       options="Y", group_path="/station/XY")
+        res = idx.eval(doc, self.env)
+        self.assertEqual([(el.lat, el.lon, el.group_pos) for el in res],
+                         [(1.0, 2.0, 0), (4.0, 5.0, 1)])
+        # invalid coordinates are skipped
+        idx = XmlIndex(self.rt1, "/station/lon", index.GEO_INDEX,
+                       options="/station/XY/paramXY")
+        doc = newXMLDocument(RAW_XML1 % ("", ""))
+        self.assertEqual(len(idx.eval(doc)), 1)
+        idx = XmlIndex(self.rt1, "/station/XY/paramXY[3]", index.GEO_INDEX,
+                       options="/station/lon")
+        self.assertEqual(len(idx.eval(doc)), 0)
+
+    def test_IntervalIndex(self):
+        """
+        Tests indexing of time intervals.
+        """
+        xml = u"""<station><start>%s</start><end>%s</end></station>"""
+        idx = XmlIndex(self.rt1, "/station/start", index.INTERVAL_INDEX,
+                       options="/station/end")
+        doc = newXMLDocument(xml % ("2008-01-01", "2008-01-02T12:00:00"))
+        res = idx.eval(doc, self.env)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(type(res[0]), index.IntervalIndexElement)
+        self.assertEqual(res[0].key, datetime(2008, 1, 1))
+        self.assertEqual(res[0].endval, datetime(2008, 1, 2, 12))
+        self.assertEqual(res[0].duration, 129600.0)
+        # open ended interval
+        doc = newXMLDocument(xml % ("2008-01-01", ""))
+        res = idx.eval(doc, self.env)
+        self.assertEqual((res[0].key, res[0].endval, res[0].duration),
+                         (datetime(2008, 1, 1), None, None))
+        doc = newXMLDocument(u"<station><start>2008-01-01</start></station>")
+        res = idx.eval(doc, self.env)
+        self.assertEqual(res[0].endval, None)
+        # intervals ending before they start are skipped
+        doc = newXMLDocument(xml % ("2008-01-02", "2008-01-01"))
+        self.assertEqual(idx.eval(doc), [])
+
     def test_DateIndex(self):
         """
         Tests indexing of dates.
@@ -331,6 +435,24 @@ class XmlIndexTest(SeisHubEnvironmentTestCase):
         self.assertEqual(res[1].group_pos, 1)
 
 
+    def testIndexPlan(self):
+        """
+        Grouped indexes evaluated via an XmlIndexPlan share the group nodes.
+        """
+        doc = newXMLDocument(RAW_XML2)
+        idx1 = XmlIndex(self.rt1, "/station/XY/X", index.NUMERIC_INDEX,
+                        group_path="/station/XY")
+        idx2 = XmlIndex(self.rt1, "/station/station_code")
+        idx3 = XmlIndex(self.rt1, "/station/XY/Z/value", index.NUMERIC_INDEX,
+                        group_path="/station/XY")
+        plan = XmlIndexPlan([idx1, idx2, idx3])
+        self.assertEqual(plan.groups.keys(), ["/station/XY"])
+        res = plan.eval(doc, self.env)
+        self.assertEqual(len(res), 5)
+        self.assertEqual([(r.index, r.key, r.group_pos) for r in res],
+                         [(idx1, '1', 0), (idx1, '4', 1), (idx2, 'BERN', 0),
+                          (idx3, '3', 0), (idx3, '6', 1)])
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(XmlIndexTest, 'test'))
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
-from seishub.core.exceptions import DuplicateObjectError, NotFoundError
+from datetime import datetime
+from seishub.core.exceptions import DuplicateObjectError, NotFoundError, \
+    InvalidParameterError, SeisHubError
+from seishub.core.xmldb.defaults import document_tab
 from seishub.core.test import SeisHubEnvironmentTestCase
-from seishub.core.xmldb.index import XmlIndex, DATETIME_INDEX, FLOAT_INDEX
+from seishub.core.xmldb.index import XmlIndex, DATETIME_INDEX, FLOAT_INDEX, \
+    FULLTEXT_INDEX
 from seishub.core.xmldb.resource import Resource, newXMLDocument
 from seishub.core.xmldb.xpath import XPathQuery
 from sqlalchemy import sql, Table
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.types import NullType
 import os
 import unittest
 
@@ -316,6 +322,481 @@ class XmlIndexCatalogTest(SeisHubEnvironmentTestCase):
         self.catalog.deleteIndex(index3)
         self.xmldb.deleteResource(res)
 
+    def test_indexResourceDuplicates(self):
+        """
+        Indexing a resource twice should silently skip duplicate elements.
+        """
+        res = Resource(self.rt1, document=newXMLDocument(RAW_XML2))
+        self.xmldb.addResource(res)
+        index1 = XmlIndex(self.rt1, "/station/station_code", label='idx1')
+        index2 = XmlIndex(self.rt1, "/station/XY/paramXY", label='idx2')
+        index3 = XmlIndex(self.rt1, "/station/test_date", FLOAT_INDEX,
+                          label='idx3')
+        self.catalog.registerIndex(index1)
+        self.catalog.registerIndex(index2)
+        self.catalog.registerIndex(index3)
+        self.catalog.indexResource(res)
+        self.assertEquals(len(self.catalog.dumpIndexByResource(res)), 5)
+        # second run does not raise and does not add any rows
+        self.catalog.indexResource(res)
+        self.assertEquals(len(self.catalog.dumpIndexByResource(res)), 5)
+        self.assertEquals(len(self.catalog.dumpIndex(index2)), 3)
+        # clean up
+        self.catalog.deleteIndex(index1)
+        self.catalog.deleteIndex(index2)
+        self.catalog.deleteIndex(index3)
+        self.xmldb.deleteResource(res)
+
+    def test_indexCacheLookups(self):
+        """
+        Index lookups by resource type, label, xpath and wildcard path.
+        """
+        index1 = XmlIndex(self.rt1, "/station/XY/paramXY", label='idx1')
+        index2 = XmlIndex(self.rt1, "/station/lon", label='idx2')
+        index3 = XmlIndex(self.rt2, "/station/lon", label='idx1')
+        for index in [index1, index2, index3]:
+            self.catalog.registerIndex(index)
+        res = self.catalog.getIndexes(package_id='testpackage',
+                                      resourcetype_id='station')
+        self.assertEquals(res, [index1, index2])
+        res = self.catalog.getIndexes(package_id='testpackage',
+                                      resourcetype_id='station', label='idx1')
+        self.assertEquals(res, [index1])
+        res = self.catalog.getIndexes(package_id='testpackage',
+                                      resourcetype_id='testml',
+                                      xpath='/station/lon')
+        self.assertEquals(res, [index3])
+        res = self.catalog.getIndexes(label='idx1')
+        self.assertEquals(res, [index1, index3])
+        res = self.catalog.getIndexes(package_id='testpackage',
+                                      resourcetype_id='station', label='idx3')
+        self.assertEquals(res, [])
+        # wildcard paths
+        res = self.catalog.findIndex('testpackage', 'station', 'station/*/*')
+        self.assertEquals(res, index1)
+        res = self.catalog.findIndex('testpackage', 'station', '*/lon')
+        self.assertEquals(res, index2)
+        self.assertRaises(NotFoundError, self.catalog.findIndex,
+                          'testpackage', 'station', 'station/*/lon')
+        # deleted indexes are removed from all lookups
+        self.catalog.deleteIndex(index2)
+        self.assertRaises(NotFoundError, self.catalog.findIndex,
+                          'testpackage', 'station', '*/lon')
+        res = self.catalog.getIndexes(package_id='testpackage',
+                                      resourcetype_id='station', label='idx2')
+        self.assertEquals(res, [])
+        # clean up
+        self.catalog.deleteIndex(index1)
+        self.catalog.deleteIndex(index3)
+
+    def test_indexStatistics(self):
+        """
+        Statistics are collected per index and used to order predicates.
+        """
+        res1 = Resource(self.rt1, document=newXMLDocument(RAW_XML1))
+        res2 = Resource(self.rt1, document=newXMLDocument(RAW_XML2))
+        self.xmldb.addResource(res1)
+        self.xmldb.addResource(res2)
+        index1 = XmlIndex(self.rt1, "/station/chan_code", label='chan')
+        index2 = XmlIndex(self.rt1, "/station/XY/paramXY", FLOAT_INDEX,
+                          label='param')
+        self.catalog.registerIndex(index1)
+        self.catalog.registerIndex(index2)
+        self.catalog.reindexIndexes([index1, index2])
+        stats = self.catalog.getIndexStatistics(index1)
+        self.assertEquals(stats['rows'], 2)
+        self.assertEquals(stats['documents'], 2)
+        self.assertEquals(stats['distinct'], 1)
+        self.assertEquals(stats['bounds'], None)
+        stats = self.catalog.getIndexStatistics(index2)
+        self.assertEquals(stats['rows'], 3)
+        self.assertEquals(stats['documents'], 2)
+        self.assertEquals(stats['min'], 0)
+        self.assertEquals(stats['max'], 99)
+        self.assertEquals(len(stats['bounds']), 9)
+        # chan_code matches all documents, param > 50 only a single value
+        q = "/testpackage/station[chan = 1 and param > 50]"
+        conjuncts = self.catalog._getConjuncts(XPathQuery(q).getPredicates())
+        ordered = self.catalog._orderConjuncts(conjuncts)
+        self.assertEquals(ordered, conjuncts[::-1])
+        predicates = self.catalog._orderPredicates(
+            XPathQuery(q).getPredicates())
+        self.assertEquals(predicates, [conjuncts[1], 'and', conjuncts[0]])
+        res = self.catalog.query(XPathQuery(q))
+        self.assertEquals(res['ordered'], [res2.document._id])
+        # conjuncts in another order use the cached statement
+        q2 = "/testpackage/station[param > 50 and chan = 1]"
+        res = self.catalog.query(XPathQuery(q2))
+        self.assertEquals(res['ordered'], [res2.document._id])
+        # collecting statistics keeps cached statements
+        self.assertEquals(len(self.catalog._statements), 1)
+        self.catalog.updateIndexStatistics([index1, index2])
+        self.assertEquals(len(self.catalog._statements), 1)
+        # queries never collect statistics but schedule their collection
+        refreshed = []
+        self.catalog._refreshIndexStatistics = refreshed.append
+        self.catalog._statistics.clear()
+        res = self.catalog.query(XPathQuery(q))
+        self.assertEquals(res['ordered'], [res2.document._id])
+        self.assertEquals(self.catalog._statistics, {})
+        self.assertEquals(set(refreshed), set([index1, index2]))
+        del self.catalog._refreshIndexStatistics
+        stats = self.catalog.getIndexStatistics(index1)
+        self.assertEquals(stats['time'], None)
+        self.assertEquals(stats['rows'], 0)
+        self.assertFalse(self.catalog._isMultiValued(index2))
+        # clean up
+        self.catalog.deleteIndex(index1)
+        self.catalog.deleteIndex(index2)
+        self.xmldb.deleteResource(res1)
+        self.xmldb.deleteResource(res2)
+
+    def test_fulltextIndex(self):
+        """
+        Fulltext indexes are queried with the contains function.
+        """
+        xml = "<station><comment>%s</comment><code>%s</code></station>"
+        res1 = Resource(self.rt1, document=newXMLDocument(
+            xml % ("Deep event near Bern", "BERN")))
+        res2 = Resource(self.rt1, document=newXMLDocument(
+            xml % ("Shallow event, near Genf.", "GENF")))
+        self.xmldb.addResource(res1)
+        self.xmldb.addResource(res2)
+        index1 = XmlIndex(self.rt1, "/station/comment", FULLTEXT_INDEX,
+                          label='comment')
+        index2 = XmlIndex(self.rt1, "/station/code", label='code')
+        self.catalog.registerIndex(index1)
+        self.catalog.registerIndex(index2)
+        self.catalog.reindexIndexes([index1, index2])
+        id1 = res1.document._id
+        id2 = res2.document._id
+        q = "/testpackage/station[contains(comment, '%s')]"
+        res = self.catalog.query(XPathQuery(q % 'EVENT'))
+        self.assertEquals(res['ordered'], [id1, id2])
+        res = self.catalog.query(XPathQuery(q % 'deep'))
+        self.assertEquals(res['ordered'], [id1])
+        # all terms must match
+        res = self.catalog.query(XPathQuery(q % 'near genf'))
+        self.assertEquals(res['ordered'], [id2])
+        res = self.catalog.query(XPathQuery(q % 'deep genf'))
+        self.assertEquals(res['ordered'], [])
+        # combined with other predicates and functions
+        q = "/testpackage/station[contains(comment, 'near') and code = 'GENF']"
+        res = self.catalog.query(XPathQuery(q))
+        self.assertEquals(res['ordered'], [id2])
+        q = "/testpackage/station[not(contains(comment, 'deep'))]"
+        res = self.catalog.query(XPathQuery(q))
+        self.assertEquals(res['ordered'], [id2])
+        # contains requires a fulltext index and a term
+        q = "/testpackage/station[contains(code, 'BERN')]"
+        self.assertRaises(InvalidParameterError, self.catalog.query,
+                          XPathQuery(q))
+        q = "/testpackage/station[contains(comment, '...')]"
+        self.assertRaises(InvalidParameterError, self.catalog.query,
+                          XPathQuery(q))
+        # clean up
+        self.catalog.deleteIndex(index1)
+        self.catalog.deleteIndex(index2)
+        self.xmldb.deleteResource(res1)
+        self.xmldb.deleteResource(res2)
+
+    def test_geoIndex(self):
+        """
+        Geo indexes are queried with the within_bbox and within_radius
+        functions.
+        """
+        xml = "<station><lat>%s</lat><lon>%s</lon></station>"
+        coords = {'BERN': (46.95, 7.44), 'GENF': (46.20, 6.15),
+                  'FIJI': (-17.70, 178.00), 'SUVA': (-18.10, -179.90)}
+        for name, coord in coords.iteritems():
+            self.env.catalog.addResource("testpackage", "station",
+                                         xml % coord, name=name)
+        index = self.env.catalog.registerIndex("testpackage", "station",
+                                               "coord", "/station/lat", "geo",
+                                               "/station/lon")
+        self.env.catalog.reindexIndex(index, processes=2)
+        self.assertEquals(len(self.catalog.dumpIndex(index)), 4)
+        def query(q):
+            res = self.env.catalog.query("/testpackage/station[%s]" % q)
+            return sorted([res[id]['resource_name']
+                           for id in res['ordered']])
+        self.assertEquals(query("within_bbox(coord, 45, 48, 5, 11)"),
+                          ['BERN', 'GENF'])
+        self.assertEquals(query("within_bbox(station/lat, 46.5, 48, 5, 11)"),
+                          ['BERN'])
+        self.assertEquals(query("within_bbox(coord, -90, 90, -180, 180)"),
+                          ['BERN', 'FIJI', 'GENF', 'SUVA'])
+        # crossing the date line
+        self.assertEquals(query("within_bbox(coord, -20, -10, 170, -170)"),
+                          ['FIJI', 'SUVA'])
+        # Bern and Genf are about 129 km apart
+        self.assertEquals(query("within_radius(coord, 46.95, 7.44, 120)"),
+                          ['BERN'])
+        self.assertEquals(query("within_radius(coord, 46.95, 7.44, 140)"),
+                          ['BERN', 'GENF'])
+        self.assertEquals(query("within_radius(coord, -18, 180, 250)"),
+                          ['FIJI', 'SUVA'])
+        self.assertEquals(query("within_radius(coord, 90, 0, 20000)"),
+                          ['BERN', 'FIJI', 'GENF', 'SUVA'])
+        self.assertEquals(query("not(within_radius(coord, -18, 180, 250))"),
+                          ['BERN', 'GENF'])
+        # moving a coordinate within its grid cell updates the row
+        res = self.env.catalog.getResource("testpackage", "station", "BERN")
+        self.env.catalog.modifyResource(res, xml % (46.95, 7.9))
+        self.assertEquals(query("within_bbox(coord, 45, 48, 7.5, 8)"),
+                          ['BERN'])
+        # invalid arguments
+        self.assertRaises(InvalidParameterError, query,
+                          "within_bbox(coord, 45, 48, 5)")
+        self.assertRaises(InvalidParameterError, query,
+                          "within_radius(coord, 'a', 7.44, 120)")
+        self.env.catalog.registerIndex("testpackage", "station", "code",
+                                       "/station/code")
+        self.assertRaises(InvalidParameterError, query,
+                          "within_bbox(code, 45, 48, 5, 11)")
+        self.assertRaises(InvalidParameterError,
+                          self.env.catalog.registerIndex, "testpackage",
+                          "station", "geo2", "/station/lat", "geo")
+        # clean up
+        for name in coords:
+            self.env.catalog.deleteResource(self.env.catalog.getResource(
+                "testpackage", "station", name))
+        self.env.catalog.deleteAllIndexes("testpackage")
+
+    def test_intervalIndex(self):
+        """
+        Interval indexes are queried with the overlaps function.
+        """
+        xml = """<station><channel><start>%s</start><end>%s</end></channel>
+                 <channel><start>%s</start><end>%s</end></channel></station>"""
+        epochs = {'BERN': ('2000-01-01', '2005-01-01', '2005-01-01', ''),
+                  'GENF': ('2001-06-01', '2001-07-01',
+                           '1990-01-01', '2000-06-01'),
+                  'FIJI': ('2008-01-01', '2009-01-01',
+                           '2009-01-01T12:00:00', '2010-01-01')}
+        for name, epoch in epochs.iteritems():
+            self.env.catalog.addResource("testpackage", "station",
+                                         xml % epoch, name=name)
+        index = self.env.catalog.registerIndex("testpackage", "station",
+                                               "epoch",
+                                               "/station/channel#start",
+                                               "interval", "end")
+        self.env.catalog.reindexIndex(index)
+        elements = self.catalog.dumpIndex(index)
+        self.assertEquals(len(elements), 6)
+        longest = datetime(2000, 6, 1) - datetime(1990, 1, 1)
+        self.assertEquals(max([el.duration for el in elements]),
+                          longest.total_seconds())
+        def query(q):
+            res = self.env.catalog.query("/testpackage/station[%s]" % q)
+            return sorted([res[id]['resource_name']
+                           for id in res['ordered']])
+        self.assertEquals(query("overlaps(epoch, '2001-06-15', '2001-06-15')"),
+                          ['BERN', 'GENF'])
+        self.assertEquals(query("overlaps(epoch, '1995-01-01', '1996-01-01')"),
+                          ['GENF'])
+        # open ended epoch
+        self.assertEquals(query("overlaps(epoch, '2020-01-01', '2021-01-01')"),
+                          ['BERN'])
+        # gap between two epochs
+        self.assertEquals(
+            query("overlaps(epoch, '2009-01-01T01:00', '2009-01-01T02:00')"),
+            ['BERN'])
+        self.assertEquals(
+            query("not(overlaps(epoch, '2009-01-01T01:00', '2009-01-02'))"),
+            ['GENF'])
+        # invalid arguments
+        self.assertRaises(InvalidParameterError, query,
+                          "overlaps(epoch, 'a', '2009-01-02')")
+        self.assertRaises(InvalidParameterError, query,
+                          "overlaps(epoch, '2009-01-02')")
+        self.assertRaises(InvalidParameterError,
+                          self.env.catalog.registerIndex, "testpackage",
+                          "station", "epoch2", "/station/channel/start",
+                          "interval")
+        # clean up
+        for name in epochs:
+            self.env.catalog.deleteResource(self.env.catalog.getResource(
+                "testpackage", "station", name))
+        self.env.catalog.deleteAllIndexes("testpackage")
+
+    def test_keyvalIndexes(self):
+        """
+        Keyval indexes are declared per table and may be dropped, created
+        and migrated. Partial indexes are maintained per XMLIndex.
+        """
+        indexes = self.catalog.getKeyvalIndexes()
+        names = [i['name'] for i in indexes]
+        self.assertEquals(len(indexes), 10)
+        self.assertTrue(all([i['exists'] for i in indexes]))
+        name = 'idx_default_float_index_idx_key_doc'
+        self.assertTrue(name in names)
+        index = indexes[names.index(name)]
+        self.assertEquals(index['columns'],
+                          ['index_id', 'keyval', 'document_id'])
+        self.assertEquals(index['index_id'], None)
+        # drop and migrate again
+        self.catalog.dropKeyvalIndex(name)
+        index = [i for i in self.catalog.getKeyvalIndexes()
+                 if i['name'] == name][0]
+        self.assertFalse(index['exists'])
+        self.assertEquals(self.catalog.migrateKeyvalIndexes(), [name])
+        self.assertEquals(self.catalog.migrateKeyvalIndexes(), [])
+        # disabled indexes are not migrated
+        self.catalog.dropKeyvalIndex(name)
+        self.env.config.set('xmldb', 'disabled_keyval_indexes', name)
+        self.assertEquals(self.catalog.migrateKeyvalIndexes(), [])
+        self.env.config.set('xmldb', 'disabled_keyval_indexes', '')
+        self.catalog.createKeyvalIndex(name)
+        self.assertRaises(NotFoundError, self.catalog.createKeyvalIndex,
+                          'idx_unknown')
+        if not self.catalog._supportsPartialIndexes():
+            return
+        # partial indexes
+        self.env.config.set('xmldb', 'partial_keyval_indexes', True)
+        xmlindex = XmlIndex(self.rt1, "/station/XY/paramXY", FLOAT_INDEX,
+                            label='param')
+        self.catalog.registerIndex(xmlindex)
+        partial = name + '_' + str(xmlindex._id)
+        index = [i for i in self.catalog.getKeyvalIndexes()
+                 if i['name'] == partial][0]
+        self.assertTrue(index['exists'])
+        self.assertEquals(index['index_id'], xmlindex._id)
+        self.assertEquals(index['columns'], ['keyval', 'document_id'])
+        # clean up
+        self.catalog.deleteIndex(xmlindex)
+        self.env.config.set('xmldb', 'partial_keyval_indexes', False)
+        names = [i['name'] for i in self.catalog.getKeyvalIndexes()]
+        self.assertFalse(partial in names)
+
+    def test_reindexIndexes(self):
+        """
+        Reindexing in worker processes should equal a serial reindex.
+        """
+        res1 = Resource(self.rt1, document=newXMLDocument(RAW_XML1))
+        res2 = Resource(self.rt1, document=newXMLDocument(RAW_XML2))
+        self.xmldb.addResource(res1)
+        self.xmldb.addResource(res2)
+        index1 = XmlIndex(self.rt1, "/station/station_code", label='idx1')
+        index2 = XmlIndex(self.rt1, "/station/XY/paramXY", label='idx2')
+        self.catalog.registerIndex(index1)
+        self.catalog.registerIndex(index2)
+        # serial with progress report
+        calls = []
+        progress = lambda done, total: calls.append((done, total))
+        self.catalog.reindexIndexes([index1, index2], batch_size=1,
+                                    progress=progress)
+        self.assertEquals(calls, [(1, 2), (2, 2)])
+        serial = [sorted([(el.key, el.group_pos, el.document._id)
+                          for el in self.catalog.dumpIndex(idx)])
+                  for idx in [index1, index2]]
+        self.assertEquals(len(serial[0]), 2)
+        self.assertEquals(len(serial[1]), 4)
+        # worker processes
+        self.catalog.reindexIndexes([index1, index2], processes=2,
+                                    batch_size=1)
+        parallel = [sorted([(el.key, el.group_pos, el.document._id)
+                            for el in self.catalog.dumpIndex(idx)])
+                    for idx in [index1, index2]]
+        self.assertEquals(serial, parallel)
+        # documents which can not be evaluated stop both reindexes
+        self.env.db.query(document_tab.update().\
+                          where(document_tab.c['id'] == res2.document._id).\
+                          values(data=u'<station>'))
+        self.assertRaises(Exception, self.catalog.reindexIndexes,
+                          [index1, index2])
+        self.assertRaises(SeisHubError, self.catalog.reindexIndexes,
+                          [index1, index2], processes=2, batch_size=1)
+        # clean up
+        self.catalog.deleteIndex(index1)
+        self.catalog.deleteIndex(index2)
+        self.xmldb.deleteResource(res1)
+        self.xmldb.deleteResource(res2)
+
+    def test_onlineReindex(self):
+        """
+        Online reindexing keeps the old index rows until it has finished.
+        """
+        index = self.env.catalog.registerIndex("testpackage", "station",
+                                               "code", "/station/station_code")
+        res1 = self.env.catalog.addResource("testpackage", "station",
+                                            RAW_XML1, name='bern')
+        res2 = self.env.catalog.addResource("testpackage", "station",
+                                            RAW_XML2, name='genf')
+        table = index._getElementCls().db_table
+        def dump(index_id):
+            query = sql.select([table.c.keyval], table.c.index_id == index_id)
+            return sorted([r[0] for r in self.catalog._db.execute(query)])
+        self.assertEquals(dump(index._id), ['BERN', 'GENF'])
+        # cancel after the first batch - old rows are still live
+        def progress(done, total):
+            self.assertEquals(dump(index._id), ['BERN', 'GENF'])
+            self.assertEquals(dump(-index._id), ['BERN'])
+            self.catalog.cancelReindex([index])
+        result = self.catalog.reindexIndexes([index], batch_size=1,
+                                             progress=progress, online=True)
+        self.assertFalse(result)
+        checkpoints = self.catalog.getReindexCheckpoints()
+        self.assertEquals(checkpoints, {index._id: res1.document._id})
+        # writes are applied to the shadow rows as well
+        res3 = self.env.catalog.addResource("testpackage", "station",
+                                            RAW_XML1.replace('BERN', 'BASEL'),
+                                            name='basel')
+        self.assertEquals(dump(index._id), ['BASEL', 'BERN', 'GENF'])
+        self.assertEquals(dump(-index._id), ['BASEL', 'BERN'])
+        # resume after the checkpoint and swap
+        calls = []
+        progress = lambda done, total: calls.append((done, total))
+        result = self.catalog.reindexIndexes([index], batch_size=1,
+                                             progress=progress, online=True,
+                                             resume=True)
+        self.assertTrue(result)
+        self.assertEquals(calls, [(1, 2), (2, 2)])
+        self.assertEquals(dump(index._id), ['BASEL', 'BERN', 'GENF'])
+        self.assertEquals(dump(-index._id), [])
+        self.assertEquals(self.catalog.getReindexCheckpoints(), {})
+        # deleting an index discards shadow rows of a cancelled reindex
+        progress = lambda done, total: self.catalog.cancelReindex([index])
+        self.catalog.reindexIndexes([index], batch_size=1,
+                                    progress=progress, online=True)
+        self.assertEquals(dump(-index._id), ['BERN'])
+        index_id = index._id
+        self.env.catalog.deleteIndex(index)
+        self.assertEquals(dump(-index_id), [])
+        self.assertEquals(self.catalog.getReindexCheckpoints(), {})
+        # clean up
+        self.env.catalog.deleteResource(res1)
+        self.env.catalog.deleteResource(res2)
+        self.env.catalog.deleteResource(res3)
+
+    def test_updateResource(self):
+        """
+        Modifying a resource should only touch changed index rows.
+        """
+        index = self.env.catalog.registerIndex("testpackage", "station",
+                                               "paramXY", IDX4, "float")
+        res = self.env.catalog.addResource("testpackage", "station",
+                                           RAW_XML2, name='muh')
+        def dump():
+            res = self.env.catalog.getResource("testpackage", "station",
+                                               "muh")
+            return sorted([(el.key, el._id)
+                           for el in self.catalog.dumpIndexByResource(res)])
+        before = dump()
+        self.assertEquals([k for k, _ in before], [0.0, 2.5, 99.0])
+        # unchanged document
+        self.env.catalog.modifyResource(res, RAW_XML2)
+        self.assertEquals(dump(), before)
+        # single value changed - other rows are kept
+        res = self.env.catalog.getResource("testpackage", "station", "muh")
+        self.env.catalog.modifyResource(res, RAW_XML2.replace('99', '42'))
+        after = dump()
+        self.assertEquals([k for k, _ in after], [0.0, 2.5, 42.0])
+        self.assertEquals(after[:2], before[:2])
+        # clean up
+        self.env.catalog.deleteResource(res)
+        self.env.catalog.deleteIndex(index)
+
     def test_indexResourceWithGrouping(self):
         # set up
         res = Resource(self.rt1, document=newXMLDocument(RAW_XML4))
@@ -369,6 +850,246 @@ class XmlIndexCatalogTest(SeisHubEnvironmentTestCase):
         self.catalog.deleteIndex(index2)
         self.xmldb.deleteResource(res)
 
+    def test_flushResource(self):
+        # set up
+        index1 = XmlIndex(self.rt1, "/station/station_code", label="code")
+        index2 = XmlIndex(self.rt1, "/station/XY/paramXY", FLOAT_INDEX,
+                          label="paramXY")
+        self.catalog.registerIndex(index1)
+        self.catalog.registerIndex(index2)
+        res1 = Resource(self.rt1, document=newXMLDocument(RAW_XML1))
+        res2 = Resource(self.rt1, document=newXMLDocument(RAW_XML2))
+        self.xmldb.addResource(res1)
+        self.xmldb.addResource(res2)
+        self.catalog.indexResource(res1)
+        self.catalog.indexResource(res2)
+        self.assertEquals(len(self.catalog.dumpIndexByResource(res2)), 4)
+        # flush res2 only
+        self.catalog.flushResource(res2)
+        self.assertEquals(len(self.catalog.dumpIndexByResource(res2)), 0)
+        self.assertEquals(len(self.catalog.dumpIndexByResource(res1)), 2)
+        # clean up:
+        self.catalog.deleteIndex(index1)
+        self.catalog.deleteIndex(index2)
+        self.xmldb.deleteResource(res1)
+        self.xmldb.deleteResource(res2)
+
+    def test_statementCache(self):
+        """
+        Queries differing only in values reuse the compiled statement.
+        """
+        self._setup_testdata()
+        cache = self.catalog._statements
+        q = "/testpackage/station[longitude = '%s' and " + \
+            "paramXY != '%s']"
+        res = self.catalog.query(XPathQuery(q % ('12.51200', '0')))
+        self.assertEquals(res['ordered'], [])
+        entries, hits = len(cache), cache.hits
+        res = self.catalog.query(XPathQuery(q % ('22.51200', '0')))
+        self.assertEquals(res['ordered'], [self.res2.document._id])
+        res = self.catalog.query(XPathQuery(q % ('22.51200', '5')))
+        self.assertEquals(res['ordered'], [self.res2.document._id])
+        res = self.catalog.query(XPathQuery(q % ('xxx', '5')))
+        self.assertEquals(res['ordered'], [])
+        self.assertEquals(len(cache), entries)
+        self.assertEquals(cache.hits, hits + 3)
+        # different shape
+        q = "/testpackage/station[latitude = '55.23200']"
+        res = self.catalog.query(XPathQuery(q))
+        self.assertEquals(res['ordered'], [self.res2.document._id])
+        self.assertEquals(len(cache), entries + 1)
+        # changing indexes invalidates all statements
+        self._cleanup_testdata()
+        self.assertEquals(len(cache), 0)
+
+    def test_iterQuery(self):
+        """
+        Streamed query results should equal the merged result dictionary.
+        """
+        self._setup_testdata()
+        q = "/testpackage/station order by station/lon desc"
+        res = self.catalog.query(XPathQuery(q))
+        self.assertEquals(res['ordered'], [self.res2.document._id,
+                                           self.res1.document._id])
+        items = list(self.catalog.iterQuery(XPathQuery(q)))
+        self.assertEquals([id for id, _ in items], res['ordered'])
+        self.assertEquals([record for _, record in items],
+                          [res[id] for id in res['ordered']])
+        # ordering by a multi-valued index is rejected
+        q = "/testpackage/station order by paramXY desc"
+        self.assertRaises(InvalidParameterError, list,
+                          self.catalog.iterQuery(XPathQuery(q)))
+        self._cleanup_testdata()
+
+    def test_cursorQuery(self):
+        """
+        Continuation tokens resume a query after the last returned row.
+        """
+        self._setup_testdata()
+        ids = [self.res1.document._id, self.res2.document._id,
+               self.res3.document._id]
+        for q, expected in [("/testpackage/*/*", ids),
+                            ("/testpackage/station order by station/lon desc",
+                             ids[1::-1])]:
+            res = self.catalog.query(XPathQuery(q + " limit 1"))
+            results = res['ordered']
+            while 'cursor' in res:
+                res = self.catalog.query(XPathQuery(q + " limit 1 after '%s'"
+                                                    % res['cursor']))
+                results.extend(res['ordered'])
+            self.assertEquals(results, expected)
+        # no token if all results are returned
+        res = self.catalog.query(XPathQuery("/testpackage/*/* limit 5"))
+        self.assertFalse('cursor' in res)
+        # token does not match the order by clause
+        q = "/testpackage/*/* limit 1"
+        cursor = self.catalog.query(XPathQuery(q))['cursor']
+        q = "/testpackage/station order by station/lon limit 1 after '%s'"
+        self.assertRaises(InvalidParameterError, self.catalog.query,
+                          XPathQuery(q % cursor))
+        self._cleanup_testdata()
+        # documents without a value of the sort key
+        idx = self.env.catalog.registerIndex('testpackage', 'testtype', 'lat',
+                                             '/station/lat', type='float')
+        resources = []
+        for i in range(10):
+            if i in (1, 3, 6, 8):
+                xml = '<station><lon>%d</lon></station>' % i
+            else:
+                xml = '<station><lat>%d</lat></station>' % (i % 3)
+            resources.append(self.env.catalog.addResource('testpackage',
+                                                          'testtype', xml))
+        for direction in ('asc', 'desc'):
+            q = "/testpackage/testtype order by station/lat %s" % direction
+            expected = self.catalog.query(XPathQuery(q))['ordered']
+            self.assertEquals(len(expected), 10)
+            res = self.catalog.query(XPathQuery(q + " limit 3"))
+            results = res['ordered']
+            while 'cursor' in res:
+                res = self.catalog.query(XPathQuery(q + " limit 3 after '%s'"
+                                                    % res['cursor']))
+                results.extend(res['ordered'])
+            self.assertEquals(results, expected)
+        self.env.catalog.deleteIndex(idx)
+        for res in resources:
+            self.env.catalog.deleteResource(res)
+
+    def test_aggregateQuery(self):
+        """
+        Aggregates and groups are computed by the database.
+        """
+        xml = "<event><mag>%s</mag><time>%s</time><pick>%s</pick>" + \
+              "<pick>%s</pick><amp>%s</amp><amp>%s</amp></event>"
+        data = [('1.2', '2010-01-01T10:00:00', 1, 2, 1, 3),
+                ('1.7', '2010-01-01T12:00:00', 3, 3, 2, 2),
+                ('-0.3', '2010-01-02T08:00:00', 5, 7, 4, 6),
+                ('2.5', '2010-01-02T09:30:00', 1, 1, 5, 5)]
+        resources = [self.env.catalog.addResource('testpackage', 'testtype',
+                                                  xml % values)
+                     for values in data]
+        indexes = [self.env.catalog.registerIndex('testpackage', 'testtype',
+                                                  label, xpath, type=type)
+                   for label, xpath, type in [('mag', '/event/mag', 'float'),
+                                              ('time', '/event/time',
+                                               'datetime'),
+                                              ('pick', '/event/pick',
+                                               'integer'),
+                                              ('amp', '/event/amp',
+                                               'integer')]]
+        for idx in indexes:
+            self.env.catalog.reindexIndex(idx)
+        q = "/testpackage/testtype[mag > 0] select count(), max(mag), " + \
+            "avg(pick)"
+        res = self.catalog.aggregate(XPathQuery(q))
+        self.assertEquals(len(res), 1)
+        self.assertEquals(res[0]['count'], 3)
+        self.assertEquals(res[0]['max_mag'], 2.5)
+        # each distinct value of a document is aggregated once
+        self.assertAlmostEquals(res[0]['avg_pick'], 7 / 4.0)
+        # also with multiple multi-valued indexes
+        q = "/testpackage/testtype[mag > 0] select count(), avg(pick), " + \
+            "avg(amp), max(amp)"
+        res = self.catalog.aggregate(XPathQuery(q))
+        self.assertEquals(res[0]['count'], 3)
+        self.assertAlmostEquals(res[0]['avg_pick'], 7 / 4.0)
+        self.assertAlmostEquals(res[0]['avg_amp'], 11 / 4.0)
+        self.assertEquals(res[0]['max_amp'], 5)
+        q = "/testpackage/testtype select count(), avg(pick), avg(amp) " + \
+            "group by bucket(time, 'day')"
+        res = self.catalog.aggregate(XPathQuery(q))
+        self.assertEquals([(r['count'], r['avg_amp']) for r in res],
+                          [(2, 2.0), (2, 5.0)])
+        self.assertAlmostEquals(res[0]['avg_pick'], 6 / 3.0)
+        self.assertAlmostEquals(res[1]['avg_pick'], 13 / 3.0)
+        # numeric buckets
+        q = "/testpackage/testtype select count(), min(mag) " + \
+            "group by bucket(mag, 1)"
+        res = self.catalog.aggregate(XPathQuery(q))
+        self.assertEquals([(r['mag'], r['count'], r['min_mag']) for r in res],
+                          [(-1, 1, -0.3), (1, 2, 1.2), (2, 1, 2.5)])
+        # date and time buckets
+        q = "/testpackage/testtype select count(), max(time) " + \
+            "group by bucket(time, 'day')"
+        res = self.catalog.aggregate(XPathQuery(q))
+        self.assertEquals([(r['time'], r['count'], r['max_time'])
+                           for r in res],
+                          [(datetime(2010, 1, 1), 2,
+                            datetime(2010, 1, 1, 12)),
+                           (datetime(2010, 1, 2), 2,
+                            datetime(2010, 1, 2, 9, 30))])
+        # group by values of a multi-valued index
+        q = "/testpackage/testtype select count() group by pick limit 2"
+        res = self.catalog.aggregate(XPathQuery(q))
+        self.assertEquals([(r['pick'], r['count']) for r in res],
+                          [(1, 2), (2, 1)])
+        # invalid queries
+        for q in ["/testpackage/testtype select avg(time)",
+                  "/testpackage/testtype select count() " + \
+                  "group by bucket(time, 'week')",
+                  "/testpackage/testtype select count() " + \
+                  "group by bucket(mag, -1)",
+                  "/testpackage/testtype select count() order by mag"]:
+            self.assertRaises(InvalidParameterError, self.catalog.aggregate,
+                              XPathQuery(q))
+        self.assertRaises(InvalidParameterError, self.catalog.query,
+                          XPathQuery("/testpackage/testtype select count()"))
+        self.assertRaises(InvalidParameterError, self.catalog.aggregate,
+                          XPathQuery("/testpackage/testtype"))
+        for idx in indexes:
+            self.env.catalog.deleteIndex(idx)
+        for res in resources:
+            self.env.catalog.deleteResource(res)
+
+    def test_explain(self):
+        """
+        Explaining a query returns statement, plan, indexes and timing.
+        """
+        self._setup_testdata()
+        q = "/testpackage/station[longitude = '22.51200'] " + \
+            "order by latitude desc"
+        res = self.catalog.explain(XPathQuery(q))
+        self.assertEquals(res['predicates'],
+                          [['testpackage', 'station', 'longitude'], '=',
+                           '22.51200'])
+        self.assertEquals([(i['index'], i['rows']) for i in res['indexes']],
+                          [(str(self.idx1), 2), (str(self.idx2), 2)])
+        self.assertTrue(res['sql'].startswith('SELECT DISTINCT'))
+        self.assertEquals(res['params']['value_0'], u'22.51200')
+        self.assertTrue(res['plan'])
+        self.assertEquals(res['results'], 1)
+        self.assertEquals(sorted(res['timing']),
+                          ['build', 'execute', 'process'])
+        # aggregate queries
+        q = "/testpackage/station select count() group by longitude"
+        res = self.catalog.explain(XPathQuery(q))
+        self.assertEquals(res['results'], 2)
+        # parse time is added by the catalog
+        res = self.env.catalog.explain(q)
+        self.assertEquals(res['query'], q)
+        self.assertEquals(sorted(res['timing']),
+                          ['build', 'execute', 'parse', 'process'])
+        self._cleanup_testdata()
+
     def test_runXPathQuery(self):
         # create test catalog
         self._setup_testdata()
@@ -625,6 +1346,56 @@ class XmlIndexCatalogTest(SeisHubEnvironmentTestCase):
         # remove test catalog
         self._cleanup_testdata()
 
+    def test_materializedIndexView(self):
+        """
+        Tests a materialized index view maintained on write.
+        """
+        self.env.config.set('xmldb', 'materialized_index_views', True)
+        sql = 'SELECT document_id, resource_name, longitude ' + \
+              'FROM "/testpackage/station" ORDER BY longitude'
+        # create test catalog
+        self._setup_testdata()
+        self.catalog.updateIndexView(self.idx1)
+        self.assertFalse('/testpackage/station' in self.env.db.getViews())
+        res = self.env.db.engine.execute(sql).fetchall()
+        self.assertEquals(len(set([tuple(r) for r in res])), 2)
+        # add a resource
+        res4 = self.env.catalog.addResource("testpackage", "station",
+                                            RAW_XML1.replace('12.51200', '1'),
+                                            name='muh')
+        res = self.env.db.engine.execute(sql).fetchall()
+        self.assertEquals(res[0], (res4.document._id, u'muh', u'1'))
+        # modify and rename it
+        self.env.catalog.modifyResource(res4,
+                                        RAW_XML1.replace('12.51200', '2'))
+        self.env.catalog.renameResource(res4, 'maeh')
+        res = self.env.db.engine.execute(sql).fetchall()
+        self.assertEquals(res[1], (res4.document._id, u'maeh', u'2'))
+        # delete it
+        self.env.catalog.deleteResource(res4)
+        res = self.env.db.engine.execute(sql).fetchall()
+        self.assertEquals(len(set([tuple(r) for r in res])), 2)
+        self.assertFalse(res4.document._id in [r[0] for r in res])
+        # columns are typed
+        columns = Inspector.from_engine(self.env.db.engine).\
+            get_columns('/testpackage/station')
+        for column in columns:
+            self.assertFalse(isinstance(column['type'], NullType))
+        # deleting all resources of a resource type clears the table
+        self.env.catalog.deleteAllResources('testpackage', 'station')
+        res = self.env.db.engine.execute(sql).fetchall()
+        self.assertEquals(res, [])
+        # switching back creates a view
+        self.env.config.set('xmldb', 'materialized_index_views', False)
+        self.catalog.updateIndexView(self.idx1)
+        self.assertTrue('/testpackage/station' in self.env.db.getViews())
+        # remove test catalog
+        for idx in [self.idx1, self.idx2, self.idx3, self.idx4, self.idx5] + \
+                self.idx_so:
+            self.env.catalog.deleteIndex(idx)
+        for res in [self.res3] + self.so_res:
+            self.env.catalog.deleteResource(res)
+
     def test_queryIndexView(self):
         # create test catalog
         self._setup_testdata()
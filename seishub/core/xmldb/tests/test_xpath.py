@@ -2,7 +2,8 @@
 
 from seishub.core.exceptions import InvalidParameterError
 from seishub.core.test import SeisHubEnvironmentTestCase
-from seishub.core.xmldb.xpath import XPathQuery, RestrictedXPathQueryParser
+from seishub.core.xmldb.xpath import XPathQuery, \
+    RestrictedXPathQueryParser, _getGrammar
 import unittest
 
 
@@ -239,6 +240,33 @@ class XPathQueryParserTest(SeisHubEnvironmentTestCase):
             self.assertEqual(r.limit, results[i][1])
             self.assertEqual(r.offset, results[i][2])
 
+    def testAggregateQuery(self):
+        self.parser.parse('/pid/rid select count()')
+        self.assertEqual(self.parser.aggregates, [['count', None]])
+        self.assertEqual(self.parser.group_by, None)
+        self.parser.parse('/pid/rid[rn/node1 > 5] select COUNT(), ' + \
+                          'min(rn/node2), avg(/pid/rid/rn/node3) ' + \
+                          'group by rn/node4, bucket(rn/node5, 0.5) limit 10')
+        self.assertEqual(self.parser.predicates,
+                         [['pid', 'rid', 'rn/node1'], '>', '5'])
+        self.assertEqual(self.parser.aggregates,
+                         [['count', None], ['min', ['pid', 'rid', 'rn/node2']],
+                          ['avg', ['pid', 'rid', 'rn/node3']]])
+        self.assertEqual(self.parser.group_by,
+                         [[['pid', 'rid', 'rn/node4'], None],
+                          [['pid', 'rid', 'rn/node5'], '0.5']])
+        self.assertEqual(self.parser.limit, 10)
+        self.parser.parse('/pid/rid/rn select max(node1) ' + \
+                          'group by bucket(node2, "day")')
+        self.assertEqual(self.parser.aggregates,
+                         [['max', ['pid', 'rid', 'rn/node1']]])
+        self.assertEqual(self.parser.group_by,
+                         [[['pid', 'rid', 'rn/node2'], 'day']])
+        self.assertRaises(InvalidParameterError, self.parser.parse,
+                          '/pid/rid select sum(rn/node1)')
+        self.assertRaises(InvalidParameterError, self.parser.parse,
+                          '/pid/rid select count() group by bucket(rn/node1)')
+
     def testXMLNodeLevelQuery(self):
         queries = ['/pid/rid/rn/node',
                    '/pid/rid/rn/@attr1',
@@ -286,6 +314,33 @@ class XPathQueryParserTest(SeisHubEnvironmentTestCase):
         for r in res:
             self.assertTrue(len(r.predicates) <= 3)
 
+    def testContainsFunction(self):
+        q = '/pid/rid[contains(rn/desc, "deep event") and not(' + \
+            'contains(../rid/rn/desc, "bern"))]'
+        self.parser.parse(q)
+        self.assertEqual(self.parser.predicates,
+                         [['contains', ['pid', 'rid', 'rn/desc'],
+                           'deep event'], 'and',
+                          ['not', ['contains', ['pid', 'rid', 'rn/desc'],
+                                   'bern']]])
+        q = '/pid/rid[within_bbox(rn/lat, -10, 10.5, 170, -170) or ' + \
+            'within_radius(rn/lat, 46.9, 7.4, "100")]'
+        self.parser.parse(q)
+        self.assertEqual(self.parser.predicates,
+                         [['within_bbox', ['pid', 'rid', 'rn/lat'],
+                           '-10', '10.5', '170', '-170'], 'or',
+                          ['within_radius', ['pid', 'rid', 'rn/lat'],
+                           '46.9', '7.4', '100']])
+        self.parser.parse('/pid/rid[overlaps(rn/epoch, "2001-01-01", ' + \
+                          '"2002-01-01")]')
+        self.assertEqual(self.parser.predicates,
+                         ['overlaps', ['pid', 'rid', 'rn/epoch'],
+                          '2001-01-01', '2002-01-01'])
+        # a node may still be named contains
+        self.parser.parse('/pid/rid[rn/contains = 5]')
+        self.assertEqual(self.parser.predicates,
+                         [['pid', 'rid', 'rn/contains'], '=', '5'])
+
 
 class XPathQueryTest(SeisHubEnvironmentTestCase):
     def testXPathQuery(self):
@@ -314,6 +369,34 @@ class XPathQueryTest(SeisHubEnvironmentTestCase):
         query = XPathQuery(q)
         self.assertEqual(query.getLocationPath(), q.split('/')[1:])
 
+    def testQueryCache(self):
+        """
+        Parsed queries are cached, but each query object gets its own copy.
+        """
+        q = "/pkg/rt/rootnode[node1 = 'a' and ../rootnode/node2 > 5]"
+        query1 = XPathQuery(q)
+        query2 = XPathQuery(q)
+        self.assertTrue(query1.parsed_query is query2.parsed_query)
+        self.assertEqual(query1.getPredicates(), query2.getPredicates())
+        query1.getPredicates()[0][0].append('x')
+        query1.location_steps.append('x')
+        self.assertEqual(query2.getPredicates(),
+                         [[['pkg', 'rt', 'rootnode/node1'], '=', 'a'], 'and',
+                          [['pkg', 'rt', 'rootnode/node2'], '>', '5']])
+        self.assertEqual(XPathQuery(q).getLocationPath(),
+                         ['pkg', 'rt', 'rootnode'])
+        # same paths relative to another location
+        query3 = XPathQuery(q.replace('/rt/', '/rt2/'))
+        self.assertEqual(query3.getPredicates()[0][0],
+                         ['pkg', 'rt2', 'rootnode/node1'])
+        # parsing without cache
+        parsed = query3.parse(query3.query, cache=False)
+        self.assertFalse(parsed is query3.parsed_query)
+        self.assertEqual(query3.getPredicates()[0][0],
+                         ['pkg', 'rt2', 'rootnode/node1'])
+        # the grammar is built only once
+        self.assertTrue(_getGrammar() is _getGrammar())
+
 #    test_expr = "/testpackage/testtype/rootnode[./element1/element2 = 'blub' and ./element1/@id <= 5]"
 #    wildcard_expr = "/*/*/rootnode[./element1/element2 = 'blub']"
 #    join_expr = "/seispkg/network/*[../event/*/station = ../network/*/station and ./@id = ../station/*/@id and ../event/*/datetime = yesterday]"
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from seishub.core.config import IntOption
 from seishub.core.exceptions import InvalidParameterError, NotFoundError, \
     InvalidObjectError
+from seishub.core.util.cache import LRUCache
 from seishub.core.util.xml import addXMLDeclaration, applyMacros
 from seishub.core.xmldb.index import XmlIndex, TEXT_INDEX, INDEX_TYPES
 from seishub.core.xmldb.interfaces import IResource
@@ -9,8 +11,10 @@ from seishub.core.xmldb.resource import Resource, newXMLDocument
 from seishub.core.xmldb.xmldbms import XmlDbManager
 from seishub.core.xmldb.xmlindexcatalog import XmlIndexCatalog
 from seishub.core.xmldb.xpath import XPathQuery
+from collections import OrderedDict
 import os
 import datetime
+import time
 
 
 class XmlCatalog(object):
@@ -19,11 +23,25 @@ class XmlCatalog(object):
     
     Use this class to manage all indexes and resources.
     """
+    IntOption('xmldb', 'query_cache_size', 100,
+        "Number of catalog query results kept in memory (0 = disabled). "
+        "The cache is bounded by entries, not bytes - it holds up to "
+        "query_cache_size * query_cache_max_results result records.")
+    IntOption('xmldb', 'query_cache_max_results', 1000,
+        "Query results with more documents are not cached. Each cached "
+        "document keeps its full result record, including all values of "
+        "multi-valued indexes.")
+
     def __init__(self, env):
         self.env = env
         self.xmldb = XmlDbManager(env.db)
         self.index_catalog = XmlIndexCatalog(env.db, self.xmldb)
         self.index_catalog.env = env
+        self._results = LRUCache(env.config.getint('xmldb',
+                                                   'query_cache_size'))
+        self._generations = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
 
     def addResource(self, package_id, resourcetype_id, xml_data, uid=None,
                     name=None):
@@ -47,6 +65,7 @@ class XmlCatalog(object):
         self.validateResource(res)
         self.xmldb.addResource(res)
         self.index_catalog.indexResource(res)
+        self._invalidateResults(package_id, resourcetype_id)
         return res
 
     def renameResource(self, resource, new_name):
@@ -54,6 +73,9 @@ class XmlCatalog(object):
         Rename a given Resource object.
         """
         self.xmldb.renameResource(resource, new_name)
+        self.index_catalog.refreshIndexViewRows(resource)
+        self._invalidateResults(resource.package.package_id,
+                                resource.resourcetype.resourcetype_id)
 
     def modifyResource(self, resource, xml_data, uid=None):
         """
@@ -67,8 +89,10 @@ class XmlCatalog(object):
         self.validateResource(new_resource)
         self.xmldb.modifyResource(resource, new_resource, uid)
         # we only keep indexes for the newest revision
-        self.index_catalog.flushResource(resource)
-        self.index_catalog.indexResource(new_resource)
+        self.index_catalog.updateResource(resource, new_resource)
+        self.index_catalog.refreshIndexViewRows(new_resource)
+        self._invalidateResults(resource.package.package_id,
+                                resource.resourcetype.resourcetype_id)
 
     def deleteResource(self, resource=None, resource_id=None):
         """
@@ -105,6 +129,8 @@ class XmlCatalog(object):
         # remove indexed data:
         self.index_catalog.flushResource(resource)
         res = self.xmldb.deleteResource(resource)
+        self._invalidateResults(resource.package.package_id,
+                                resource.resourcetype.resourcetype_id)
         if not res:
             msg = "Error deleting a resource: No resource was found with " + \
                   "the given parameters."
@@ -115,7 +141,11 @@ class XmlCatalog(object):
         """
         Remove all resources of specified package_id and resourcetype_id.
         """
-        return self.xmldb.deleteAllResources(package_id, resourcetype_id)
+        try:
+            return self.xmldb.deleteAllResources(package_id, resourcetype_id)
+        finally:
+            self.index_catalog.clearIndexViewRows(package_id, resourcetype_id)
+            self._invalidateResults(package_id, resourcetype_id)
 
     def getResource(self, package_id=None, resourcetype_id=None,
                     name=None, revision=None, document_id=None,
@@ -192,7 +222,12 @@ class XmlCatalog(object):
         Register an index.
         
         @param type: "text" | "numeric" | "float" | "datetime" | "boolean" |
-                     "date" | "integer" | "timestamp"
+                     "date" | "integer" | "timestamp" | "fulltext" | "geo" |
+                     "interval"
+        @param options: index options, e.g. a format string for datetime
+                        indexes, the longitude XPath expression of a geo
+                        index, whose xpath selects the latitude, or the end
+                        time XPath expression of an interval index
         """
         # check for label
         if not label:
@@ -212,6 +247,10 @@ class XmlCatalog(object):
         if type.lower() not in INDEX_TYPES:
             msg = "registerIndex: Invalid index type '%s'."
             raise InvalidParameterError(msg % type)
+        if type.lower() in ('geo', 'interval') and not options:
+            msg = "registerIndex: Index type '%s' requires a second XPath " + \
+                  "expression as options!"
+            raise InvalidParameterError(msg % type)
         # check for grouping indexes
         xpath = xpath.strip()
         group_path = None
@@ -312,6 +351,14 @@ class XmlCatalog(object):
         There is an additional key 'ordered' containing an ORDERED list of
         document ids, which is of interest in case there is an order by clause,
         as the dict itself does not preserve order.
+
+        If the number of results reaches the limit of a query, the key
+        'cursor' contains a continuation token. Appending "after '<token>'"
+        to the query returns the next results, which is much faster than
+        using an offset on large result sets.
+
+        Queries with aggregate functions return the list of groups as done
+        by L{aggregate}.
         
         For further detail on the restricted XPath query syntax, see 
         L{seishub.xmldb.xpath}
@@ -323,11 +370,163 @@ class XmlCatalog(object):
         """
         query = applyMacros(query)
         q = XPathQuery(query)
-        results = self.index_catalog.query(q)
+        if q.getAggregates():
+            return self.index_catalog.aggregate(q)
+        results = self._getCachedResults(q)
+        if results is None:
+            results = self.index_catalog.query(q)
+            self._cacheResults(q, results)
         if not full:
             return results
-        return [self.xmldb.getResource(document_id=id)
-                for id in results['ordered']]
+        return self.xmldb.getResources(results['ordered'])
+
+    def getQueryCacheStatistics(self):
+        """
+        Returns number of hits, misses and cached results of the query cache.
+        """
+        return {'hits': self._cache_hits, 'misses': self._cache_misses,
+                'entries': len(self._results), 'size': self._results.maxsize}
+
+    def _getCacheKey(self, q):
+        # results depend on the indexes - any index change creates new keys
+        return (q.query, self.index_catalog.getIndexGeneration())
+
+    def _getCachedResults(self, q):
+        """
+        Returns a copy of cached results of a query or None if the results
+        are not cached or any queried resource type has been modified since.
+        """
+        entry = self._results.get(self._getCacheKey(q))
+        if entry is not None:
+            results, tags = entry
+            if all([self._generations.get(key, 0) == generation
+                    for key, generation in tags]):
+                self._cache_hits += 1
+                return self._copyResults(results)
+        self._cache_misses += 1
+        return None
+
+    def _cacheResults(self, q, results):
+        """
+        Caches query results, tagged with the current generation of each
+        resource type used in the query.
+        """
+        max_results = self.env.config.getint('xmldb',
+                                              'query_cache_max_results')
+        if len(results['ordered']) > max_results:
+            return
+        tags = [(key, self._generations.get(key, 0))
+                for key in self._getQueriedResourceTypes(q)]
+        self._results.set(self._getCacheKey(q),
+                          (self._copyResults(results), tags))
+
+    def _copyResults(self, results):
+        """
+        Returns a copy of query results sharing no record or list of values
+        with the given results.
+        """
+        copy = OrderedDict()
+        for key, value in results.iteritems():
+            if isinstance(value, dict):
+                value = dict([(k, isinstance(v, list) and list(v) or v)
+                              for k, v in value.iteritems()])
+            elif isinstance(value, list):
+                value = list(value)
+            copy[key] = value
+        return copy
+
+    def _getQueriedResourceTypes(self, q):
+        """
+        Returns generation keys of all resource types used in the location
+        path and any path of a query.
+
+        Each resource type depends on a (package_id, resourcetype_id) and a
+        (package_id,) key. Queries using wildcards depend on the None key.
+        """
+        keys = set([tuple(q.getLocationPath()[0:2])])
+        def walk(p):
+            if len(p) == 3 and \
+               all([isinstance(item, basestring) for item in p]):
+                keys.add((p[0], p[1]))
+                return
+            for item in p:
+                if isinstance(item, list):
+                    walk(item)
+        walk(q.getPredicates() or [])
+        walk(q.getOrderBy() or [])
+        if [key for key in keys if None in key or '*' in key]:
+            return [None]
+        return list(keys) + list(set([(key[0],) for key in keys]))
+
+    def _invalidateResults(self, package_id, resourcetype_id=None):
+        """
+        Invalidates cached query results of a resource type or, if no
+        resource type is given, of all resource types of a package.
+        """
+        # queries using wildcards depend on any resource type
+        keys = [None]
+        if resourcetype_id is None:
+            keys.append((package_id,))
+        else:
+            keys.append((package_id, resourcetype_id))
+        for key in keys:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def iterQuery(self, query):
+        """
+        Query the catalog via restricted XPath queries, yielding a
+        (document_id, {xpath:value}) tuple for each resulting document.
+
+        Use this method to process large result sets without keeping all
+        results in memory. See L{query} for details.
+        """
+        query = applyMacros(query)
+        q = XPathQuery(query)
+        return self.index_catalog.iterQuery(q)
+
+    def aggregate(self, query):
+        """
+        Query the catalog via restricted XPath queries with aggregate
+        functions, e.g. '/seismology/event[magnitude > 3] select count(),
+        max(datetime) group by bucket(magnitude, 0.5)'.
+
+        Supported aggregate functions are count(), min(path), max(path) and
+        avg(path). Results may be grouped by indexed values, or by buckets of
+        numeric (bucket(path, width)) or date and time (bucket(path, 'day'))
+        values. All aggregates are computed by the database.
+
+        @param query: Restricted XPath query with a select clause.
+        @type query: basestring
+        @return: list of dicts with group keys and aggregates of each group
+        """
+        query = applyMacros(query)
+        q = XPathQuery(query)
+        return self.index_catalog.aggregate(q)
+
+    def explain(self, query):
+        """
+        Explains how a restricted XPath query is evaluated, in order to find
+        missing or badly chosen indexes of slow queries.
+
+        Returns a dict with the parsed predicates, the used indexes and their
+        statistics, the SQL statement, the execution plan of the database,
+        the number of results and the time spent on each step in seconds.
+        The query is executed once, bypassing all caches.
+
+        @param query: Restricted XPath query to be explained.
+        @type query: basestring
+        @return: dict
+        """
+        query = applyMacros(query)
+        q = XPathQuery(query)
+        # parse again bypassing the query cache to time the parser itself
+        t = time.time()
+        q.parse(query, cache=False)
+        parse = time.time() - t
+        result = self.index_catalog.explain(q)
+        result['query'] = query
+        result['timing']['parse'] = parse
+        return result
 
     def updateAllIndexViews(self):
         """
@@ -352,23 +551,36 @@ class XmlCatalog(object):
                                                             resourcetype_id)
         return self.xmldb.getAllResourceNames(resourcetype, limit, ordered)
 
-    def reindexIndex(self, xmlindex=None, _id=None):
+    def reindexIndex(self, xmlindex=None, _id=None, **kwargs):
         """
         Reindex all resources by a given XMLIndex object.
+
+        Additional keyword arguments, e.g. processes or progress, are passed
+        to L{XmlIndexCatalog.reindexIndexes}.
         """
         if _id:
             xmlindex = self.getIndexes(_id=_id)[0]
-        return self.index_catalog.reindexIndexes([xmlindex])
+        try:
+            return self.index_catalog.reindexIndexes([xmlindex], **kwargs)
+        finally:
+            self._invalidateResults(xmlindex.package_id,
+                                    xmlindex.resourcetype_id)
 
-    def reindexResourceType(self, package_id, resourcetype_id):
+    def reindexResourceType(self, package_id, resourcetype_id, **kwargs):
         """
         Reindex a whole resource type by given package_id and resourcetype_id.
+
+        Additional keyword arguments, e.g. processes or progress, are passed
+        to L{XmlIndexCatalog.reindexIndexes}.
         """
         xmlindex_list = self.getIndexes(package_id=package_id,
                                         resourcetype_id=resourcetype_id)
         if not xmlindex_list:
             return
-        return self.index_catalog.reindexIndexes(xmlindex_list)
+        try:
+            return self.index_catalog.reindexIndexes(xmlindex_list, **kwargs)
+        finally:
+            self._invalidateResults(package_id, resourcetype_id)
 
     def reindexResource(self, resource):
         """
@@ -376,3 +588,5 @@ class XmlCatalog(object):
         """
         self.index_catalog.flushResource(resource)
         self.index_catalog.indexResource(resource)
+        self._invalidateResults(resource.package.package_id,
+                                resource.resourcetype.resourcetype_id)
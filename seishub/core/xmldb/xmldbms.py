@@ -6,6 +6,11 @@ from seishub.core.exceptions import DuplicateObjectError, NotFoundError, \
 from seishub.core.xmldb.defaults import resource_tab
 from seishub.core.xmldb.resource import XmlDocument, Resource
 from sqlalchemy import sql
+import copy
+
+
+# maximal number of ids within a single IN clause
+BULK_SIZE = 500
 
 
 class XmlDbManager(DbStorage):
@@ -130,6 +135,34 @@ class XmlDbManager(DbStorage):
                                 revision, id)
         return res
 
+    def getResources(self, document_ids):
+        """
+        Get resources by a list of document ids.
+
+        Resources, documents and document metadata are read in chunks of
+        BULK_SIZE documents with a single query each, instead of one query
+        per resource.
+
+        @param document_ids: list of document ids
+        @return: list of Resource objects in order of the given document ids,
+            each with the requested document revision only
+        """
+        resources = {}
+        for i in xrange(0, len(document_ids), BULK_SIZE):
+            chunk = list(document_ids[i:i + BULK_SIZE])
+            for res in self.pickup(Resource, document={'_id': chunk}):
+                documents = res._document
+                for document in documents:
+                    if len(documents) > 1:
+                        # multiple revisions of the same resource
+                        res = copy.copy(res)
+                        res.document = document
+                    resources[document._id] = res
+        missing = [id for id in document_ids if id not in resources]
+        if missing:
+            raise NotFoundError("Resource not found. ('%s')" % missing[0])
+        return [resources[id] for id in document_ids]
+
     def getRevisions(self, package_id=None, resourcetype_id=None,
                      name=None, id=None):
         """
@@ -1,34 +1,125 @@
 # -*- coding: utf-8 -*-
 
+from seishub.core.config import BoolOption, IntOption, ListOption
 from seishub.core.db.orm import DbStorage, DbError
+from seishub.core.db.util import compileStatement, encodeCursor, Explain
+from seishub.core.util.cache import LRUCache
+from seishub.core.util.text import isInteger
 from seishub.core.exceptions import InvalidParameterError, SeisHubError, \
     NotFoundError, InvalidObjectError, DuplicateObjectError
 from seishub.core.registry.defaults import resourcetypes_tab, packages_tab
 from seishub.core.xmldb.defaults import document_tab, resource_tab, \
-    document_meta_tab
-from seishub.core.xmldb.index import XmlIndex, type_classes
+    document_meta_tab, index_numeric_tab, index_float_tab, \
+    index_datetime_tab, index_date_tab, index_integer_tab, \
+    index_interval_tab, index_shadow_tab, KEYVAL_INDEX_SUFFIX
+from seishub.core.xmldb.index import XmlIndex, XmlIndexPlan, \
+    PROCESSOR_INDEX, type_classes, GeoIndexElement, GEO_CELL_COLUMNS, \
+    getGeoCell, getUnitVector, IntervalIndexElement, parseDateTime, \
+    NUMERIC_INDEX, FLOAT_INDEX, INTEGER_INDEX, DATETIME_INDEX, DATE_INDEX, \
+    TIMESTAMP_INDEX, INTERVAL_INDEX
 from seishub.core.xmldb.interfaces import IXPathQuery, IResource, IXmlIndex
-from seishub.core.xmldb.resource import Resource, XmlDocument
+from seishub.core.xmldb.resource import XmlDocument
 from seishub.core.xmldb.xpath import XPathQuery
-from sqlalchemy import select, sql
+from sqlalchemy import select, sql, MetaData, Table, Column, DateTime, \
+    Float, Integer, Unicode
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.types import NullType
 from zope.interface.exceptions import DoesNotImplement
+from collections import deque, OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+import copy
+import math
+import multiprocessing
+import sqlite3
+import threading
+import time
+
+
+# index tables with ordered values, collecting min/max and histograms
+ORDERED_INDEX_TABLES = (index_numeric_tab, index_float_tab,
+                        index_datetime_tab, index_date_tab, index_integer_tab,
+                        index_interval_tab)
+HISTOGRAM_BUCKETS = 10
+# dialects sorting NULL before all other values in ascending order
+NULLS_LOW_DIALECTS = ('sqlite', 'mysql', 'mssql')
+# statistics assumed for indexes not analyzed yet
+DEFAULT_STATISTICS = {'rows': 0, 'documents': 0, 'distinct': 0, 'min': None,
+                      'max': None, 'bounds': None, 'time': None}
+# number of arguments of all query functions
+FUNCTION_ARGS = {'not': 1, 'contains': 2, 'within_bbox': 5, 'within_radius': 4,
+                 'overlaps': 3}
+# mean earth radius in km
+EARTH_RADIUS = 6371.0
+# maximal number of grid cell ranges of a geo query
+GEO_MAX_CELL_RANGES = 32
+# functions evaluating indexed data while building the SQL statement
+UNCACHEABLE_FUNCTIONS = ('overlaps',)
+# index types which may be averaged or grouped into buckets of a given width
+NUMERIC_INDEX_TYPES = (NUMERIC_INDEX, FLOAT_INDEX, INTEGER_INDEX)
+# index types which may be grouped into buckets of a time unit
+DATETIME_INDEX_TYPES = (DATETIME_INDEX, DATE_INDEX, TIMESTAMP_INDEX,
+                        INTERVAL_INDEX)
+# SQLite formats truncating date and time values to a unit
+DATETIME_BUCKETS = {'year': '%Y-01-01 00:00:00',
+                    'month': '%Y-%m-01 00:00:00',
+                    'day': '%Y-%m-%d 00:00:00',
+                    'hour': '%Y-%m-%d %H:00:00',
+                    'minute': '%Y-%m-%d %H:%M:00',
+                    'second': '%Y-%m-%d %H:%M:%S'}
+
+
+class _BindValue(object):
+    """
+    Value of a relational predicate lifted out of a query as bind parameter.
+
+    The index of the compared path is set while building the SQL statement,
+    so the value can be converted into the key type on each execution.
+    """
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self.xmlindex = None
+
+    def getParam(self, xmlindex, key):
+        """
+        Returns a typed bind parameter for the prepared key of this value.
+        """
+        self.xmlindex = xmlindex
+        column = xmlindex._getElementCls().db_table.c['keyval']
+        return sql.bindparam(self.name, key, type_=column.type)
 
 
 class _IndexView(object):
     """
     Mixin for XMLIndexCatalog providing "horizontal" SQL views on the indexed
     data per resource type.
+
+    If the option xmldb.materialized_index_views is enabled, the view is
+    stored as a table with the same name and columns instead. This table is
+    updated incrementally whenever a resource is indexed, modified, renamed or
+    deleted and has a database index on each column.
     """
 
-    def updateIndexView(self, resourcetype):
+    def _isMaterialized(self):
+        return self._db_manager.env.config.getbool('xmldb',
+                                                   'materialized_index_views')
+
+    def updateIndexView(self, resourcetype, rebuild=False):
         """
         Updates an index view of a resource type.
+
+        A materialized index view is only rebuilt if its columns changed or
+        if rebuild is set.
         """
         if isinstance(resourcetype, XmlIndex):
             resourcetype = resourcetype.resourcetype
         package_id = resourcetype.package.package_id
         resourcetype_id = resourcetype.resourcetype_id
         name = '/%s/%s' % (package_id, resourcetype_id)
+        self._view_columns.pop(name, None)
         # fetches all indexes of this resource type
         xmlindex_list = self.getIndexes(package_id=package_id,
                                         resourcetype_id=resourcetype_id)
@@ -37,9 +128,140 @@ class _IndexView(object):
         # create index view
         query, joins = self._createIndexView(xmlindex_list[::-1])
         query = query.select_from(joins)
+        if self._isMaterialized():
+            self._createIndexTable(name, query, rebuild)
+            return
+        self._dropIndexTable(name)
         self._db_manager.createView(name, query)
         self._db_manager.env.log.debug("Updating IndexView %s ..." % name)
 
+    def _getIndexTableColumns(self, name):
+        """
+        Returns the column names of a materialized index view or None.
+
+        Column names are cached until the index view is updated or dropped.
+        """
+        if name in self._view_columns:
+            return self._view_columns[name]
+        if name in self._db_manager.getViews() or \
+           not self._db.has_table(name):
+            columns = None
+        else:
+            table = Table(name, MetaData(), autoload=True,
+                          autoload_with=self._db)
+            columns = table.c.keys()
+        self._view_columns[name] = columns
+        return columns
+
+    def _createIndexTable(self, name, query, rebuild=False):
+        """
+        Creates a materialized index view from a index view query.
+
+        Columns keep the types of the indexed values, literal columns are
+        stored as text.
+        """
+        columns = [c.name for c in query.inner_columns]
+        if not rebuild and self._getIndexTableColumns(name) == columns:
+            return
+        try:
+            self._db_manager.dropView(name)
+        except NotFoundError:
+            pass
+        self._dropIndexTable(name)
+        table = Table(name, MetaData(),
+                      *[Column(c.name, isinstance(c.type, NullType) and \
+                               Unicode(255) or c.type)
+                        for c in query.inner_columns])
+        quote = self._db.dialect.identifier_preparer.quote_identifier
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            table.create(conn)
+            conn.execute("INSERT INTO %s %s" % (quote(name),
+                                                compileStatement(query)))
+            for column in columns:
+                conn.execute("CREATE INDEX %s ON %s (%s)" % (
+                    quote(name + '/' + column), quote(name), quote(column)))
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
+            self._view_columns.pop(name, None)
+        msg = "Creating materialized IndexView %s ..."
+        self._db_manager.env.log.debug(msg % name)
+
+    def _dropIndexTable(self, name):
+        """
+        Drops a materialized index view if it exists.
+        """
+        if self._getIndexTableColumns(name) is None:
+            return
+        quote = self._db.dialect.identifier_preparer.quote_identifier
+        self._db.execute("DROP TABLE %s" % quote(name))
+        self._view_columns.pop(name, None)
+
+    def clearIndexViewRows(self, package_id, resourcetype_id=None):
+        """
+        Deletes all rows of the materialized index views of a resource type
+        or, if no resource type is given, of all resource types of a package.
+        """
+        if not self._isMaterialized():
+            return
+        if resourcetype_id is None:
+            resourcetype_ids = [rt.resourcetype_id for rt in self.env.\
+                                registry.db_getResourceTypes(package_id)]
+        else:
+            resourcetype_ids = [resourcetype_id]
+        quote = self._db.dialect.identifier_preparer.quote_identifier
+        for resourcetype_id in resourcetype_ids:
+            name = '/%s/%s' % (package_id, resourcetype_id)
+            if self._getIndexTableColumns(name) is not None:
+                self._db.execute("DELETE FROM %s" % quote(name))
+
+    def refreshIndexViewRows(self, resource):
+        """
+        Refreshes all rows of the given resource in a materialized index view.
+        """
+        if not self._isMaterialized():
+            return
+        package_id = resource.package.package_id
+        resourcetype_id = resource.resourcetype.resourcetype_id
+        name = '/%s/%s' % (package_id, resourcetype_id)
+        xmlindex_list = self.getIndexes(package_id=package_id,
+                                        resourcetype_id=resourcetype_id)
+        if not xmlindex_list or self._getIndexTableColumns(name) is None:
+            return
+        query, joins = self._createIndexView(xmlindex_list[::-1])
+        query = query.select_from(joins)
+        query = query.where(document_tab.c['resource_id'] == \
+            sql.literal_column("%s" % int(resource._id)))
+        quote = self._db.dialect.identifier_preparer.quote_identifier
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            self._deleteIndexViewRows(conn, name, resource)
+            conn.execute("INSERT INTO %s %s" % (quote(name),
+                                                compileStatement(query)))
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _deleteIndexViewRows(self, conn, name, resource):
+        """
+        Deletes all rows of a resource from a materialized index view.
+        """
+        quote = self._db.dialect.identifier_preparer.quote_identifier
+        query = sql.select([document_tab.c['id']],
+            document_tab.c['resource_id'] == \
+                sql.literal_column("%s" % int(resource._id)))
+        conn.execute("DELETE FROM %s WHERE document_id IN (%s)" % (
+            quote(name), compileStatement(query)))
+
     def _createIndexView(self, xmlindex_list, compact=False):
         """
         Creates an index view using all given XMLIndex objects.
@@ -106,9 +328,287 @@ class _IndexView(object):
         package_id = xmlindex.resourcetype.package.package_id
         resourcetype_id = xmlindex.resourcetype.resourcetype_id
         name = '/%s/%s' % (package_id, resourcetype_id)
+        if self._getIndexTableColumns(name) is not None:
+            self._dropIndexTable(name)
+            return
         self._db_manager.dropView(name)
 
 
+class _IndexStatistics(object):
+    """
+    Mixin for XMLIndexCatalog collecting statistics about indexed values.
+
+    Statistics are used by the query processor to order predicates by their
+    estimated selectivity. They are collected after each reindex. Missing
+    statistics and statistics older than xmldb.statistics_refresh_interval
+    are collected in a background thread on first use, queries never wait
+    for statistics to be collected.
+    """
+
+    def updateIndexStatistics(self, xmlindex_list=None):
+        """
+        Collects statistics for all or the given XMLIndex objects.
+        """
+        if xmlindex_list is None:
+            xmlindex_list = self.getIndexes()
+        for xmlindex in xmlindex_list:
+            self._statistics[xmlindex._id] = \
+                self._collectIndexStatistics(xmlindex)
+
+    def getIndexStatistics(self, xmlindex):
+        """
+        Returns a dictionary of statistics for the given XMLIndex.
+
+        Keys are rows (number of non empty values), documents (number of
+        indexed documents), distinct (number of distinct values), min, max
+        and bounds (equi-depth histogram bounds). The last three are only
+        set for numeric, date and datetime indexes. If no statistics have
+        been collected yet, they are collected in the background and uniform
+        defaults with a time of None are returned.
+        """
+        stats = self._statistics.get(xmlindex._id)
+        if stats is None:
+            self._refreshIndexStatistics(xmlindex)
+            return dict(DEFAULT_STATISTICS)
+        interval = self._db_manager.env.config.getint('xmldb',
+            'statistics_refresh_interval')
+        if interval and time.time() - stats['time'] > interval:
+            self._refreshIndexStatistics(xmlindex)
+        return stats
+
+    def _refreshIndexStatistics(self, xmlindex):
+        """
+        Collects statistics for the given XMLIndex in a background thread.
+
+        In-memory databases are not shared between threads, so their
+        statistics are collected after reindexing only.
+        """
+        if xmlindex._id in self._refreshing or \
+           self._db.url.database in (None, '', ':memory:'):
+            return
+        self._refreshing.add(xmlindex._id)
+        def refresh():
+            try:
+                stats = self._collectIndexStatistics(xmlindex)
+                # index may have been deleted meanwhile
+                if xmlindex._id in self._cache:
+                    self._statistics[xmlindex._id] = stats
+            except Exception, e:
+                msg = "Error collecting statistics of index %s: %s"
+                self._db_manager.env.log.error(msg % (str(xmlindex), e))
+            finally:
+                self._refreshing.discard(xmlindex._id)
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def _collectIndexStatistics(self, xmlindex):
+        table = xmlindex._getElementCls().db_table
+        keyval = table.c['keyval']
+        where = table.c['index_id'] == xmlindex._id
+        query = sql.select([sql.func.count(keyval),
+                            sql.func.count(table.c['document_id'].distinct()),
+                            sql.func.count(keyval.distinct())], where)
+        rows, documents, distinct = self._db.execute(query).fetchone()
+        stats = {'rows': rows, 'documents': documents, 'distinct': distinct,
+                 'min': None, 'max': None, 'bounds': None,
+                 'time': time.time()}
+        if table not in ORDERED_INDEX_TABLES or not rows:
+            return stats
+        query = sql.select([sql.func.min(keyval), sql.func.max(keyval)],
+                           where)
+        stats['min'], stats['max'] = self._db.execute(query).fetchone()
+        # equi-depth histogram
+        bounds = []
+        query = sql.select([keyval], sql.and_(where, keyval != None))
+        query = query.order_by(keyval).limit(1)
+        for i in range(1, HISTOGRAM_BUCKETS):
+            offset = i * rows // HISTOGRAM_BUCKETS
+            bounds.append(self._db.execute(query.offset(offset)).scalar())
+        stats['bounds'] = bounds
+        return stats
+
+    def _estimateRows(self, xmlindex, op=None, value=None):
+        """
+        Estimates the number of index rows matching a predicate.
+        """
+        stats = self.getIndexStatistics(xmlindex)
+        rows = float(stats['rows'])
+        if not rows or op is None:
+            return rows
+        distinct = max(stats['distinct'], 1)
+        if op in ('=', '=='):
+            return rows / distinct
+        if op == '!=':
+            return rows - rows / distinct
+        bounds = stats['bounds']
+        if not bounds or value is None:
+            # no histogram - assume a third of all values
+            return rows / 3
+        try:
+            below = len([b for b in bounds if b is not None and b < value])
+        except TypeError:
+            return rows / 3
+        fraction = (below + 0.5) / (len(bounds) + 1)
+        if op in ('>', '>='):
+            fraction = 1 - fraction
+        return rows * fraction
+
+    def _isMultiValued(self, xmlindex):
+        """
+        Returns True if documents have multiple values for given XMLIndex.
+
+        Indexes without statistics are assumed to be single-valued.
+        """
+        stats = self.getIndexStatistics(xmlindex)
+        return stats['rows'] > stats['documents']
+
+
+class _KeyvalIndexes(object):
+    """
+    Mixin for XMLIndexCatalog managing the covering (index_id, keyval,
+    document_id) database indexes used by range predicates.
+
+    One such index is declared per index table in xmldb.defaults. Missing
+    indexes of existing installations are created by migrateKeyvalIndexes
+    at start up, unless listed in xmldb.disabled_keyval_indexes. If the
+    option xmldb.partial_keyval_indexes is enabled, an additional partial
+    (keyval, document_id) index is kept for each XMLIndex on databases
+    supporting partial indexes (PostgreSQL, SQLite >= 3.8).
+    """
+
+    def getKeyvalIndexes(self):
+        """
+        Returns a list of dictionaries describing all keyval indexes.
+
+        Keys are name, table, columns, index_id (only set for partial
+        indexes), exists and disabled.
+        """
+        disabled = self._db_manager.env.config.getlist('xmldb',
+            'disabled_keyval_indexes')
+        inspector = Inspector.from_engine(self._db)
+        existing = {}
+        results = []
+        for table in self._getIndexTables():
+            existing[table.name] = [idx['name'] for idx
+                                    in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if not index.name.endswith(KEYVAL_INDEX_SUFFIX):
+                    continue
+                results.append({'name': index.name,
+                                'table': table.name,
+                                'columns': [c.name for c in index.columns],
+                                'index_id': None})
+        if self._supportsPartialIndexes():
+            partial = self._db_manager.env.config.getbool('xmldb',
+                'partial_keyval_indexes')
+            for xmlindex in self.getIndexes():
+                try:
+                    table = xmlindex._getElementCls().db_table
+                except (KeyError, AttributeError):
+                    # processor index not loaded yet
+                    continue
+                name = self._getPartialIndexName(table, xmlindex._id)
+                if not partial and name not in existing[table.name]:
+                    continue
+                results.append({'name': name,
+                                'table': table.name,
+                                'columns': ['keyval', 'document_id'],
+                                'index_id': xmlindex._id})
+        for result in results:
+            result['exists'] = result['name'] in existing[result['table']]
+            result['disabled'] = result['name'] in disabled
+        return results
+
+    def createKeyvalIndex(self, name):
+        """
+        Creates the keyval index with the given name.
+        """
+        index = self._getKeyvalIndex(name)
+        if index['exists']:
+            return
+        preparer = self._db.dialect.identifier_preparer
+        ddl = "CREATE INDEX %s ON %s (%s)" % (
+            preparer.quote_identifier(name),
+            preparer.quote_identifier(index['table']),
+            ', '.join(index['columns']))
+        if index['index_id'] is not None:
+            ddl += " WHERE index_id = %d" % index['index_id']
+        self._db.execute(ddl)
+        self._db_manager.env.log.info("Created keyval index %s." % name)
+
+    def dropKeyvalIndex(self, name):
+        """
+        Drops the keyval index with the given name.
+        """
+        index = self._getKeyvalIndex(name)
+        if not index['exists']:
+            return
+        preparer = self._db.dialect.identifier_preparer
+        self._db.execute("DROP INDEX %s" % preparer.quote_identifier(name))
+        self._db_manager.env.log.info("Dropped keyval index %s." % name)
+
+    def migrateKeyvalIndexes(self):
+        """
+        Creates all missing and not disabled keyval indexes.
+
+        Returns a list of the names of all created indexes.
+        """
+        created = []
+        for index in self.getKeyvalIndexes():
+            if index['exists'] or index['disabled']:
+                continue
+            try:
+                self.createKeyvalIndex(index['name'])
+            except Exception, e:
+                msg = "Error creating keyval index %s"
+                self._db_manager.env.log.error(msg % index['name'], e)
+                continue
+            created.append(index['name'])
+        return created
+
+    def _getKeyvalIndex(self, name):
+        for index in self.getKeyvalIndexes():
+            if index['name'] == name:
+                return index
+        msg = "Keyval index %s does not exist."
+        raise NotFoundError(msg % name)
+
+    def _getIndexTables(self):
+        tables = set([cls.db_table for cls in type_classes.values()])
+        return sorted(tables, key=lambda t: t.name)
+
+    def _getPartialIndexName(self, table, index_id):
+        return 'idx_' + table.name + KEYVAL_INDEX_SUFFIX + '_' + str(index_id)
+
+    def _supportsPartialIndexes(self):
+        if self._db.name.startswith('postgres'):
+            return True
+        if self._db.name == 'sqlite':
+            return sqlite3.sqlite_version_info >= (3, 8, 0)
+        return False
+
+    def _updatePartialKeyvalIndex(self, xmlindex, drop=False):
+        """
+        Creates or drops the partial keyval index of a given XMLIndex.
+        """
+        if not self._supportsPartialIndexes():
+            return
+        try:
+            table = xmlindex._getElementCls().db_table
+        except (KeyError, AttributeError):
+            return
+        name = self._getPartialIndexName(table, xmlindex._id)
+        try:
+            if drop:
+                self.dropKeyvalIndex(name)
+            elif self._db_manager.env.config.getbool('xmldb',
+                    'partial_keyval_indexes'):
+                self.createKeyvalIndex(name)
+        except NotFoundError:
+            pass
+
+
 class _QueryProcessor(object):
     """
     Mixin for XMLIndexCatalog providing query processing.
@@ -129,20 +629,9 @@ class _QueryProcessor(object):
         # still there: multiple nodes or no label found
         expr = '/' + expr
         if '*' in expr:
-            expr_list = expr.split('/')
-            len_expr_list = len(expr_list)
-            xmlindex_list = self.getIndexes(package_id=package_id,
-                                            resourcetype_id=resourcetype_id)
-            for xmlindex in xmlindex_list:
-                xpath_list = xmlindex.xpath.split('/')
-                if len(xpath_list) != len_expr_list:
-                    continue
-                # join both lists
-                zipped = zip(xpath_list, expr_list)
-                # check if something does not fit
-                if False in [z[0] == z[1] for z in zipped if '*' not in z]:
-                    continue
-                # return first fitting xmlindex
+            xmlindex = self._findIndexByWildcard(package_id, resourcetype_id,
+                                                 expr)
+            if xmlindex:
                 return xmlindex
         # try via xpath
         idx = self.getIndexes(package_id=package_id,
@@ -156,6 +645,41 @@ class _QueryProcessor(object):
         msg = "Error processing query. No index found for: /%s/%s%s"
         raise NotFoundError(msg % (package_id, resourcetype_id, expr))
 
+    def _findIndexByWildcard(self, package_id, resourcetype_id, expr):
+        """
+        Returns the first index matching a XPath expression containing
+        wildcard steps, using the path trie of the resource type.
+        """
+        key = (package_id, resourcetype_id)
+        trie = self._tries.get(key)
+        if trie is None:
+            trie = self._tries[key] = {}
+            for xmlindex in self._cache_by_rt.get(key, {}).itervalues():
+                node = trie
+                for step in xmlindex.xpath.split('/'):
+                    node = node.setdefault(step, {})
+                node.setdefault(None, []).append(xmlindex)
+        nodes = [trie]
+        for step in expr.split('/'):
+            children = []
+            for node in nodes:
+                if step == '*':
+                    children.extend([v for k, v in node.iteritems()
+                                     if k is not None])
+                    continue
+                if step in node:
+                    children.append(node[step])
+                if '*' in node:
+                    children.append(node['*'])
+            nodes = children
+            if not nodes:
+                return None
+        matches = [xmlindex for node in nodes
+                   for xmlindex in node.get(None, [])]
+        if not matches:
+            return None
+        return min(matches, key=lambda xmlindex: xmlindex._id)
+
     def _applyOp(self, op, left, right, complement=False):
         # create sqlalchemy clauses from string operators
         if op == '==' or op == '=':
@@ -180,11 +704,61 @@ class _QueryProcessor(object):
             return sql.or_(left, right)
         raise InvalidParameterError("Operator '%s' not specified." % op)
 
-    def _applyFunc(self, func, expr, q, joins):
+    def _applyFunc(self, func, args, q, joins, complement=False):
+        if func not in FUNCTION_ARGS:
+            raise InvalidParameterError("Function '%s' not specified." % func)
+        if len(args) != FUNCTION_ARGS[func]:
+            msg = "Function '%s' requires %d arguments."
+            raise InvalidParameterError(msg % (func, FUNCTION_ARGS[func]))
         if func == 'not':
             # select the complementary result set
-            return self._process_predicates(expr, q, joins, complement=True)
-        raise InvalidParameterError("Function '%s' not specified." % func)
+            return self._process_predicates(args[0], q, joins,
+                                            complement=True)
+        path = args[0]
+        idx = self.findIndex(path[0], path[1], path[2])
+        if func == 'contains':
+            w = self._containsOnIndex(idx, args[1], complement)
+            return q, joins, w
+        elif func == 'overlaps':
+            w = self._overlapsOnIndex(idx, complement, args[1], args[2])
+            return q, joins, w
+        try:
+            values = [float(v) for v in args[1:]]
+        except ValueError:
+            msg = "Function '%s' requires numeric arguments."
+            raise InvalidParameterError(msg % func)
+        if func == 'within_bbox':
+            w = self._withinBBoxOnIndex(idx, complement, *values)
+        else:
+            w = self._withinRadiusOnIndex(idx, complement, *values)
+        return q, joins, w
+
+    def _containsOnIndex(self, idx, value, complement=False):
+        """
+        Returns a clause selecting all documents containing all terms of the
+        given value, using the posting list of a fulltext index.
+        """
+        element_cls = idx._getElementCls()
+        if element_cls._tokenize is None:
+            msg = "Function 'contains' requires a fulltext index: %s"
+            raise InvalidParameterError(msg % str(idx))
+        terms = element_cls._tokenize(value)
+        if not terms:
+            msg = "Function 'contains' requires at least one search term."
+            raise InvalidParameterError(msg)
+        idx_tab = element_cls.db_table
+        postings = sql.select([idx_tab.c['document_id']],
+                              sql.and_(idx_tab.c['index_id'] == idx._id,
+                                       idx_tab.c['keyval'].in_(terms)))
+        if len(terms) > 1:
+            # documents must contain every term
+            count = sql.func.count(idx_tab.c['keyval'].distinct())
+            postings = postings.group_by(idx_tab.c['document_id']).\
+                having(count == len(terms))
+        w = document_tab.c['id'].in_(postings)
+        if complement:
+            return sql.not_(w)
+        return w
 
     def _join_on_index(self, idx, joins=None, method="outerjoin",
                        complement=False):
@@ -247,9 +821,139 @@ class _QueryProcessor(object):
             joins = join(idx_tab, onclause=oncl)
         return q, joins
 
+    def _withinBBoxOnIndex(self, idx, complement, min_lat, max_lat, min_lon,
+                           max_lon):
+        """
+        Returns a clause selecting all documents with a coordinate within
+        the given box, using the grid cells of a geo index.
+
+        A box with min_lon > max_lon crosses the date line.
+        """
+        idx_tab = self._getGeoTable(idx)
+        w = sql.and_(idx_tab.c['lat'] >= min_lat, idx_tab.c['lat'] <= max_lat,
+                     self._getLonClause(idx_tab, min_lon, max_lon))
+        return self._withinOnIndex(idx, idx_tab, w, complement, min_lat,
+                                   max_lat, min_lon, max_lon)
+
+    def _withinRadiusOnIndex(self, idx, complement, lat, lon, radius):
+        """
+        Returns a clause selecting all documents with a coordinate within
+        radius kilometers of the given point, using a geo index.
+
+        Distances are tested exactly on the sphere by comparing the scalar
+        product of the unit vectors with the cosine of the angular distance.
+        """
+        idx_tab = self._getGeoTable(idx)
+        angle = min(radius / EARTH_RADIUS, math.pi)
+        x, y, z = getUnitVector(lat, lon)
+        w = idx_tab.c['x'] * x + idx_tab.c['y'] * y + idx_tab.c['z'] * z >= \
+            math.cos(angle) - 1e-12
+        # bounding box of the circle
+        delta = math.degrees(angle)
+        min_lat, max_lat = lat - delta, lat + delta
+        if min_lat <= -90 or max_lat >= 90 or \
+           math.sin(angle) >= math.cos(math.radians(lat)):
+            # circle contains a pole
+            min_lon, max_lon = -180, 180
+        else:
+            delta = math.degrees(math.asin(math.sin(angle) /
+                                           math.cos(math.radians(lat))))
+            min_lon, max_lon = lon - delta, lon + delta
+            if min_lon < -180:
+                min_lon += 360
+            if max_lon > 180:
+                max_lon -= 360
+        return self._withinOnIndex(idx, idx_tab, w, complement,
+                                   max(min_lat, -90), min(max_lat, 90),
+                                   min_lon, max_lon)
+
+    def _overlapsOnIndex(self, idx, complement, start, end):
+        """
+        Returns a clause selecting all documents with an interval overlapping
+        the given time span, using an interval index.
+
+        Closed intervals are only searched within start times between start
+        minus the longest stored duration and end.
+        """
+        element_cls = idx._getElementCls()
+        if element_cls is not IntervalIndexElement:
+            msg = "Function 'overlaps' requires an interval index: %s"
+            raise InvalidParameterError(msg % str(idx))
+        try:
+            start, end = parseDateTime(start), parseDateTime(end)
+        except Exception:
+            msg = "Function 'overlaps' requires two date/time arguments."
+            raise InvalidParameterError(msg)
+        idx_tab = element_cls.db_table
+        keyval = idx_tab.c['keyval']
+        endval = idx_tab.c['endval']
+        query = sql.select([sql.func.max(idx_tab.c['duration'])],
+                           idx_tab.c['index_id'] == idx._id)
+        max_duration = self._db.execute(query).scalar()
+        closed = sql.and_(keyval <= end, endval >= start)
+        if max_duration is not None:
+            # one second margin for rounded durations
+            first = start - timedelta(seconds=max_duration + 1)
+            closed = sql.and_(keyval >= first, closed)
+        opened = sql.and_(endval == None, keyval <= end)
+        query = sql.select([idx_tab.c['document_id']],
+                           sql.and_(idx_tab.c['index_id'] == idx._id,
+                                    sql.or_(closed, opened)))
+        w = document_tab.c['id'].in_(query)
+        if complement:
+            return sql.not_(w)
+        return w
+
+    def _getGeoTable(self, idx):
+        element_cls = idx._getElementCls()
+        if element_cls is not GeoIndexElement:
+            msg = "Geo functions require a geo index: %s"
+            raise InvalidParameterError(msg % str(idx))
+        return element_cls.db_table
+
+    def _getLonClause(self, idx_tab, min_lon, max_lon):
+        lon = idx_tab.c['lon']
+        if min_lon > max_lon:
+            return sql.or_(lon >= min_lon, lon <= max_lon)
+        return sql.and_(lon >= min_lon, lon <= max_lon)
+
+    def _withinOnIndex(self, idx, idx_tab, w, complement, min_lat, max_lat,
+                       min_lon, max_lon):
+        """
+        Returns a clause selecting all documents matching the where clause
+        w on a geo index, restricted to the grid cells of the given box.
+        """
+        # cell ranges for each row of the grid
+        rows = range(getGeoCell(min_lat, 0) // GEO_CELL_COLUMNS,
+                     getGeoCell(max_lat, 0) // GEO_CELL_COLUMNS + 1)
+        if min_lon > max_lon:
+            cols = [(getGeoCell(-90, min_lon), GEO_CELL_COLUMNS - 1),
+                    (0, getGeoCell(-90, max_lon))]
+        else:
+            cols = [(getGeoCell(-90, min_lon), getGeoCell(-90, max_lon))]
+        keyval = idx_tab.c['keyval']
+        if len(rows) * len(cols) <= GEO_MAX_CELL_RANGES:
+            cells = sql.or_(*[keyval.between(row * GEO_CELL_COLUMNS + start,
+                                             row * GEO_CELL_COLUMNS + end)
+                              for row in rows for start, end in cols])
+        else:
+            cells = keyval.between(rows[0] * GEO_CELL_COLUMNS,
+                                   (rows[-1] + 1) * GEO_CELL_COLUMNS - 1)
+        query = sql.select([idx_tab.c['document_id']],
+                           sql.and_(idx_tab.c['index_id'] == idx._id,
+                                    cells, w))
+        w = document_tab.c['id'].in_(query)
+        if complement:
+            return sql.not_(w)
+        return w
+
     def _process_predicates(self, p, query, joins=None, complement=False):
         w = None
-        if len(p) == 3:
+        if isinstance(p[0], basestring):
+            # function
+            query, joins, w = self._applyFunc(p[0], p[1:], query, joins,
+                                              complement)
+        elif len(p) == 3:
             # binary expression
             op = p[1]
             l = p[0]
@@ -257,15 +961,27 @@ class _QueryProcessor(object):
             if op in XPathQuery._relational_ops:
                 # relational operator, l is a path expression => find an index
                 lidx = self.findIndex(l[0], l[1], l[2])
-                joins, ltab = self._join_on_index(lidx, joins,
-                                                  complement=complement)
+                bind = None
+                if isinstance(r, _BindValue):
+                    bind, r = r, r.value
                 if isinstance(r, list):  # joined path query
+                    joins, ltab = self._join_on_index(lidx, joins,
+                                                      complement=complement)
                     ridx = self.findIndex(r[0], r[1], r[2])
                     joins, rtab = self._join_on_index(ridx, joins,
                                                       complement=complement)
                     w = ltab.c['keyval'] == rtab.c['keyval']
-                else:  # key / value query
-                    w = self._applyOp(op, ltab.c['keyval'], lidx.prepareKey(r))
+                else:
+                    value = lidx.prepareKey(r)
+                    if bind is not None:
+                        value = bind.getParam(lidx, value)
+                    if not complement and self._isMultiValued(lidx):
+                        # avoid multiplying rows of multi-valued indexes
+                        w = self._existsOnIndex(lidx, op, value)
+                    else:  # key / value query
+                        joins, ltab = self._join_on_index(
+                            lidx, joins, complement=complement)
+                        w = self._applyOp(op, ltab.c['keyval'], value)
             else:
                 # logical operator
                 query, joins, lw = \
@@ -275,11 +991,6 @@ class _QueryProcessor(object):
                     self._process_predicates(r, query, joins,
                                              complement=complement)
                 w = self._applyOp(op, lw, rw, complement)
-        elif len(p) == 2:
-            # function
-            func = p[0]
-            expr = p[1]
-            query, joins, w = self._applyFunc(func, expr, query, joins)
         else:
             # unary expression => require node existence
             idx = self.findIndex(p[0][0], p[0][1], p[0][2])
@@ -288,7 +999,97 @@ class _QueryProcessor(object):
             w = (idx_tab.c['keyval'] != None)
         return query, joins, w
 
+    def _orderPredicates(self, p):
+        """
+        Returns a copy of the predicates with each chain of 'and' expressions
+        sorted by the estimated selectivity of its predicates.
+
+        Predicates are ordered before their values are lifted and before
+        looking up the statement cache, so the chosen order is part of the
+        cached query shape and bind parameters are named in that order.
+        """
+        if isinstance(p[0], basestring):
+            if p[0] == 'not' and len(p) == 2:
+                return [p[0], self._orderPredicates(p[1])]
+            return p
+        if len(p) != 3 or p[1] in XPathQuery._relational_ops:
+            return p
+        if p[1] != 'and':
+            return [self._orderPredicates(p[0]), p[1],
+                    self._orderPredicates(p[2])]
+        conjuncts = self._orderConjuncts(self._getConjuncts(p))
+        w = self._orderPredicates(conjuncts[0])
+        for c in conjuncts[1:]:
+            w = [w, 'and', self._orderPredicates(c)]
+        return w
+
+    def _getConjuncts(self, p):
+        """
+        Flattens nested 'and' expressions into a list of predicates.
+        """
+        if len(p) == 3 and p[1] == 'and':
+            return self._getConjuncts(p[0]) + self._getConjuncts(p[2])
+        return [p]
+
+    def _orderConjuncts(self, conjuncts):
+        """
+        Sorts predicates by their estimated number of matching rows.
+
+        Predicates which can't be estimated keep their order at the end.
+        """
+        costs = []
+        for c in conjuncts:
+            try:
+                costs.append(self._estimatePredicate(c))
+            except NotFoundError:
+                costs.append(None)
+        if None in costs and len(set(costs)) == 1:
+            return conjuncts
+        inf = float('inf')
+        order = sorted(range(len(conjuncts)),
+                       key=lambda i: costs[i] is None and inf or costs[i])
+        return [conjuncts[i] for i in order]
+
+    def _estimatePredicate(self, p):
+        if len(p) == 3 and p[1] in XPathQuery._relational_ops:
+            l, op, r = p
+            lidx = self.findIndex(l[0], l[1], l[2])
+            if isinstance(r, _BindValue):
+                r = r.value
+            if isinstance(r, list):
+                return self._estimateRows(lidx)
+            try:
+                value = lidx.prepareKey(r)
+            except Exception:
+                value = None
+            return self._estimateRows(lidx, op, value)
+        if len(p) == 1:
+            idx = self.findIndex(p[0][0], p[0][1], p[0][2])
+            return self._estimateRows(idx)
+        if p[0] == 'contains':
+            path, value = p[1:]
+            idx = self.findIndex(path[0], path[1], path[2])
+            return self._estimateRows(idx, '=', value)
+        return None
+
+    def _existsOnIndex(self, idx, op, value):
+        """
+        Returns an EXISTS clause for a key/value predicate on given index.
+        """
+        idx_tab = idx._getElementCls().db_table.alias()
+        oncl = sql.and_(idx_tab.c['document_id'] == document_tab.c['id'],
+                        idx_tab.c['index_id'] == idx._id,
+                        self._applyOp(op, idx_tab.c['keyval'], value))
+        return sql.exists([idx_tab.c['id']], oncl)
+
     def _process_order_by(self, order_by, query, joins=None):
+        """
+        Adds the order by clauses to a query.
+
+        Returns the query, the joins and a list of (column, descending) tuples
+        of the sort keys.
+        """
+        keys = []
         for ob in order_by:
             # an order_by element is of the form:
             # [[package, resourcetype, xpath], direction]
@@ -307,31 +1108,119 @@ class _QueryProcessor(object):
             else:
                 o = col.asc()
             query = query.order_by(o)
-        return query, joins
+            keys.append((col, ob[1] == "desc"))
+        return query, joins, keys
+
+    def _getOrderLabels(self, order_by):
+        """
+        Returns the result column names of the sort keys of a query.
+        """
+        labels = [str(self.findIndex(ob[0][0], ob[0][1], ob[0][2]))
+                  for ob in order_by]
+        labels.append('document_id')
+        return labels
+
+    def _getKeysetClause(self, keys, cursor):
+        """
+        Returns a clause selecting all rows sorted after the given values of
+        the sort keys, i.e. (key_1, ..., key_n) > (value_1, ..., value_n) with
+        respect to the direction of each key.
+
+        The values are bound as parameters named cursor_0 ... cursor_n. Rows
+        without a value of a sort key are sorted as done by the database, i.e.
+        before all values in ascending order on SQLite and MySQL and after
+        all values on PostgreSQL.
+        """
+        nulls_low = self._db.dialect.name in NULLS_LOW_DIALECTS
+        equal = []
+        clauses = []
+        for i, ((col, desc), value) in enumerate(zip(keys, cursor)):
+            nulls_first = nulls_low != desc
+            if value is None:
+                # only values follow if NULL is sorted first
+                if nulls_first:
+                    clauses.append(sql.and_(*(equal + [col != None])))
+                equal.append(col == None)
+                continue
+            param = sql.bindparam('cursor_%d' % i, value, type_=col.type)
+            if desc:
+                clause = col < param
+            else:
+                clause = col > param
+            if not nulls_first:
+                clause = sql.or_(clause, col == None)
+            clauses.append(sql.and_(*(equal + [clause])))
+            equal.append(col == param)
+        return sql.or_(*clauses)
+
+    def _process_results(self, res, limit=None, labels=None):
+        """
+        Merges all rows of a query result by document id.
+
+        Returns a dictionary of merged rows by document id and an additional
+        key 'ordered' with the document ids in order of their first row.
+        Differing values of a column are collected into a list, ignoring
+        duplicates.
 
-    def _process_results(self, res):
-        ordered = list()
-        results = dict()
+        If the result has been cut off by the given limit, the key 'cursor'
+        contains a continuation token with the values of the given sort key
+        columns of the last row.
+        """
+        results = OrderedDict()
+        seen = {}
+        rows = 0
+        row = None
         for row in res:
-            id = row["document_id"]
-            idx_values = dict(row)
-            if not id in ordered:
-                ordered.append(id)
-                results[id] = idx_values
+            rows += 1
+            id = row['document_id']
+            record = results.get(id)
+            if record is None:
+                results[id] = dict(row.items())
             else:
-                # cycle through results and reformat output to avoid duplicates
-                for key, val in idx_values.iteritems():
-                    # check if list; append new element, but ignore duplicates
-                    if isinstance(results[id][key], list):
-                        if not val in results[id][key]:
-                            results[id][key].append(val)
-                    else:
-                        if not results[id][key] == val:
-                            results[id][key] = [results[id][key]]
-                            results[id][key].append(val)
-        results['ordered'] = ordered
+                self._mergeRow(record, row, seen.setdefault(id, {}))
+        results['ordered'] = results.keys()
+        if limit and rows == limit and labels:
+            results['cursor'] = encodeCursor([row[l] for l in labels])
         return results
 
+    def _iterResults(self, res):
+        """
+        Yields (document_id, record) tuples of merged rows of a query result.
+
+        Only adjacent rows of a document are merged, which is always the case
+        unless ordering by a multi-valued index. Such queries are rejected by
+        L{iterQuery}.
+        """
+        id = record = seen = None
+        for row in res:
+            if record is not None and row['document_id'] == id:
+                self._mergeRow(record, row, seen)
+                continue
+            if record is not None:
+                yield id, record
+            id = row['document_id']
+            record = dict(row.items())
+            seen = {}
+        if record is not None:
+            yield id, record
+
+    def _mergeRow(self, record, row, seen):
+        """
+        Merges the values of a row into the record of the same document.
+
+        seen keeps a set of all values of each column converted into a list.
+        """
+        for key, val in row.items():
+            values = seen.get(key)
+            if values is None:
+                if record[key] == val:
+                    continue
+                values = seen[key] = set([record[key]])
+                record[key] = [record[key]]
+            if val not in values:
+                values.add(val)
+                record[key].append(val)
+
     def query(self, xpath):
         """
         Query the catalog.
@@ -341,14 +1230,259 @@ class _QueryProcessor(object):
         @return: result set containing uris of resources this xpath applies to
         @rtype: list of strings
         """
+        if xpath.getAggregates():
+            msg = "Use aggregate() for queries with aggregate functions."
+            raise InvalidParameterError(msg)
+        res = self._executeQuery(xpath)
+        labels = self._getOrderLabels(xpath.getOrderBy() or list())
+        try:
+            return self._process_results(res, xpath.getLimit(), labels)
+        finally:
+            res.close()
+
+    def iterQuery(self, xpath):
+        """
+        Query the catalog, yielding a (document_id, record) tuple for each
+        resulting document instead of collecting all results at once.
+
+        Ordering by a multi-valued index is not supported, as the rows of a
+        document wouldn't be adjacent. Use L{query} instead.
+
+        @see: L{_iterResults}
+        """
+        if xpath.getAggregates():
+            msg = "Use aggregate() for queries with aggregate functions."
+            raise InvalidParameterError(msg)
+        for ob in xpath.getOrderBy() or list():
+            idx = self.findIndex(ob[0][0], ob[0][1], ob[0][2])
+            if self._isMultiValued(idx):
+                msg = "Can't iterate over results ordered by the " + \
+                      "multi-valued index %s. Use query() instead."
+                raise InvalidParameterError(msg % str(idx))
+        res = self._executeQuery(xpath)
+        try:
+            for item in self._iterResults(res):
+                yield item
+        finally:
+            res.close()
+
+    def aggregate(self, xpath):
+        """
+        Query the catalog using aggregate functions.
+
+        The aggregates are computed by the database, returning a dictionary
+        for each group only. Group keys are named by the index label, count()
+        by 'count' and all other aggregates by the function name and the
+        index label, e.g. 'max_magnitude'.
+
+        @param xpath: xpath query with a select clause
+        @type xpath: L{seishub.xmldb.interfaces.IXPathQuery}
+        @return: list of dictionaries sorted by the group keys
+        """
+        if not xpath.getAggregates():
+            msg = "Query has no aggregate functions."
+            raise InvalidParameterError(msg)
+        res = self._executeQuery(xpath)
+        try:
+            return [dict(row.items()) for row in res]
+        finally:
+            res.close()
+
+    def _executeQuery(self, xpath):
+        """
+        Executes a query, returning the result proxy.
+        """
+        self._checkQuery(xpath)
+        order_by = xpath.getOrderBy() or list()
+        cursor = xpath.getCursor()
+        # lift values of relational predicates out as bind parameters
+        values = []
+        predicates = xpath.getPredicates()
+        if predicates:
+            # order first - bind names follow the order of the cached shape
+            predicates = self._orderPredicates(predicates)
+            predicates = self._liftValues(predicates, values)
+        shape = self._getShape(predicates)
+        key = None
+        if shape is not None:
+            # aggregates and group by clauses contain no values, NULL values
+            # of a cursor change the keyset clause
+            key = (tuple(xpath.getLocationPath()), shape,
+                   self._getShape(order_by), xpath.getLimit(),
+                   xpath.getOffset(),
+                   cursor and tuple([v is None for v in cursor]),
+                   repr((xpath.getAggregates(), xpath.getGroupBy())))
+        entry = key and self._statements.get(key)
+        if entry:
+            # same query shape - execute cached statement with new values
+            compiled, binds = entry
+            values = dict([(v.name, v.value) for v in values])
+            params = dict([(b.name, b.xmlindex.prepareKey(values[b.name]))
+                           for b in binds])
+        else:
+            query = self._buildStatement(xpath, predicates)
+            compiled = query.compile(bind=self._db)
+            binds = [v for v in values if v.xmlindex is not None]
+            if key:
+                self._statements.set(key, (compiled, binds))
+            params = {}
+        for i, value in enumerate(cursor or []):
+            if value is not None:
+                params['cursor_%d' % i] = value
+        return self._db.execute(compiled, params)
+
+    def _checkQuery(self, xpath):
+        """
+        Checks if the clauses of a query may be combined.
+        """
         if not IXPathQuery.providedBy(xpath):
             raise DoesNotImplement(IXPathQuery)
-        # evaluate XPath query
+        order_by = xpath.getOrderBy() or list()
+        cursor = xpath.getCursor()
+        if cursor is not None and len(cursor) != len(order_by) + 1:
+            msg = "Cursor does not match the order by clause of the query."
+            raise InvalidParameterError(msg)
+        if xpath.getAggregates() and (order_by or cursor is not None):
+            msg = "Aggregate queries are sorted by their group keys and " + \
+                  "can not be ordered or resumed."
+            raise InvalidParameterError(msg)
+
+    def _buildStatement(self, xpath, predicates):
+        """
+        Returns the SQL statement of a query using the given predicates.
+        """
         location_path = xpath.getLocationPath()
+        aggregates = xpath.getAggregates()
+        if aggregates:
+            return self._buildAggregateQuery(location_path, predicates,
+                                             aggregates,
+                                             xpath.getGroupBy() or list(),
+                                             xpath.getLimit(),
+                                             xpath.getOffset())
+        return self._buildQuery(location_path, predicates,
+                                xpath.getOrderBy() or list(),
+                                xpath.getLimit(), xpath.getOffset(),
+                                xpath.getCursor())
+
+    def explain(self, xpath):
+        """
+        Explains the evaluation of a query.
+
+        The query is executed once without using the statement cache. The
+        returned dictionary contains the parsed predicates, all used indexes
+        with their statistics, the SQL statement and its parameters, the
+        execution plan of the database, the number of results and the time
+        in seconds spent building, executing and processing the statement.
+
+        @param xpath: xpath query to be explained
+        @type xpath: L{seishub.xmldb.interfaces.IXPathQuery}
+        @return: dictionary
+        """
+        self._checkQuery(xpath)
+        timing = {}
+        t = time.time()
         predicates = xpath.getPredicates()
-        order_by = xpath.getOrderBy() or list()
-        limit = xpath.getLimit()
-        offset = xpath.getOffset()
+        if predicates:
+            predicates = self._orderPredicates(predicates)
+            predicates = self._liftValues(predicates, [])
+        query = self._buildStatement(xpath, predicates)
+        compiled = query.compile(bind=self._db)
+        timing['build'] = time.time() - t
+        t = time.time()
+        res = self._db.execute(compiled)
+        timing['execute'] = time.time() - t
+        t = time.time()
+        try:
+            if xpath.getAggregates():
+                results = res.fetchall()
+            else:
+                results = self._process_results(res)['ordered']
+        finally:
+            res.close()
+        timing['process'] = time.time() - t
+        plan = [tuple(row)[-1] for row in self._db.execute(Explain(query))]
+        return {'predicates': xpath.getPredicates(),
+                'indexes': self._getQueryIndexes(xpath),
+                'sql': unicode(compiled),
+                'params': compiled.params,
+                'plan': plan,
+                'results': len(results),
+                'timing': timing}
+
+    def _getQueryIndexes(self, xpath):
+        """
+        Returns path, index and statistics of each index used by a query.
+        """
+        paths = []
+        def walk(p):
+            if len(p) == 3 and \
+               all([isinstance(item, basestring) for item in p]):
+                if p not in paths:
+                    paths.append(p)
+                return
+            for item in p:
+                if isinstance(item, list):
+                    walk(item)
+        for clause in (xpath.getPredicates(), xpath.getAggregates(),
+                       xpath.getGroupBy(), xpath.getOrderBy()):
+            walk(clause or [])
+        indexes = []
+        for path in paths:
+            idx = self.findIndex(path[0], path[1], path[2])
+            stats = self.getIndexStatistics(idx)
+            indexes.append({'path': '/' + '/'.join(path),
+                            'index': str(idx),
+                            'label': idx.label,
+                            'rows': stats['rows'],
+                            'distinct': stats['distinct'],
+                            'documents': stats['documents']})
+        return indexes
+
+    def _liftValues(self, p, values):
+        """
+        Returns a copy of the predicates with the values of all key/value
+        predicates replaced by L{_BindValue} objects, appended to values.
+        """
+        if isinstance(p[0], basestring):
+            if p[0] == 'not':
+                return [p[0], self._liftValues(p[1], values)]
+            return p
+        if len(p) != 3:
+            return p
+        if p[1] not in XPathQuery._relational_ops:
+            return [self._liftValues(p[0], values), p[1],
+                    self._liftValues(p[2], values)]
+        if isinstance(p[2], list):
+            return p
+        value = _BindValue('value_%d' % len(values), p[2])
+        values.append(value)
+        return [p[0], p[1], value]
+
+    def _getShape(self, p):
+        """
+        Returns a hashable copy of lifted predicates or order by clauses or
+        None if the resulting statement must not be cached.
+        """
+        if isinstance(p, _BindValue):
+            return _BindValue
+        if not isinstance(p, list):
+            return p
+        if p and p[0] in UNCACHEABLE_FUNCTIONS:
+            return None
+        shape = tuple([self._getShape(item) for item in p])
+        if None in shape:
+            return None
+        return shape
+
+    def _buildQuery(self, location_path, predicates, order_by, limit,
+                    offset, cursor=None):
+        """
+        Returns the SQL statement of a parsed query.
+
+        Rows are always sorted by document id last, so the values of the sort
+        keys of a row given as cursor allow to resume a query directly after
+        that row instead of skipping all previous rows by an offset.
+        """
         # default columns: document_id, package, resourcetype, resource_name,
         # size, uid, datetime
         columns = [document_tab.c['id'].label("document_id"),
@@ -359,8 +1493,40 @@ class _QueryProcessor(object):
                    document_meta_tab.c['size'].label('meta_size'),
                    document_meta_tab.c['uid'].label('meta_uid'),
                    document_meta_tab.c['datetime'].label('meta_datetime')]
+        joins = self._joinLocation(location_path)
+        # parse predicates
+        query = select(columns, use_labels=True, distinct=True)
+        if predicates:
+            query, joins, w = self._process_predicates(predicates, query,
+                                                       joins)
+            if w is not None:
+                query = query.where(w)
+        # order by
+        keys = []
+        if order_by:
+            query, joins, keys = self._process_order_by(order_by, query,
+                                                        joins)
+        # order by document id - by default or to break ties
+        query = query.order_by(document_tab.c['id'])
+        keys.append((document_tab.c['id'], False))
+        # resume after the last row of a previous query
+        if cursor is not None:
+            query = query.where(self._getKeysetClause(keys, cursor))
+        query = query.select_from(joins)
+        # limit and offset
+        if limit:
+            query = query.limit(limit)
+        if offset:
+            query = query.offset(offset)
+        return query
+
+    def _joinLocation(self, location_path):
+        """
+        Joins documents with their resource, resource type, package and
+        document meta data, restricted to the package and resource type of
+        the location path.
+        """
         pkg, rt = location_path[0:2]
-        # join default columns
         oncl = (resource_tab.c['id'] == document_tab.c['resource_id'])
         joins = document_tab.join(resource_tab, onclause=oncl)
         oncl = resourcetypes_tab.c['id'] == resource_tab.c['resourcetype_id']
@@ -372,44 +1538,158 @@ class _QueryProcessor(object):
             oncl = sql.and_(oncl, packages_tab.c['name'] == pkg)
         joins = joins.join(packages_tab, onclause=oncl)
         oncl = (document_tab.c['id'] == document_meta_tab.c['id'])
-        joins = joins.join(document_meta_tab, onclause=oncl)
-        # parse predicates
-        query = select(columns, use_labels=True, distinct=True)
+        return joins.join(document_meta_tab, onclause=oncl)
+
+    def _buildAggregateQuery(self, location_path, predicates, aggregates,
+                             group_by, limit, offset):
+        """
+        Returns the SQL statement of a parsed aggregate query.
+
+        Documents are counted on the distinct document ids and group keys of
+        all matching documents. Each other aggregate is computed on its own
+        distinct rows of document id, group keys and aggregated value, so
+        values of other joined indexes never repeat its values. The results
+        are joined by group key and sorted by the group keys.
+        """
+        labels = []
+        for path, _ in group_by:
+            labels.append(self.findIndex(path[0], path[1], path[2]).label)
+        base = self._buildAggregateRows(location_path, predicates, group_by)
+        base = base.alias('aggregated')
+        groups = [base.c['group_%d' % i] for i in xrange(len(group_by))]
+        columns = list(groups)
+        joins = base
+        for i, (func, path) in enumerate(aggregates):
+            if path is None:
+                count = sql.func.count(base.c['document_id'].distinct())
+                columns.append(count)
+                labels.append(func)
+                continue
+            idx = self.findIndex(path[0], path[1], path[2])
+            if func == 'avg' and idx.type not in NUMERIC_INDEX_TYPES:
+                msg = "avg() requires a numeric index: %s"
+                raise InvalidParameterError(msg % str(idx))
+            rows = self._buildAggregateRows(location_path, predicates,
+                                            group_by, idx)
+            rows = rows.alias('aggregated_%d' % i)
+            value = rows.c['value']
+            keys = [rows.c['group_%d' % j] for j in xrange(len(group_by))]
+            col = getattr(sql.func, func)(value, type_=value.type)
+            sub = select(keys + [col.label('value')]).select_from(rows)
+            if keys:
+                sub = sub.group_by(*keys)
+            sub = sub.alias('aggregate_%d' % i)
+            if groups:
+                # group keys may be NULL
+                oncl = sql.and_(*[
+                    sql.or_(group == sub.c['group_%d' % j],
+                            sql.and_(group == None,
+                                     sub.c['group_%d' % j] == None))
+                    for j, group in enumerate(groups)])
+                joins = joins.outerjoin(sub, onclause=oncl)
+            else:
+                # a single row without groups
+                joins = joins.join(sub, onclause=sql.literal(True))
+            columns.append(sql.func.max(sub.c['value'],
+                                        type_=value.type))
+            labels.append('%s_%s' % (func, idx.label))
+        columns = [col.label(label) for col, label in zip(columns, labels)]
+        query = select(columns).select_from(joins)
+        if groups:
+            query = query.group_by(*groups).order_by(*groups)
+        if limit:
+            query = query.limit(limit)
+        if offset:
+            query = query.offset(offset)
+        return query
+
+    def _buildAggregateRows(self, location_path, predicates, group_by,
+                            idx=None):
+        """
+        Returns a select of the distinct document ids and group keys of all
+        matching documents and, if an index is given, its values.
+        """
+        joins = self._joinLocation(location_path)
+        query = select([document_tab.c['id'].label('document_id')],
+                       distinct=True)
         if predicates:
             query, joins, w = self._process_predicates(predicates, query,
                                                        joins)
             if w is not None:
                 query = query.where(w)
-        # order by
-        if order_by:
-            query, joins = self._process_order_by(order_by, query, joins)
-        else:
-            # default order by document id
-            query = query.order_by(document_tab.c['id'])
-        query = query.select_from(joins)
-        # limit and offset
-        if limit:
-            query = query.limit(limit)
-        if offset:
-            query = query.offset(offset)
-        # query
-        res = self._db.execute(query)
-        results = self._process_results(res)
-        res.close()
-        return results
+        for i, (path, width) in enumerate(group_by):
+            group_idx = self.findIndex(path[0], path[1], path[2])
+            joins, idx_tab = self._join_on_index(group_idx, joins)
+            col = self._getBucket(group_idx, idx_tab.c['keyval'], width)
+            query.append_column(col.label('group_%d' % i))
+        if idx is not None:
+            joins, idx_tab = self._join_on_index(idx, joins)
+            query.append_column(idx_tab.c['keyval'].label('value'))
+        return query.select_from(joins)
+
+    def _getBucket(self, idx, col, width):
+        """
+        Returns the group key of an index column.
+
+        Numeric values are rounded down to a multiple of the bucket width, date
+        and time values are truncated to the given unit.
+        """
+        if width is None:
+            return col
+        if idx.type in NUMERIC_INDEX_TYPES:
+            try:
+                width = isInteger(width) and int(width) or float(width)
+            except ValueError:
+                width = 0
+            if width <= 0:
+                msg = "Invalid bucket width for index %s: %s"
+                raise InvalidParameterError(msg % (str(idx), width))
+            # floor(value / width) * width - the integer cast either
+            # truncates or rounds depending on the database
+            value = sql.cast(col, Float) / float(width)
+            floor = sql.cast(value, Integer)
+            floor = floor - sql.case([(value < floor, 1)], else_=0)
+            return floor * sql.literal(width)
+        if idx.type in DATETIME_INDEX_TYPES:
+            if width not in DATETIME_BUCKETS:
+                msg = "Invalid bucket unit for index %s: %s (use %s)"
+                raise InvalidParameterError(msg % (str(idx), width,
+                    ', '.join(sorted(DATETIME_BUCKETS))))
+            if self._db_manager.isSQLite():
+                return sql.func.strftime(DATETIME_BUCKETS[width], col,
+                                         type_=DateTime)
+            return sql.func.date_trunc(width, col, type_=DateTime)
+        msg = "Index %s can not be grouped into buckets."
+        raise InvalidParameterError(msg % str(idx))
 
 
-class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
+class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView,
+                      _IndexStatistics, _KeyvalIndexes):
     """
     A catalog of indexes.
 
     Most methods use XMLIndex objects as input parameters. You may use the
     getIndexes methods to query for valid XMLIndex objects.
     """
+    BoolOption('xmldb', 'materialized_index_views', False,
+        "Stores index views as tables which are updated on each write.")
+    IntOption('xmldb', 'statistics_refresh_interval', 3600,
+        "Seconds after which index statistics used for query planning are "
+        "collected again in the background (0 = only after reindexing).")
+    BoolOption('xmldb', 'partial_keyval_indexes', False,
+        "Creates an additional partial keyval index for each index.")
+    ListOption('xmldb', 'disabled_keyval_indexes', '',
+        "Keyval indexes which are not created at start up.")
+    IntOption('xmldb', 'statement_cache_size', 200,
+        "Number of compiled catalog query statements kept in memory "
+        "(0 = disabled).")
+
     def __init__(self, db, resource_storage=None):
         DbStorage.__init__(self, db)
         self._db_manager = db
         self._storage = resource_storage
+        self._cancelled = set()
+        self._index_generation = 0
         self.refreshIndexCache()
 
     def refreshIndexCache(self):
@@ -417,22 +1697,65 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
         Refreshs the index cache.
         """
         self._cache = {}
+        self._cache_by_rt = {}
+        self._cache_by_label = {}
+        self._cache_by_xpath = {}
+        self._tries = {}
+        self._plans = {}
+        self._statistics = {}
+        self._refreshing = set()
+        self._shadows = {}
+        self._view_columns = {}
+        self._statements = LRUCache(self._db_manager.env.config.getint(
+            'xmldb', 'statement_cache_size'))
         # get all indexes
         indexes = self.pickup(XmlIndex)
         for idx in indexes:
             self._addToCache(idx)
+        # keep maintaining shadow rows of unfinished online reindexes
+        query = sql.select([index_shadow_tab.c['index_id']])
+        for item in self._db.execute(query).fetchall():
+            xmlindex = self._cache.get(item[0])
+            if xmlindex is not None:
+                self._addShadow(xmlindex)
 
     def _addToCache(self, xmlindex):
         """
         Adds a given XMLIndex to the index cache.
         """
+        key = (xmlindex.package_id, xmlindex.resourcetype_id)
         self._cache[xmlindex._id] = xmlindex
+        self._cache_by_rt.setdefault(key, {})[xmlindex._id] = xmlindex
+        self._cache_by_label[key + (xmlindex.label,)] = xmlindex
+        self._cache_by_xpath[key + (xmlindex.xpath,)] = xmlindex
+        self._tries.pop(key, None)
+        self._plans.clear()
+        self._statements.clear()
+        self._index_generation += 1
 
     def _deleteFromCache(self, xmlindex):
         """
         Deletes a given XMLIndex from the index cache.
         """
-        self._cache.pop(xmlindex._id, None)
+        xmlindex = self._cache.pop(xmlindex._id, None)
+        if xmlindex is None:
+            return
+        key = (xmlindex.package_id, xmlindex.resourcetype_id)
+        self._cache_by_rt.get(key, {}).pop(xmlindex._id, None)
+        self._cache_by_label.pop(key + (xmlindex.label,), None)
+        self._cache_by_xpath.pop(key + (xmlindex.xpath,), None)
+        self._tries.pop(key, None)
+        self._statistics.pop(xmlindex._id, None)
+        self._plans.clear()
+        self._statements.clear()
+        self._index_generation += 1
+
+    def getIndexGeneration(self):
+        """
+        Returns a counter which changes each time an index is registered or
+        deleted.
+        """
+        return self._index_generation
 
     def registerIndex(self, xmlindex):
         """
@@ -450,6 +1773,7 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
             raise SeisHubError(msg % str(xmlindex), e)
         # cache
         self._addToCache(xmlindex)
+        self._updatePartialKeyvalIndex(xmlindex)
         # refresh index view
         self.updateIndexView(xmlindex)
         return xmlindex
@@ -463,6 +1787,7 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
             raise InvalidObjectError(msg)
         resourcetype = xmlindex.resourcetype
         self.flushIndex(xmlindex)
+        self._updatePartialKeyvalIndex(xmlindex, drop=True)
         self.drop(XmlIndex, _id=xmlindex._id)
         # cache
         self._deleteFromCache(xmlindex)
@@ -476,18 +1801,36 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
         if args:
             msg = "XmlIndexCatalog.getIndexes() should be called with keywords"
             raise DeprecationWarning(msg)
+        kwargs = dict([(k, v) for k, v in kwargs.iteritems()
+                       if v is not None and v != '*'])
+        package_id = kwargs.get('package_id')
+        resourcetype_id = kwargs.get('resourcetype_id')
+        key = (package_id, resourcetype_id)
+        # narrow down candidates using the secondary dictionaries
+        if '_id' in kwargs:
+            candidates = [self._cache.get(kwargs['_id'])]
+        elif package_id and resourcetype_id and 'label' in kwargs:
+            candidates = [self._cache_by_label.get(key + (kwargs['label'],))]
+        elif package_id and resourcetype_id and 'xpath' in kwargs:
+            candidates = [self._cache_by_xpath.get(key + (kwargs['xpath'],))]
+        elif package_id and resourcetype_id:
+            candidates = self._cache_by_rt.get(key, {}).values()
+        else:
+            candidates = self._cache.values()
         xmlindex_list = []
-        for id, xmlindex in self._cache.iteritems():
+        for xmlindex in candidates:
+            if xmlindex is None:
+                continue
             flag = True
             for key, value in kwargs.iteritems():
-                if value == None or value == '*':
-                    continue
                 if not hasattr(xmlindex, key):
                     continue
                 if getattr(xmlindex, key) != value:
                     flag = False
+                    break
             if flag:
                 xmlindex_list.append(xmlindex)
+        xmlindex_list.sort(key=lambda xmlindex: xmlindex._id)
         return xmlindex_list
 
     def indexResource(self, resource, xmlindex_list=None):
@@ -497,20 +1840,225 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
         if not IResource.providedBy(resource):
             raise TypeError("%s is not an IResource." % str(resource))
         if not xmlindex_list:
-            xmlindex_list = self.getIndexes(
-                package_id=resource.package.package_id,
-                resourcetype_id=resource.resourcetype.resourcetype_id)
-        elements = []
-        for xmlindex in xmlindex_list:
-            temp = xmlindex.eval(resource.document, self.env)
-            elements.extend(temp)
-        for el in elements:
+            plan = self._getIndexPlan(resource.package.package_id,
+                                      resource.resourcetype.resourcetype_id)
+        else:
+            plan = XmlIndexPlan(xmlindex_list)
+        elements = plan.eval(resource.document, self.env)
+        self._storeElements(elements)
+        self.refreshIndexViewRows(resource)
+        return elements
+
+    def updateResource(self, old_resource, resource):
+        """
+        Updates the indexed data of a modified resource.
+
+        The new index elements are compared with the index rows stored for
+        the previous document and only the difference is deleted or inserted.
+        Indexing is skipped completely if the document hash did not change.
+        """
+        if not IResource.providedBy(resource):
+            raise TypeError("%s is not an IResource." % str(resource))
+        new_id = resource.document._id
+        if resource.resourcetype.version_control:
+            # index rows belong to the previous revision
+            old_id, old_hash = self._getPreviousDocument(resource)
+        else:
+            old_id = old_resource.document._id
+            old_hash = old_resource.document.meta.hash
+        unchanged = old_hash == resource.document.meta.hash
+        if unchanged and old_id == new_id:
+            return
+        plan = self._getIndexPlan(resource.package.package_id,
+                                  resource.resourcetype.resourcetype_id)
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            if unchanged:
+                # new revision of an unchanged document - just move all rows
+                for table in plan.getTables():
+                    conn.execute(table.update()
+                                 .where(table.c['document_id'] == old_id)
+                                 .values(document_id=new_id))
+            else:
+                self._updateRows(conn, plan, resource.document, old_id)
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _getPreviousDocument(self, resource):
+        """
+        Returns document id and hash of the previous revision of a resource.
+        """
+        query = sql.select([document_tab.c['id'], document_meta_tab.c['hash']],
+            sql.and_(document_tab.c['resource_id'] == resource._id,
+                     document_tab.c['id'] != resource.document._id,
+                     document_meta_tab.c['id'] == document_tab.c['id']))
+        query = query.order_by(sql.desc(document_tab.c['revision'])).limit(1)
+        item = self._db.execute(query).fetchone()
+        if not item:
+            return None, None
+        return item[0], item[1]
+
+    def _updateRows(self, conn, plan, document, old_id):
+        """
+        Replaces the index rows of document old_id by the index elements of
+        the given document, deleting and inserting only changed rows.
+        """
+        new_id = document._id
+        rows = {}
+        for el in plan.eval(document, self.env):
+            row = self._getElementRow(el)
+            rows.setdefault(self._getRowKey(el.db_table, row),
+                            (el.db_table, row))
+        for table in plan.getTables():
+            columns = [c for c in table.c if c.name != 'document_id']
+            query = sql.select(columns, table.c['document_id'] == old_id)
+            keep = []
+            drop = []
+            for item in conn.execute(query).fetchall():
+                key = self._getRowKey(table, item)
+                if key in rows:
+                    del rows[key]
+                    keep.append(item['id'])
+                else:
+                    drop.append(item['id'])
+            if drop:
+                conn.execute(table.delete(table.c['id'].in_(drop)))
+            if keep and old_id != new_id:
+                conn.execute(table.update()
+                             .where(table.c['id'].in_(keep))
+                             .values(document_id=new_id))
+        self._storeRows(rows.values(), conn)
+
+    def _getRowKey(self, table, row):
+        """
+        Returns a comparable key for a stored or new index row.
+
+        Key values are converted into the Python type of the key column, as
+        e.g. numeric columns return Decimal objects. Additional columns of
+        an index table (e.g. coordinates of geo indexes) are part of the key.
+        """
+        values = []
+        for col in table.c:
+            if col.name in ('id', 'index_id', 'group_pos', 'document_id'):
+                continue
+            values.append(self._getColumnValue(col, row[col.name]))
+        return (table, row['index_id'], row['group_pos']) + tuple(values)
+
+    def _getColumnValue(self, col, value):
+        if value is None:
+            return value
+        try:
+            python_type = col.type.python_type
+        except NotImplementedError:
+            return value
+        if python_type is Decimal:
+            return Decimal(str(value))
+        if not isinstance(value, python_type):
             try:
-                self.store(el)
-            except DbError:
-                # ignore duplicate index elements
+                return python_type(value)
+            except (TypeError, ValueError):
                 pass
-        return elements
+        return value
+
+    def _getIndexPlan(self, package_id, resourcetype_id):
+        """
+        Returns the cached index evaluation plan of a resource type.
+        """
+        key = (package_id, resourcetype_id)
+        plan = self._plans.get(key)
+        if plan is None:
+            xmlindex_list = self.getIndexes(package_id=package_id,
+                                            resourcetype_id=resourcetype_id)
+            # shadow indexes of online reindexes are written as well
+            xmlindex_list += [self._shadows[xmlindex._id]
+                              for xmlindex in xmlindex_list
+                              if xmlindex._id in self._shadows]
+            plan = self._plans[key] = XmlIndexPlan(xmlindex_list)
+        return plan
+
+    def _getElementRow(self, element):
+        """
+        Returns a complete column dictionary for a given index element.
+
+        All columns except the primary key are included, so rows of the same
+        table may be inserted with a single executemany statement.
+        """
+        row = self._to_kwargs(element)
+        for col in element.db_table.c.keys():
+            if col == 'id':
+                continue
+            row.setdefault(col, None)
+        return row
+
+    def _getKeyRow(self, xmlindex, key, group_pos, document_id, extra=()):
+        """
+        Returns index table and column dictionary for a plain index key.
+
+        Values of additional columns are given in the order of the
+        _extra_fields of the index element class.
+        """
+        element_cls = xmlindex._getElementCls()
+        row = {'index_id': xmlindex._id, 'keyval': key,
+               'group_pos': group_pos, 'document_id': document_id}
+        row.update(zip(element_cls._extra_fields, extra))
+        return element_cls.db_table, row
+
+    def _storeElements(self, elements, conn=None):
+        """
+        Stores a list of index elements grouped by index table.
+
+        Each table is written with a single executemany statement and all
+        tables within one transaction. Duplicate index elements are ignored.
+        """
+        rows = [(el.db_table, self._getElementRow(el)) for el in elements]
+        self._storeRows(rows, conn)
+
+    def _storeRows(self, rows, conn=None):
+        """
+        Stores a list of (table, row) tuples - see L{_storeElements}.
+        """
+        # group rows by table and skip duplicates within this batch
+        tables = {}
+        for table, row in rows:
+            key = tuple(sorted(row.items()))
+            table_rows, seen = tables.setdefault(table, ([], set()))
+            if key in seen:
+                continue
+            seen.add(key)
+            table_rows.append(row)
+        if not tables:
+            return
+        if conn is not None:
+            # caller takes care of the transaction
+            for table, (table_rows, _) in tables.iteritems():
+                conn.execute(table.insert(), table_rows)
+            return
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            for table, (table_rows, _) in tables.iteritems():
+                conn.execute(table.insert(), table_rows)
+            txn.commit()
+        except IntegrityError:
+            txn.rollback()
+            # some rows are already indexed - fall back to single inserts and
+            # ignore duplicate index elements
+            for table, (table_rows, _) in tables.iteritems():
+                for row in table_rows:
+                    try:
+                        conn.execute(table.insert(), row)
+                    except IntegrityError:
+                        pass
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
 
     def dumpIndex(self, xmlindex):
         """
@@ -537,26 +2085,66 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
     def flushIndex(self, xmlindex):
         """
         Remove all indexed data for given XMLIndex object.
+
+        Shadow rows of an unfinished online reindex are removed as well.
         """
         element_cls = xmlindex._getElementCls()
         self.drop(element_cls, index=xmlindex)
+        if xmlindex._id in self._shadows:
+            self.discardReindex([xmlindex])
 
     def flushResource(self, resource):
         """
         Remove all indexed data for given Resource object.
+
+        Only index tables used by the indexes of the resource type are
+        cleared, all within a single transaction.
         """
-        for element_cls in type_classes.values():
-            self.drop(element_cls,
-                      document={'_id': resource.document._id})
-        return
+        plan = self._getIndexPlan(resource.package.package_id,
+                                  resource.resourcetype.resourcetype_id)
+        document_id = resource.document._id
+        name = '/%s/%s' % (resource.package.package_id,
+                           resource.resourcetype.resourcetype_id)
+        materialized = self._isMaterialized() and \
+            self._getIndexTableColumns(name) is not None
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            for table in plan.getTables():
+                conn.execute(table.delete(
+                    table.c['document_id'] == document_id))
+            if materialized:
+                self._deleteIndexViewRows(conn, name, resource)
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
 
-    def reindexIndexes(self, xmlindex_list):
+    def reindexIndexes(self, xmlindex_list, processes=None, batch_size=100,
+                       progress=None, online=False, resume=False):
         """
         Reindex all resources by a list of XMLIndex objects.
 
         This works only with indexes of a single resource type. We take the
         resource type of the first index and skip any additional indexes with
         a different resource type.
+
+        @param processes: Number of worker processes used for parsing and
+            evaluating documents. By default all documents are processed in
+            the calling thread.
+        @param batch_size: Number of documents fetched, processed and stored
+            at once.
+        @param progress: Optional callable, receiving the number of already
+            processed documents and the total number of documents.
+        @param online: Builds the new index rows as shadow rows while the old
+            rows stay queryable. Shadow rows are swapped in within a single
+            transaction after all documents have been processed.
+        @param resume: Continues a cancelled online reindex after the last
+            stored batch instead of starting all over.
+        @return: False if the reindex has been cancelled using
+            L{cancelReindex}, otherwise True.
         """
         resourcetype = xmlindex_list[0].resourcetype
         #resourcetype_id = resourcetype._id
@@ -569,7 +2157,15 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
                 xmlindex_list.remove(xmlindex)
                 continue
             # clear index
-            self.flushIndex(xmlindex)
+            if not online:
+                self.flushIndex(xmlindex)
+        ids = set([xmlindex._id for xmlindex in xmlindex_list])
+        self._cancelled.difference_update(ids)
+        checkpoint = None
+        if online:
+            checkpoint = self._startShadows(xmlindex_list, resume)
+            xmlindex_list = [self._shadows[xmlindex._id]
+                             for xmlindex in xmlindex_list]
         # fetch all document_id for this resourcetype
         query = sql.select()
         a = document_tab.alias('a')
@@ -584,24 +2180,363 @@ class XmlIndexCatalog(DbStorage, _QueryProcessor, _IndexView):
             j = b.join(a, sql.and_(a.c['resource_id'] == b.c['resource_id'],
                                    a.c['revision'] == b.c['max_revision']))
             query = query.select_from(j)
-        query = query.with_only_columns([a.c['id'],
-                                         a.c['data'],
-                                         a.c['revision']])
         query = query.where(
             sql.and_(
                 a.c['resource_id'] == resource_tab.c['id'],
                 resource_tab.c['resourcetype_id'] == resourcetype._id
             ))
-        result = self._db.execute(query)
-        # get all document IDs and reindex
-        if self._db_manager.isSQLite():
-            # sqlite does not support multiple open connections; In particular
-            # it is not possible to commit inserts while keeping an open cursor
-            result = result.fetchall()
-        for item in result:
-            # build temporary objects manually for performance reasons
-            doc = XmlDocument(data=item['data'], revision=item['revision'])
-            doc._id = item['id']
-            res = Resource(resourcetype=resourcetype, document=doc)
-            self.indexResource(res, xmlindex_list)
+        if checkpoint is not None:
+            # documents up to the checkpoint have been processed already
+            query = query.where(a.c['id'] > checkpoint)
+        # count documents
+        count_query = query.with_only_columns([sql.func.count(a.c['id'])])
+        total = self._db.execute(count_query).scalar()
+        query = query.with_only_columns([a.c['id'],
+                                         a.c['data'],
+                                         a.c['revision']])
+        batches = self._iterBatches(query, a.c['id'], batch_size)
+        batches = self._iterUntilCancelled(batches, ids)
+        if processes and processes > 1:
+            self._reindexParallel(xmlindex_list, batches, processes, total,
+                                  progress, online)
+        else:
+            self._reindexSerial(xmlindex_list, batches, total, progress,
+                                online)
+        if self._cancelled.intersection(ids):
+            self._cancelled.difference_update(ids)
+            return False
+        if online:
+            xmlindex_list = [self._cache[-shadow._id]
+                             for shadow in xmlindex_list]
+            self._swapShadows(xmlindex_list)
+        if self._isMaterialized():
+            self.updateIndexView(resourcetype, rebuild=True)
+        self.updateIndexStatistics(xmlindex_list)
         return True
+
+    def cancelReindex(self, xmlindex_list):
+        """
+        Cancels running reindexes of the given XMLIndex objects.
+
+        Reindexing stops after the current batch of documents. Shadow rows of
+        an online reindex are kept and maintained on each write, so the
+        reindex may be resumed later.
+        """
+        self._cancelled.update([xmlindex._id for xmlindex in xmlindex_list])
+
+    def discardReindex(self, xmlindex_list):
+        """
+        Removes all shadow rows of unfinished online reindexes.
+        """
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            for xmlindex in xmlindex_list:
+                table = xmlindex._getElementCls().db_table
+                conn.execute(table.delete(
+                    table.c['index_id'] == -xmlindex._id))
+                conn.execute(index_shadow_tab.delete(
+                    index_shadow_tab.c['index_id'] == xmlindex._id))
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
+        for xmlindex in xmlindex_list:
+            self._deleteShadow(xmlindex)
+
+    def getReindexCheckpoints(self):
+        """
+        Returns the last processed document id of all unfinished online
+        reindexes by index id - None if no batch has been stored yet.
+        """
+        query = sql.select([index_shadow_tab.c['index_id'],
+                            index_shadow_tab.c['checkpoint']])
+        return dict([(item[0], item[1])
+                     for item in self._db.execute(query).fetchall()])
+
+    def _addShadow(self, xmlindex):
+        """
+        Registers a shadow copy of a XMLIndex, writing rows with negated id.
+        """
+        shadow = copy.copy(xmlindex)
+        shadow._id = -xmlindex._id
+        self._shadows[xmlindex._id] = shadow
+        self._plans.clear()
+        return shadow
+
+    def _deleteShadow(self, xmlindex):
+        if self._shadows.pop(xmlindex._id, None) is not None:
+            self._plans.clear()
+
+    def _startShadows(self, xmlindex_list, resume=False):
+        """
+        Prepares shadow indexes for an online reindex.
+
+        Returns the document id after which reindexing has to continue or
+        None if all documents have to be processed.
+        """
+        checkpoints = self.getReindexCheckpoints()
+        checkpoint = None
+        if resume and xmlindex_list:
+            values = [checkpoints.get(xmlindex._id)
+                      for xmlindex in xmlindex_list]
+            if None not in values:
+                # continue where all given indexes have been processed
+                checkpoint = min(values)
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            for xmlindex in xmlindex_list:
+                table = xmlindex._getElementCls().db_table
+                clause = table.c['index_id'] == -xmlindex._id
+                if checkpoint is not None:
+                    clause = sql.and_(clause,
+                                      table.c['document_id'] > checkpoint)
+                conn.execute(table.delete(clause))
+                if xmlindex._id in checkpoints:
+                    conn.execute(index_shadow_tab.update(
+                        index_shadow_tab.c['index_id'] == xmlindex._id),
+                        checkpoint=checkpoint)
+                else:
+                    conn.execute(index_shadow_tab.insert(),
+                                 index_id=xmlindex._id, checkpoint=None)
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
+        for xmlindex in xmlindex_list:
+            if xmlindex._id not in self._shadows:
+                self._addShadow(xmlindex)
+        return checkpoint
+
+    def _swapShadows(self, xmlindex_list):
+        """
+        Replaces the index rows by the shadow rows within one transaction.
+        """
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            for xmlindex in xmlindex_list:
+                table = xmlindex._getElementCls().db_table
+                shadow_id = -xmlindex._id
+                conn.execute(table.delete(table.c['index_id'] == xmlindex._id))
+                # rows of documents deleted while being processed
+                conn.execute(table.delete(sql.and_(
+                    table.c['index_id'] == shadow_id,
+                    ~table.c['document_id'].in_(
+                        sql.select([document_tab.c['id']])))))
+                conn.execute(table.update()
+                             .where(table.c['index_id'] == shadow_id)
+                             .values(index_id=xmlindex._id))
+                conn.execute(index_shadow_tab.delete(
+                    index_shadow_tab.c['index_id'] == xmlindex._id))
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
+        for xmlindex in xmlindex_list:
+            self._deleteShadow(xmlindex)
+
+    def _storeShadowRows(self, xmlindex_list, batch, rows):
+        """
+        Replaces the shadow rows of a batch of documents and stores the last
+        document id as checkpoint, all within a single transaction.
+        """
+        document_ids = [item[0] for item in batch]
+        conn = self._db.connect()
+        txn = conn.begin()
+        try:
+            for shadow in xmlindex_list:
+                table = shadow._getElementCls().db_table
+                conn.execute(table.delete(sql.and_(
+                    table.c['index_id'] == shadow._id,
+                    table.c['document_id'].in_(document_ids))))
+            self._storeRows(rows, conn)
+            index_ids = [-shadow._id for shadow in xmlindex_list]
+            conn.execute(index_shadow_tab.update(
+                index_shadow_tab.c['index_id'].in_(index_ids)),
+                checkpoint=document_ids[-1])
+            txn.commit()
+        except:
+            txn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _iterUntilCancelled(self, batches, ids):
+        """
+        Yields batches until a reindex of any of the given index ids has been
+        cancelled.
+        """
+        for batch in batches:
+            if self._cancelled.intersection(ids):
+                return
+            yield batch
+
+    def _iterBatches(self, query, id_column, batch_size):
+        """
+        Yields lists of (document_id, data, revision) tuples.
+
+        Documents are fetched in chunks ordered by document id (keyset
+        pagination), so only a single batch of documents is kept in memory and
+        no cursor stays open while index rows are committed - SQLite does not
+        allow to commit inserts while keeping an open cursor.
+        """
+        last_id = None
+        while True:
+            chunk = query
+            if last_id is not None:
+                chunk = chunk.where(id_column > last_id)
+            chunk = chunk.order_by(id_column).limit(batch_size)
+            batch = [(item['id'], item['data'], item['revision'])
+                     for item in self._db.execute(chunk).fetchall()]
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1][0]
+
+    def _reindexSerial(self, xmlindex_list, batches, total, progress=None,
+                       online=False):
+        """
+        Evaluates and stores batches of documents in the calling thread.
+        """
+        plan = XmlIndexPlan(xmlindex_list)
+        done = 0
+        for batch in batches:
+            elements = []
+            for doc_elements in plan.evalMany(_getDocuments(batch), self.env):
+                elements.extend(doc_elements)
+            if online:
+                rows = [(el.db_table, self._getElementRow(el))
+                        for el in elements]
+                self._storeShadowRows(xmlindex_list, batch, rows)
+            else:
+                self._storeElements(elements)
+            done += len(batch)
+            self._reportProgress(progress, done, total)
+
+    def _reindexParallel(self, xmlindex_list, batches, processes, total,
+                         progress=None, online=False):
+        """
+        Evaluates batches of documents in a pool of worker processes.
+
+        Workers parse documents and evaluate all plain XML indexes, returning
+        plain key tuples which are written in bulk by the calling process.
+        Processor indexes need the environment and are evaluated locally.
+        """
+        xmlindexes = dict([(x._id, x) for x in xmlindex_list])
+        index_defs = [(x._id, x.xpath, x.group_path, x.type, x.options,
+                       x.label)
+                      for x in xmlindex_list if x.type != PROCESSOR_INDEX]
+        processor_plan = XmlIndexPlan([x for x in xmlindex_list
+                                       if x.type == PROCESSOR_INDEX])
+        pool = multiprocessing.Pool(processes)
+        # limit the number of pending batches to keep memory usage bounded
+        pending = deque()
+        done = 0
+        try:
+            for batch in batches:
+                job = pool.apply_async(_reindexWorker, (index_defs, batch))
+                pending.append((batch, job))
+                if len(pending) < 2 * processes:
+                    continue
+                batch, job = pending.popleft()
+                self._storeWorkerResults(xmlindexes, processor_plan, batch,
+                                         job.get(), online)
+                done += len(batch)
+                self._reportProgress(progress, done, total)
+            while pending:
+                batch, job = pending.popleft()
+                self._storeWorkerResults(xmlindexes, processor_plan, batch,
+                                         job.get(), online)
+                done += len(batch)
+                self._reportProgress(progress, done, total)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _storeWorkerResults(self, xmlindexes, processor_plan, batch, result,
+                            online=False):
+        """
+        Bulk writes key tuples of a worker and evaluates processor indexes.
+
+        Stops the reindex if the worker failed to evaluate any document.
+        """
+        keys, errors = result
+        if errors:
+            for document_id, error in errors:
+                msg = "Reindexing document %d failed: %s"
+                self._db_manager.env.log.error(msg % (document_id, error))
+            msg = "Reindexing failed on %d document(s), e.g. document %d: %s"
+            raise SeisHubError(msg % ((len(errors),) + errors[0]))
+        rows = [self._getKeyRow(xmlindexes[index_id], key, group_pos,
+                                document_id, extra)
+                for index_id, key, group_pos, document_id, extra in keys]
+        if processor_plan.xmlindex_list:
+            for elements in processor_plan.evalMany(_getDocuments(batch),
+                                                    self.env):
+                rows.extend([(el.db_table, self._getElementRow(el))
+                             for el in elements])
+        if online:
+            self._storeShadowRows(xmlindexes.values(), batch, rows)
+        else:
+            self._storeRows(rows)
+
+    def _reportProgress(self, progress, done, total):
+        msg = "Reindexing: %d of %d documents done." % (done, total)
+        self._db_manager.env.log.debug(msg)
+        if progress:
+            progress(done, total)
+
+
+def _getDocuments(batch):
+    """
+    Returns XmlDocument objects for a list of (id, data, revision) tuples.
+    """
+    documents = []
+    for id, data, revision in batch:
+        # build temporary objects manually for performance reasons
+        doc = XmlDocument(data=data, revision=revision)
+        doc._id = id
+        documents.append(doc)
+    return documents
+
+
+def _reindexWorker(index_defs, batch):
+    """
+    Evaluates XML indexes on a batch of documents in a worker process.
+
+    Returns a list of (index_id, key, group_pos, document_id, extra) tuples,
+    with extra holding the values of additional index table columns, and a
+    list of (document_id, error message) tuples of all documents which could
+    not be evaluated.
+    """
+    xmlindex_list = []
+    for _id, xpath, group_path, type, options, label in index_defs:
+        xmlindex = XmlIndex(xpath=xpath, type=type, options=options,
+                            group_path=group_path, label=label)
+        xmlindex._id = _id
+        xmlindex_list.append(xmlindex)
+    plan = XmlIndexPlan(xmlindex_list)
+    keys = []
+    errors = []
+    for doc in _getDocuments(batch):
+        try:
+            elements = plan.eval(doc)
+        except Exception, e:
+            # exceptions may not be picklable - pass the message only
+            errors.append((doc._id, "%s: %s" % (e.__class__.__name__, e)))
+            continue
+        keys.extend([(el.index._id, el.key, el.group_pos, doc._id,
+                      tuple([getattr(el, f) for f in el._extra_fields]))
+                     for el in elements])
+    return keys, errors
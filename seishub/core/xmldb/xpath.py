@@ -1,9 +1,72 @@
 # -*- coding: utf-8 -*-
 
 from seishub.core.core import implements
+from seishub.core.db.util import decodeCursor
 from seishub.core.exceptions import InvalidParameterError
+from seishub.core.util.cache import LRUCache
 from seishub.core.xmldb.interfaces import IXPathQuery
 import pyparsing as pp
+import threading
+
+
+# number of parsed queries kept in memory
+QUERY_CACHE_SIZE = 500
+
+_grammar = None
+_grammar_lock = threading.Lock()
+_query_cache = LRUCache(QUERY_CACHE_SIZE)
+
+
+class _PathTokens(list):
+    """
+    Path expression of a predicate or order by clause.
+
+    The raw tokens are kept, as relative paths are resolved against the
+    location path of the query after the whole query has been parsed.
+    """
+
+    def __init__(self, tokens):
+        list.__init__(self)
+        self.tokens = tokens
+
+
+def _evalPath(s, loc, tokens):
+    return [_PathTokens(tokens.asList())]
+
+
+def _removeLocationIds(s, loc, tokens):
+    # package and resource type ids are kept as named results only
+    del tokens[:2]
+    return tokens
+
+
+def _removeList(s, loc, tokens):
+    if len(tokens) == 1:
+        return tokens[0]
+
+
+def _toList(tokens):
+    """
+    Returns a copy of nested parse results using plain lists.
+    """
+    if isinstance(tokens, (pp.ParseResults, list)):
+        return [_toList(t) for t in tokens]
+    return tokens
+
+
+def _getGrammar():
+    """
+    Returns the parse function of the restricted XPath query grammar.
+
+    The grammar is built only once per process. Parse actions do not keep any
+    state, so the returned function may be used by multiple threads.
+    """
+    global _grammar
+    if _grammar is None:
+        with _grammar_lock:
+            if _grammar is None:
+                _grammar = RestrictedXPathQueryParser.createParser()
+    return _grammar
 
 
 class RestrictedXPathQueryParser(object):
@@ -56,11 +119,24 @@ class RestrictedXPathQueryParser(object):
     parExpr          ::= lpar pexpr rpar
 
     notFunc          ::= not(pexpr)
-    func             ::= notFunc
+    containsFunc     ::= contains(pathExpr, valueExpr)
+    withinBBoxFunc   ::= within_bbox(pathExpr, valueExpr, valueExpr,
+                                     valueExpr, valueExpr)
+    withinRadiusFunc ::= within_radius(pathExpr, valueExpr, valueExpr,
+                                       valueExpr)
+    overlapsFunc     ::= overlaps(pathExpr, valueExpr, valueExpr)
+    func             ::= notFunc | containsFunc | withinBBoxFunc |
+                         withinRadiusFunc | overlapsFunc
 
     pexpr            ::= (func | relExpr | parExpr) [logOp (pexpr | parExpr)]*
     predicates       ::= pstart pexpr pend
-    query = location [predicates]
+
+    aggFunc          ::= count() | min(pathExpr) | max(pathExpr) |
+                         avg(pathExpr)
+    groupItem        ::= pathExpr | bucket(pathExpr, valueExpr)
+    select           ::= 'select' aggFunc [, aggFunc]*
+                         ['group by' groupItem [, groupItem]*]
+    query = location [predicates] [select]
     """
 
     SEP = '/'
@@ -69,44 +145,28 @@ class RestrictedXPathQueryParser(object):
 
     _logical_ops = ['and', 'or']
     _relational_ops = ['=', '<', '>', '<=', '>=', '!=']
+    _functions = ['not', 'contains', 'within_bbox', 'within_radius',
+                  'overlaps']
+
+    _attributes = ['package_id', 'resourcetype_id', 'location_steps',
+                   'predicates', 'aggregates', 'group_by', 'order_by',
+                   'limit', 'offset', 'cursor']
 
     def __init__(self):
-        self.parser = self.createParser()
         self._init_parser()
 
     def _init_parser(self):
-        self.package_id = None
-        self.resourcetype_id = None
-        self.location_steps = None
-        self.predicates = None
-        self.order_by = None
-        self.limit = None
-        self.offset = None
-
-    def evalPackage_id(self, s, loc, tokens):
-        self.package_id = tokens[0]
-        return tokens
-
-    def evalResourcetype_id(self, s, loc, tokens):
-        self.resourcetype_id = tokens[0]
-        return tokens
-
-    def evalLocationSteps(self, s, loc, tokens):
-        self.location_steps = tokens.asList()
-        return tokens
-
-    def remove_list(self, s, loc, tokens):
-        if len(tokens) == 1:
-            return tokens[0]
-
-    def evalPath(self, s, loc, tokens):
+        for key in self._attributes:
+            setattr(self, key, None)
+
+    def _resolvePath(self, tokens):
         """
-        add location path as a prefix to path tokens and join the rest
-        of the path again.
+        Returns [package_id, resourcetype_id, path] of the tokens of a path
+        expression, prefixing relative paths with the location path.
         """
         if tokens[0] == self.SEP:
             # path is relative to root (package level)
-            return [[tokens[1], tokens[2], self.SEP.join(tokens[3:])]]
+            return [tokens[1], tokens[2], self.SEP.join(tokens[3:])]
         # count the number of '..' nodes at the beginning of the path and move
         # the appropriate number of steps in path to the left
         steps = 0
@@ -114,14 +174,21 @@ class RestrictedXPathQueryParser(object):
             if not t == self.PARENT:
                 break
             steps += 1
-        # steps = len(filter(lambda t: t == self.PARENT, tokens))
         ptokens = [self.package_id, self.resourcetype_id]
         ptokens.extend(self.location_steps)
         ptokens = ptokens[:len(ptokens) - steps]
         ptokens.extend(tokens[steps:])
-        return [[ptokens[0], ptokens[1], self.SEP.join(ptokens[2:])]]
+        return [ptokens[0], ptokens[1], self.SEP.join(ptokens[2:])]
+
+    def _resolvePaths(self, tokens):
+        for token in tokens:
+            if isinstance(token, _PathTokens):
+                token[:] = self._resolvePath(token.tokens)
+            elif isinstance(token, (pp.ParseResults, list)):
+                self._resolvePaths(token)
 
-    def createParser(self):
+    @classmethod
+    def createParser(cls):
         """This function returns a parser for the RestrictedXpathQuery grammar.
         """
         # xml standard tokens (see: http://www.w3.org/TR/REC-xml)
@@ -142,10 +209,10 @@ class RestrictedXPathQueryParser(object):
                       unichr(0xB7) + pp.srange("[\u0300-\u036F]") + \
                       pp.srange("[\u203F-\u2040]")
         # custom tokens
-        wildcard = pp.Literal(self.WILDCARD)        # node wildcard operator
-        sep = pp.Literal(self.SEP)                  # path separator
+        wildcard = pp.Literal(cls.WILDCARD)         # node wildcard operator
+        sep = pp.Literal(cls.SEP)                   # path separator
         selfNd = pp.Literal('.').suppress()         # current node
-        parentNd = pp.Literal(self.PARENT)          # parent of current node
+        parentNd = pp.Literal(cls.PARENT)           # parent of current node
         lpar = pp.Literal('(').suppress()           # left parenthesis literal
         rpar = pp.Literal(')').suppress()           # right parenthesis literal
         pstart = pp.Literal('[').suppress()         # beginning of predicates
@@ -174,6 +241,9 @@ class RestrictedXPathQueryParser(object):
         desc = pp.CaselessKeyword('desc')
         limit = pp.CaselessKeyword('limit')
         offset = pp.CaselessKeyword('offset')
+        after = pp.CaselessKeyword('after')
+        select = pp.CaselessKeyword('select')
+        groupBy = pp.CaselessKeyword('group by')
 
         # operators
         eqOp = pp.Literal('==').setParseAction(pp.replaceWith("=")) | \
@@ -190,34 +260,57 @@ class RestrictedXPathQueryParser(object):
 
         # functions
         notFunc = pp.CaselessKeyword('not')
+        containsFunc = pp.CaselessKeyword('contains')
+        withinBBoxFunc = pp.CaselessKeyword('within_bbox')
+        withinRadiusFunc = pp.CaselessKeyword('within_radius')
+        overlapsFunc = pp.CaselessKeyword('overlaps')
+        pathFunc = containsFunc | withinBBoxFunc | withinRadiusFunc | \
+                   overlapsFunc
+        comma = pp.Literal(',').suppress()
+
+        # aggregate functions
+        countFunc = pp.CaselessKeyword('count')
+        aggFunc = pp.CaselessKeyword('min') | pp.CaselessKeyword('max') | \
+                  pp.CaselessKeyword('avg')
+        bucketFunc = pp.CaselessKeyword('bucket')
 
         # location step
         package_id = (pp.Word(pp.alphanums + "-_") | wildcard).\
-                     setResultsName('package_id').\
-                     setParseAction(self.evalPackage_id).suppress()
+                     setResultsName('package_id')
         resourcetype_id = (pp.Word(pp.alphanums + "-_") | wildcard).\
-                          setResultsName('resourcetype_id').\
-                          setParseAction(self.evalResourcetype_id).suppress()
+                          setResultsName('resourcetype_id')
 
         locationStep = (sep.suppress() + (ndName | wildcard)).\
                        setResultsName('locationStep', True)
         location = (sep.suppress() + package_id + \
                    sep.suppress() + resourcetype_id + \
                    pp.ZeroOrMore(locationStep)).\
-                   setParseAction(self.evalLocationSteps)
+                   setParseAction(_removeLocationIds)
 
         # predicate expression
-        pexpr = pp.Forward().setParseAction(self.remove_list)
+        pexpr = pp.Forward().setParseAction(_removeList)
         pathExpr = (pp.Optional(sep) + node + \
                     pp.ZeroOrMore(sep.suppress() + node)).\
-                    setParseAction(self.evalPath)
+                    setParseAction(_evalPath)
         valueExpr = literalValue | numericValue
         relExpr = pathExpr + pp.Optional(relOp + (valueExpr | pathExpr))
         parExpr = pp.Group(lpar + pexpr + rpar)
         notExpr = pp.Group(notFunc + parExpr)
-        pexpr << (notExpr | pp.Group(relExpr) | parExpr) + \
+        pathFuncExpr = pp.Group(pathFunc + lpar + pathExpr + \
+                                pp.OneOrMore(comma + valueExpr) + rpar)
+        pexpr << (notExpr | pathFuncExpr | pp.Group(relExpr) | parExpr) + \
                  pp.Optional(logOp + (pp.Group(pexpr) | parExpr))
 
+        # aggregates and group by clause
+        aggItem = (countFunc + lpar + rpar | \
+                   aggFunc + lpar + pathExpr + rpar).\
+                  setResultsName('aggregates', listAllMatches=True)
+        selectExpr = select + pp.delimitedList(aggItem, ',')
+        gbItem = (bucketFunc.suppress() + lpar + pathExpr + comma + \
+                  valueExpr + rpar | pathExpr).\
+                 setResultsName('group_by', listAllMatches=True)
+        groupByExpr = groupBy + pp.delimitedList(gbItem, ',')
+
         # order by clause
         obItem = (pathExpr + pp.Optional(asc | desc, 'asc')).\
                  setResultsName('order_by', listAllMatches=True)
@@ -229,42 +322,86 @@ class RestrictedXPathQueryParser(object):
                                 pp.Word(pp.nums).setResultsName('offset'))
         offsetExpr = offset + pp.Word(pp.nums).setResultsName('offset')
 
+        # continuation token of a previous query
+        quote = pp.oneOf('" \'').suppress()
+        afterExpr = after + quote + \
+                    pp.Word(pp.alphanums + '-_=').setResultsName('cursor') + \
+                    quote
+
         # query
         predicates = (pstart + pexpr + pend).setResultsName('predicates')
         query = pp.StringStart() + \
                 location + \
                 pp.Optional(predicates) + \
+                pp.Optional(selectExpr + pp.Optional(groupByExpr)) + \
                 pp.Optional(orderByExpr) + \
                 pp.Optional(limitExpr) + \
                 pp.Optional(offsetExpr) + \
+                pp.Optional(afterExpr) + \
                 pp.StringEnd()
 
+        query.streamline()
         return query.parseString
 
     def setAttributes(self, parsed):
+        self.package_id = parsed['package_id']
+        self.resourcetype_id = parsed['resourcetype_id']
+        self.location_steps = [step for steps in parsed.get('locationStep', [])
+                               for step in steps]
+        self._resolvePaths(parsed)
         predicates = parsed.get('predicates')
         if isinstance(predicates, pp.ParseResults):
-            self.predicates = predicates.asList()
+            self.predicates = _toList(predicates)
+        aggregates = parsed.get('aggregates')
+        if isinstance(aggregates, pp.ParseResults):
+            # count() has no path
+            self.aggregates = [(a + [None])[:2] for a in _toList(aggregates)]
+        group_by = parsed.get('group_by')
+        if isinstance(group_by, pp.ParseResults):
+            # group by path [bucket width]
+            self.group_by = [(g + [None])[:2] for g in _toList(group_by)]
         order_by = parsed.get('order_by')
         if isinstance(order_by, pp.ParseResults):
-            self.order_by = order_by.asList()
+            self.order_by = _toList(order_by)
         limit = parsed.get('limit')
         if isinstance(limit, basestring):
             self.limit = int(limit)
         offset = parsed.get('offset')
         if isinstance(offset, basestring):
             self.offset = int(offset)
+        cursor = parsed.get('cursor')
+        if isinstance(cursor, basestring):
+            self.cursor = cursor
         return parsed
 
-    def parse(self, expr):
+    def parse(self, expr, cache=True):
+        """
+        Parses a query and sets location path, predicates, aggregates, group
+        by and order by clause, limit, offset and cursor of this object.
+
+        Parsed queries are cached unless cache is False - the returned parse
+        results are shared and must not be modified.
+        """
         self._init_parser()
+        cached = cache and _query_cache.get(expr)
+        if cached:
+            parsed, attributes = cached
+            for key, value in attributes.iteritems():
+                setattr(self, key, _toList(value))
+            return parsed
         try:
-            return self.setAttributes(self.parser(expr))
+            parsed = self.setAttributes(_getGrammar()(expr))
         except pp.ParseException, e:
             msg = "Error parsing query: Unexpected or invalid token at " + \
                   "position %s: %s"
             raise InvalidParameterError(msg % (str(e.loc),
                                                str(e.markInputline())))
+        if cache:
+            attributes = dict([(key, _toList(getattr(self, key)))
+                               for key in self._attributes])
+            _query_cache.set(expr, (parsed, attributes))
+        return parsed
+
 
 class XPathQuery(RestrictedXPathQueryParser):
     """
@@ -293,6 +430,12 @@ class XPathQuery(RestrictedXPathQueryParser):
     def getPredicates(self):
         return self.predicates
 
+    def getAggregates(self):
+        return self.aggregates
+
+    def getGroupBy(self):
+        return self.group_by
+
     def getOrderBy(self):
         return self.order_by
 
@@ -301,3 +444,12 @@ class XPathQuery(RestrictedXPathQueryParser):
 
     def getOffset(self):
         return self.offset
+
+    def getCursor(self):
+        """
+        Returns the decoded values of the continuation token given by an
+        'after' clause or None.
+        """
+        if self.cursor is None:
+            return None
+        return decodeCursor(self.cursor)